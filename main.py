@@ -1,35 +1,51 @@
 import os
-import shutil
 import uuid
+import hashlib
 import logging
-from datetime import timedelta
-from typing import Annotated, Optional, List, Dict, Any
+from datetime import datetime, timedelta, timezone
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Annotated, Optional, List, Dict, Any, Literal
 import asyncio
+import json
 import httpx
+from urllib.parse import urlparse
 
 from fastapi import (
     FastAPI, Depends, HTTPException, status, UploadFile,
-    File, WebSocket, Request, Form
+    File, WebSocket, WebSocketDisconnect, Request, Form, Query
 )
 from fastapi.security import OAuth2PasswordRequestForm
 
-from fastapi.responses import FileResponse as FastAPIFileResponse, HTMLResponse, StreamingResponse, JSONResponse, RedirectResponse
+from fastapi.responses import FileResponse as FastAPIFileResponse, HTMLResponse, StreamingResponse, JSONResponse, RedirectResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.concurrency import run_in_threadpool
 from contextlib import asynccontextmanager
 from fastapi.templating import Jinja2Templates
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy import select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
 from google import genai
 from google.genai import types
-from PIL import Image
-import io
 
 import module.auth as auth
-from module.database import engine, get_db
-from module.models import Base, User, UploadedFile, Slide
+from module.database import engine, get_async_db, get_async_read_db, dispose_engines, ensure_schema, SessionLocal, AsyncSessionLocal
+from module.models import Base, User, UploadedFile, Slide, UploadSession, Blob
+from module.patch import PatchError, apply_json_patch, apply_merge_patch
+import module.slidestore as slidestore
+import module.imaging as imaging
+from module.blocklist import BlocklistRefresher
+from module.aicache import AIResponseCache, make_cache_key
+from module.ttlcache import TTLCache
+from module.scheduler import AIScheduler, SchedulerBusy
+from module.collab import CollabManager, RoomAccessDenied
+from module.backplane import create_backplane
+import module.wsproto as wsproto
+from module.blobstore import BlobStore, acquire_blob, release_blob, blob_in_use, hash_file
+from starlette.requests import ClientDisconnect
+from starlette.background import BackgroundTask
 
 # 多言語対応メッセージ定義
 MESSAGES = {
@@ -54,7 +70,13 @@ MESSAGES = {
         'file_not_found': 'ファイルが見つかりません',
         'unauthorized_access': 'アクセス権限がありません',
         'file_too_large': 'ファイルサイズが上限を超えています',
-        'invalid_file_type': 'サポートされていないファイル形式です'
+        'invalid_file_type': 'サポートされていないファイル形式です',
+        'slide_version_conflict': 'スライドが他の操作で更新されています。最新の内容を取得してください',
+        'invalid_patch': 'スライドの差分データが不正です',
+        'ai_too_many_requests': 'AI機能へのリクエストが混み合っています。しばらくしてから再試行してください',
+        'auth_busy': '認証処理が混み合っています。しばらくしてから再試行してください',
+        'too_many_urls': '一度にチェックできるURLの数を超えています',
+        'invalid_slide_data': 'スライドデータが不正です'
     },
     'en': {
         'user_registered': 'User registration completed',
@@ -77,7 +99,13 @@ MESSAGES = {
         'file_not_found': 'File not found',
         'unauthorized_access': 'Access denied',
         'file_too_large': 'File size exceeds limit',
-        'invalid_file_type': 'Unsupported file type'
+        'invalid_file_type': 'Unsupported file type',
+        'slide_version_conflict': 'Slide was modified by another request. Please reload the latest version',
+        'invalid_patch': 'Invalid slide patch',
+        'ai_too_many_requests': 'Too many AI requests. Please retry later',
+        'auth_busy': 'Authentication is busy. Please retry later',
+        'too_many_urls': 'Too many URLs to check at once',
+        'invalid_slide_data': 'Invalid slide data'
     }
 }
 
@@ -111,11 +139,18 @@ def create_error_response(message_key: str, lang: str = 'ja', status_code: int =
 os.makedirs("data", exist_ok=True)
 # Create DB tables
 Base.metadata.create_all(bind=engine)
+ensure_schema(engine)
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# メタデータ列の追加前に作られたスライドの一覧表示用メタデータを埋める（一度だけ）
+with SessionLocal() as _db:
+    _backfilled = slidestore.backfill_metadata(_db)
+    if _backfilled:
+        logger.info(f"Backfilled slide metadata for {_backfilled} slides")
+
 # Pydantic models (Schemas)
 class UserCreate(BaseModel):
     username: str
@@ -144,17 +179,63 @@ class FileResponse(BaseModel):
     class Config:
         from_attributes = True
 
+class UploadSessionCreate(BaseModel):
+    filename: str
+    size: int
+    content_type: str
+
+class UploadSessionResponse(BaseModel):
+    upload_id: str
+    file_type: str
+    filename: Optional[str] = None
+    size: int
+    offset: int
+
 class SlideCreate(BaseModel):
     slide_data: str
 
 class SlideResponse(BaseModel):
     id: int
     slide_data: str
+    version: int
     owner_id: int
 
     class Config:
         from_attributes = True
 
+class SlideSummary(BaseModel):
+    id: int
+    title: Optional[str] = None
+    page_count: int
+    thumbnail_url: Optional[str] = None
+    updated_at: Optional[datetime] = None
+    version: int
+
+    class Config:
+        from_attributes = True
+
+class SlideSummaryPage(BaseModel):
+    items: List[SlideSummary]
+    next_cursor: Optional[str] = None
+
+class SlidePageSummary(BaseModel):
+    index: int
+    page_id: Optional[str] = None
+    element_count: int = 0
+
+class SlideOutlineResponse(BaseModel):
+    id: int
+    version: int
+    owner_id: int
+    outline: Any  # "slides" を除いたプレゼンテーション本体(settings など)
+    page_count: int
+    pages: List[SlidePageSummary]
+
+class SlidePatch(BaseModel):
+    version: int  # 差分の基準となるバージョン
+    patch_type: Literal["json-patch", "merge-patch"] = "json-patch"
+    patch: Any
+
 class AIPrompt(BaseModel):
     prompt: str
 
@@ -167,6 +248,17 @@ class URLSafetyResponse(BaseModel):
     matched_domain: Optional[str] = None
     source: Optional[str] = None
 
+class URLBatchRequest(BaseModel):
+    urls: List[str] = []
+    slide_data: Optional[str] = None  # 指定した場合、資料中の http(s) URL もすべてチェックする
+
+class URLBatchItem(URLSafetyResponse):
+    url: str
+
+class URLBatchResponse(BaseModel):
+    results: List[URLBatchItem]
+    domain_count: int  # 判定したユニークなドメインの数
+
 class WordRequest(BaseModel):
     keyword: str
 
@@ -174,31 +266,69 @@ class WordRequest(BaseModel):
 async def lifespan(app: FastAPI):
     """
     アプリのライフスパン管理:
-    - startup: ブロックリストをプリフェッチ
-    - shutdown: 共有HTTPクライアントをクローズ
+    - startup: 既存のブロックリストのスナップショットを mmap し、バックグラウンド更新を開始、Gemini クライアントを生成
+    - shutdown: APIキャッシュの裏での更新を止め、共同編集ルームを保存し、共有HTTPクライアント・Gemini クライアント・画像処理プロセスプール・パスワードハッシュ用スレッドプール・DB 接続をクローズ
     """
+    global gemini_client
+    if GEMINI_API_KEY and gemini_client is None:
+        gemini_client = genai.Client(api_key=GEMINI_API_KEY)
     try:
-        await _ensure_blocklists_loaded(force=True)
-        logger.info("Lifespan startup: blocklists prefetched.")
+        # 古いスナップショットでも、取得が終わるまでのつなぎとして使う
+        blocklist_refresher.load_snapshot()
+        blocklist_refresher.start()
+        logger.info("Lifespan startup: blocklist refresher started.")
     except Exception as e:
         logger.error(f"Lifespan startup failed: {e}", exc_info=True)
     # アプリ稼働期間へ遷移
     try:
         yield
     finally:
+        await blocklist_refresher.stop()
+        await api_cache.close()
+        try:
+            await collab_manager.close()
+        except Exception as e:
+            logger.warning(f"Collaboration rooms cleanup failed: {e}", exc_info=True)
         try:
             await shared_http_client.aclose()
             logger.info("Lifespan shutdown: shared_http_client closed.")
         except Exception as e:
             logger.warning(f"Lifespan shutdown cleanup failed: {e}", exc_info=True)
+        if gemini_client is not None:
+            try:
+                await gemini_client.aio.aclose()
+                gemini_client.close()
+                logger.info("Lifespan shutdown: gemini_client closed.")
+            except Exception as e:
+                logger.warning(f"Gemini client cleanup failed: {e}", exc_info=True)
+            gemini_client = None
+        imaging.shutdown_process_pool()
+        logger.info(f"Lifespan shutdown: password_hasher stats={auth.password_hasher.stats()}")
+        logger.info(f"Lifespan shutdown: ai_scheduler stats={ai_scheduler.stats()}")
+        auth.password_hasher.shutdown()
+        await dispose_engines()
 
 app = FastAPI(lifespan=lifespan)
 
+
+@app.exception_handler(auth.PasswordHasherBusy)
+async def password_hasher_busy_handler(request: Request, exc: auth.PasswordHasherBusy):
+    """パスワード処理の待ちが上限を超えたら、bcrypt を積まずに 503 + Retry-After で返す"""
+    logger.warning(f"Password hashing rejected, retry after {exc.retry_after}s: {auth.password_hasher.stats()}")
+    lang = request.query_params.get('lang', 'ja')
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": get_message('auth_busy', lang)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
 # --- HTTP client (app-scope) and utilities for Wikipedia endpoint ---
 # Shared AsyncClient with HTTP/2, connection pooling, and split timeouts
 # Note: keep a single client instance to benefit from connection reuse
 client_timeout = httpx.Timeout(connect=1.0, read=5.0, write=5.0, pool=2.0)
 shared_http_client = httpx.AsyncClient(http2=True, timeout=client_timeout, headers={"Accept-Encoding": "gzip, deflate"})
+# Gemini client (app-scope): created in lifespan, reused across /ai/ask requests
+gemini_client: Optional[genai.Client] = None
 
 # --- URL Safety (Blocklist) Utilities ---
 BLOCK_LIST = [
@@ -211,100 +341,34 @@ EXTRA_BLOCKLISTS = [
     "https://raw.githubusercontent.com/Spam404/lists/master/main-blacklist.txt",
 ]
 
-# メモリキャッシュ（アプリ存続期間内）
-_blocklist_cache: dict[str, set[str]] = {"phishing": set(), "urlhaus": set()}
-_blocklist_loaded = False
-_blocklist_lock = asyncio.Lock()
+# 照合器（ソート済みハッシュ配列）。取得結果は data/ 配下のスナップショットに書き出し、
+# 各ワーカーはそれを mmap して共有する（起動時もテキストを解析せずにマップするだけ）
+BLOCKLIST_SNAPSHOT_PATH = os.getenv("BLOCKLIST_SNAPSHOT_PATH", "data/blocklist.snapshot")
+# リストごとの正規化済みドメイン一覧と ETag/Last-Modified の保存先
+BLOCKLIST_CACHE_DIR = os.getenv("BLOCKLIST_CACHE_DIR", "data/blocklists")
 # 1日(24h)に1回の更新
 _BLOCKLIST_TTL = 24 * 60 * 60.0  # 86400秒
-_blocklist_expire_at: float = 0.0
-
-async def _ensure_blocklists_loaded(*, force: bool = False) -> None:
-    """
-    ブロックリストを一度だけ（もしくはTTL切れ/強制時）読み込み、アプリ内メモリにキャッシュする。
-    - force=True のとき: TTLに関係なく再取得を試みる
-    - TTL切れ: 最終取得時刻から24時間経過で更新
-    失敗しても既存のキャッシュは保持する（フォールバック）。
-    """
-    global _blocklist_loaded, _blocklist_expire_at, _blocklist_cache
 
-    now = asyncio.get_event_loop().time()
-    if not force and _blocklist_loaded and _blocklist_expire_at > now:
-        # 既にロード済みかつTTL内
-        return
-
-    async with _blocklist_lock:
-        # ダブルチェック（同時呼び出し対策）
-        now = asyncio.get_event_loop().time()
-        if not force and _blocklist_loaded and _blocklist_expire_at > now:
-            return
-
-        # 並列ダウンロード
-        try:
-            # BLOCK_LIST は 0..2 の3件構成。0/1 が phishing、2 が urlhaus。
-            # EXTRA_BLOCKLISTS は任意個。全て phishing 側として取り扱う。
-            core_tasks = [
-                _download_blocklist(BLOCK_LIST[0]),  # phishing.army (phishing)
-                _download_blocklist(BLOCK_LIST[1]),  # malware-filter phishing (phishing)
-                _download_blocklist(BLOCK_LIST[2]),  # urlhaus online (urlhaus)
-            ]
-            extra_tasks = [_download_blocklist(url) for url in EXTRA_BLOCKLISTS]  # Spam404 など
-            tasks = core_tasks + extra_tasks
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-
-            phishing_sets: list[set[str]] = []
-            urlhaus_sets: list[set[str]] = []
-
-            # マッピング:
-            #  - phishing: core indices 0,1 + all extras (idx >= len(core_tasks))
-            #  - urlhaus : core index 2
-            for idx, res in enumerate(results):
-                if isinstance(res, Exception):
-                    logger.error(f"Blocklist task {idx} failed: {res}", exc_info=True)
-                    continue
-                if idx in (0, 1) or idx >= len(core_tasks):
-                    phishing_sets.append(res)
-                elif idx == 2:
-                    urlhaus_sets.append(res)
-
-            # old mirror.cedia はドメインリスト形式だが品質不確実のため現状は未使用
-            # 必要になれば以下の通りで追加可能:
-            # cedia = await _download_blocklist(BLOCK_LIST[1])
-            # phishing_sets.append(cedia)
-
-            # 集約してセット化
-            phishing = set().union(*phishing_sets) if phishing_sets else set()
-            urlhaus = set().union(*urlhaus_sets) if urlhaus_sets else set()
-
-
-            common = phishing & urlhaus
-            if common:
-                urlhaus = urlhaus - common
-
-            # 最低限の正規化（空要素は _download_blocklist 側で排除済み）
-            # キャッシュに反映（全置換）
-            _blocklist_cache["phishing"] = phishing
-            _blocklist_cache["urlhaus"] = urlhaus
-
-            _blocklist_loaded = True
-            _blocklist_expire_at = asyncio.get_event_loop().time() + _BLOCKLIST_TTL
-
-            logger.info(
-                f"Blocklists loaded: phishing={len(phishing)}, urlhaus={len(urlhaus)}, ttl={_BLOCKLIST_TTL}s, extras={len(EXTRA_BLOCKLISTS)}"
-            )
-        except Exception as e:
-            # 失敗時はロードフラグやTTLは更新しない（既存キャッシュを維持）
-            logger.error(f"Failed to load blocklists: {e}", exc_info=True)
-            # 起動時強制プリフェッチが失敗した場合でもアプリは動作継続する
-            return
+# 更新はバックグラウンド(lifespan で起動)で行い、リクエスト処理は常に現在の照合器で即座に判定する
+# dict の順序が優先度。同じドメインが両方にある場合は phishing として扱う
+blocklist_refresher = BlocklistRefresher(
+    lambda: shared_http_client,
+    {
+        # BLOCK_LIST の 0/1 と EXTRA_BLOCKLISTS(Spam404 など) が phishing、2 が urlhaus
+        "phishing": [BLOCK_LIST[0], BLOCK_LIST[1], *EXTRA_BLOCKLISTS],
+        "urlhaus": [BLOCK_LIST[2]],
+    },
+    BLOCKLIST_SNAPSHOT_PATH,
+    BLOCKLIST_CACHE_DIR,
+    ttl=_BLOCKLIST_TTL,
+)
 
 def _extract_domain_from_url(url: str) -> Optional[str]:
     """
     URLからホスト名(ドメイン)を抽出し、先頭/末尾のドットを除去して小文字化。
     """
     try:
-        import urllib.parse as up
-        parsed = up.urlparse(url.strip())
+        parsed = urlparse(url.strip())
         host = parsed.hostname
         if not host:
             return None
@@ -315,80 +379,33 @@ def _extract_domain_from_url(url: str) -> Optional[str]:
 
 def _check_domain_safety(domain: str) -> Optional[Dict[str, str]]:
     """
-    ドメインがブロックリストに含まれるかチェックする。高速なセット検索を利用。
-    サブドメインのマッチングも行う。
+    ドメインがブロックリストに含まれるかチェックする。ソート済みハッシュ配列の二分探索を利用。
+    サブドメインのマッチングも行う（"a.b.c" は "a.b.c" と "b.c" を照合し、"c" 単体は対象外）。
     含まれる場合は {"matched_domain": str, "source": str} を返す。
     """
-    if not domain:
+    match = blocklist_refresher.match(domain)
+    if match is None:
         return None
+    return {"matched_domain": match[0], "source": match[1]}
 
-    parts = domain.split('.')
-    # 少なくとも2つの部分（例: example.com）からなるドメインのみをチェック対象とする
-    # range(len(parts) - 1) は ["a.b.c", "b.c"] を生成するが "c" は生成しない
-    domain_variants = [".".join(parts[i:]) for i in range(len(parts) - 1)]
-
-    for source, blocklist in _blocklist_cache.items():
-        for variant in domain_variants:
-            if variant in blocklist:
-                return {"matched_domain": variant, "source": str(source)}
-    return None
-
-async def _download_blocklist(url: str) -> set[str]:
-    """
-    テキストのブロックリストを取得し、コメント/空行を除外してドメイン集合にする。
-    """
-    try:
-        resp = await _retrying_get(shared_http_client, url, params={}, max_retries=2, max_backoff_sec=2.0)
-        resp.raise_for_status()
-        text = resp.text
-        result: set[str] = set()
-        for line in text.splitlines():
-            line = line.strip()
-            if not line or line.startswith("#") or line.startswith("!"):
-                continue
-            # hosts形式や余分なプレフィックスの緩和
-            # 例: 0.0.0.0 domain.tld / 127.0.0.1 domain.tld
-            if " " in line:
-                parts = line.split()
-                line = parts[-1]
-            # ドメインだけに正規化
-            dom = line.strip(".").lower()
-            # 簡易ドメインバリデーション
-            if "." in dom and all(part for part in dom.split(".")):
-                result.add(dom)
-        return result
-    except Exception as e:
-        logger.error(f"Blocklist download failed: {url} : {e}", exc_info=True)
-        return set()
-
-
-
-# Simple in-memory TTL cache
-# key: str -> (expires_epoch: float, value: Any)
-_ttl_cache: dict[str, tuple[float, Any]] = {}
+# 外部 API（Wikipedia / Pixabay）の応答キャッシュ
+# TTL 切れ後も _CACHE_STALE_SECONDS の間は古い値を返しつつ裏で取り直す
+# 同じキー（_make_*_cache_key）の同時ミスは 1 回の上流呼び出し（リトライ込み）の結果・例外を共有する
 _TTL_SECONDS = 60.0  # as agreed
+_CACHE_STALE_SECONDS = float(os.getenv("API_CACHE_STALE_SECONDS", "300"))
+api_cache = TTLCache(
+    max_entries=int(os.getenv("API_CACHE_MAX_ENTRIES", "4096")),
+    max_bytes=int(os.getenv("API_CACHE_MAX_BYTES", str(16 * 1024 * 1024))),
+    default_ttl=_TTL_SECONDS,
+    ttls={
+        "wikiimages": float(os.getenv("API_CACHE_WIKI_TTL", "3600")),
+        "pixabay": float(os.getenv("API_CACHE_PIXABAY_TTL", str(_TTL_SECONDS))),
+    },
+    stale_ttl=_CACHE_STALE_SECONDS,
+)
 
-def _cache_get(key: str):
-    item = _ttl_cache.get(key)
-    if not item:
-        return None
-    exp, val = item
-    if exp < asyncio.get_event_loop().time():
-        # expired
-        _ttl_cache.pop(key, None)
-        return None
-    return val
-
-def _cache_set(key: str, value: Any, ttl: float = _TTL_SECONDS):
-    _ttl_cache[key] = (asyncio.get_event_loop().time() + ttl, value)
-
-def _make_titles_cache_key(keyword: str, lang: str) -> str:
-    return f"titles::{lang}::{keyword}"
-
-def _make_imageinfo_cache_key(titles: list[str], lang: str) -> str:
-    # titles order-insensitive to increase hit rate
-    joined = "|".join(sorted(titles))
-    return f"imageinfo::{lang}::{joined}"
+def _make_wiki_images_cache_key(keyword: str, lang: str) -> str:
+    return f"wikiimages::{lang}::{keyword}"
 
 def _make_pixabay_cache_key(q: str, page: int, per_page: int, lang: str) -> str:
     # Normalize and create key
@@ -403,10 +420,7 @@ async def url_safe_check(payload: URLRequest):
     - 入力: { "url": "https://example.com/page" }
     - 出力: { safe: bool, reason: "matched|clean|invalid_url|error", matched_domain?: str, source?: "phishing|urlhaus" }
     """
-    # ブロックリストのロード/更新
-    # 起動時にプリフェッチ済み。TTL(1日)超過時のみ更新を行うため、通常はヒット即判定。
-    await _ensure_blocklists_loaded()
-
+    # ブロックリストはバックグラウンドで更新されるため、ここでは取得を待たずに現在の照合器で判定する
     # URLからドメイン抽出
     domain = _extract_domain_from_url(payload.url)
     if not domain:
@@ -419,6 +433,56 @@ async def url_safe_check(payload: URLRequest):
 
     return URLSafetyResponse(safe=True, reason="clean")
 
+# 一括チェックで受け付ける URL 数の上限
+MAX_SAFE_CHECK_URLS = 1000
+
+def _collect_document_urls(value: Any, found: Dict[str, None]) -> None:
+    """スライドデータ内の http(s) URL の文字列を出現順に集める"""
+    if isinstance(value, str):
+        text = value.strip()
+        if text[:8].lower().startswith(("http://", "https://")):
+            found.setdefault(text, None)
+    elif isinstance(value, dict):
+        for item in value.values():
+            _collect_document_urls(item, found)
+    elif isinstance(value, list):
+        for item in value:
+            _collect_document_urls(item, found)
+
+@app.post("/api/url/safe-check/batch", response_model=URLBatchResponse)
+async def url_safe_check_batch(payload: URLBatchRequest, lang: str = 'ja'):
+    """
+    複数URL（または資料全体）を 1 回のリクエストでチェックする。
+    - 入力: { "urls": [...], "slide_data"?: "<プレゼンテーション JSON>" }
+    - 出力: { results: [{ url, safe, reason, matched_domain?, source? }, ...], domain_count }
+    同じ URL・同じドメインは一度だけ判定する。
+    """
+    urls: Dict[str, None] = dict.fromkeys(payload.urls)
+    if payload.slide_data:
+        try:
+            document = json.loads(payload.slide_data)
+        except ValueError:
+            raise create_error_response('invalid_slide_data', lang, status.HTTP_400_BAD_REQUEST)
+        _collect_document_urls(document, urls)
+    if len(urls) > MAX_SAFE_CHECK_URLS:
+        raise create_error_response('too_many_urls', lang, status.HTTP_400_BAD_REQUEST)
+
+    verdicts: Dict[str, Optional[Dict[str, str]]] = {}
+    results = []
+    for url in urls:
+        domain = _extract_domain_from_url(url)
+        if not domain:
+            results.append(URLBatchItem(url=url, safe=False, reason="invalid_url"))
+            continue
+        if domain not in verdicts:
+            verdicts[domain] = _check_domain_safety(domain)
+        match = verdicts[domain]
+        if match:
+            results.append(URLBatchItem(url=url, safe=False, reason="matched", **match))
+        else:
+            results.append(URLBatchItem(url=url, safe=True, reason="clean"))
+    return URLBatchResponse(results=results, domain_count=len(verdicts))
+
 async def _retrying_get(client: httpx.AsyncClient, url: str, *, params: dict[str, Any], max_retries: int = 2, max_backoff_sec: float = 2.0) -> httpx.Response:
     """
     GET with exponential backoff retries for transient statuses: 429/502/503/504.
@@ -456,33 +520,42 @@ async def read_slide_index(request: Request, data: Optional[str] = None):
 
 # --- User Account Endpoints ---
 @app.post("/auth/register", response_model=UserResponse)
-async def register_user(user: UserCreate, db: Session = Depends(get_db), lang: str = 'ja'):
-    db_user = db.query(User).filter_by(username=user.username).first()
+async def register_user(user: UserCreate, db: AsyncSession = Depends(get_async_db), lang: str = 'ja'):
+    db_user = await auth.get_user(db, user.username)
     if db_user:
         raise create_error_response('username_already_exists', lang, 400)
     
-    hashed_password = auth.get_password_hash(user.password)
+    hashed_password = await auth.get_password_hash_async(user.password)
     db_user = User(username=user.username, hashed_password=hashed_password)
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     
     log_user_action('user_registered', db_user.id, f"ユーザー名: {user.username}", lang)  # type: ignore
     return db_user
 
 @app.post("/auth/login", response_model=auth.Token)
-async def login_user(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: Session = Depends(get_db), lang: str = 'ja'):
-    user = db.query(User).filter_by(username=form_data.username).first()
-    if not user or not auth.verify_password(form_data.password, str(user.hashed_password)):
+async def login_user(form_data: Annotated[OAuth2PasswordRequestForm, Depends()], db: AsyncSession = Depends(get_async_db), lang: str = 'ja'):
+    user = await auth.get_user(db, form_data.username)
+    if not user or not await auth.verify_password_async(form_data.password, str(user.hashed_password)):
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail=get_message('invalid_credentials', lang),
             headers={"WWW-Authenticate": "Bearer"},
         )
+
+    # コスト係数(BCRYPT_ROUNDS)が変わっていれば、平文が手元にあるこのタイミングで再ハッシュする
+    if auth.password_needs_rehash(str(user.hashed_password)):
+        try:
+            user.set_hashed_password(await auth.get_password_hash_async(form_data.password))
+            await db.commit()
+        except Exception as e:
+            await db.rollback()
+            logger.warning(f"パスワードの再ハッシュに失敗しました (user_id={user.id}): {e}")
     
     access_token_expires = timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = auth.create_access_token(
-        data={"sub": user.username}, expires_delta=access_token_expires
+        data={"sub": user.username, "uid": user.id}, expires_delta=access_token_expires
     )
     
     log_user_action('login_success', user.id, f"ユーザー名: {user.username}", lang)  # type: ignore
@@ -494,27 +567,60 @@ async def logout_user(lang: str = 'ja'):
     return create_user_response('logout_success', lang)
 
 @app.get("/users/me", response_model=UserResponse)
-async def read_users_me(current_user: Annotated[User, Depends(auth.get_current_user)]):
+async def read_users_me(current_user: Annotated[auth.Principal, Depends(auth.get_current_user)]):
     return current_user
 
 @app.get("/users/me/slides", response_model=list[SlideResponse])
-async def get_my_slides(*, db: Session = Depends(get_db), current_user: Annotated[User, Depends(auth.get_current_user)]) -> List[SlideResponse]:
-    slides = db.query(Slide).filter(Slide.owner_id == current_user.id).all()
-    return [SlideResponse.model_validate(slide) for slide in slides]
+async def get_my_slides(*, db: AsyncSession = Depends(get_async_read_db), current_user: Annotated[auth.Principal, Depends(auth.get_current_user)]) -> List[SlideResponse]:
+    result = await db.execute(
+        select(Slide).options(selectinload(Slide.pages)).where(Slide.owner_id == current_user.id)
+    )
+    slides = result.scalars().all()
+    return [_slide_to_response(slide) for slide in slides]
+
+@app.get("/users/me/slides/summary", response_model=SlideSummaryPage)
+async def get_my_slides_summary(
+    *,
+    limit: int = 20,
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_read_db),
+    current_user: Annotated[auth.Principal, Depends(auth.get_current_user)]
+):
+    """
+    ダッシュボード向けのスライド一覧。メタデータ列のみを取得し slide_data は読み込まない。
+    新しい順(id 降順)のキーセットページネーション: 次ページは next_cursor を cursor に指定する。
+    """
+    limit = max(1, min(limit, 100))
+    query = select(
+        Slide.id, Slide.title, Slide.page_count, Slide.thumbnail_url, Slide.updated_at, Slide.version
+    ).where(Slide.owner_id == current_user.id)
+    if cursor:
+        try:
+            query = query.where(Slide.id < int(cursor))
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+    rows = (await db.execute(query.order_by(Slide.id.desc()).limit(limit + 1))).all()
+
+    next_cursor = str(rows[limit - 1].id) if len(rows) > limit else None
+    return SlideSummaryPage(
+        items=[SlideSummary.model_validate(row) for row in rows[:limit]],
+        next_cursor=next_cursor,
+    )
 
 @app.put("/users/me/password", status_code=status.HTTP_200_OK)
 async def update_password(
     user_update: UserUpdatePassword,
-    current_user: Annotated[User, Depends(auth.get_current_user)],
-    db: Session = Depends(get_db),
+    current_user: Annotated[User, Depends(auth.get_current_db_user)],
+    db: AsyncSession = Depends(get_async_db),
     lang: str = 'ja'
 ):
-    if not auth.verify_password(user_update.current_password, str(current_user.hashed_password)):
+    if not await auth.verify_password_async(user_update.current_password, str(current_user.hashed_password)):
         raise create_error_response('invalid_credentials', lang, status.HTTP_400_BAD_REQUEST)
     
-    current_user.set_hashed_password(auth.get_password_hash(user_update.new_password))
-    db.commit()
-    db.refresh(current_user)
+    current_user.set_hashed_password(await auth.get_password_hash_async(user_update.new_password))
+    await db.commit()
+    await db.refresh(current_user)
+    auth.invalidate_user_cache(current_user.id)  # type: ignore
     
     log_user_action('password_updated', current_user.id, lang=lang) # type: ignore
     return create_user_response('password_updated', lang)
@@ -522,16 +628,17 @@ async def update_password(
 @app.put("/users/me/username", status_code=status.HTTP_200_OK)
 async def update_username(
     user_update: UserUpdateUsername,
-    current_user: Annotated[User, Depends(auth.get_current_user)],
-    db: Session = Depends(get_db),
+    current_user: Annotated[User, Depends(auth.get_current_db_user)],
+    db: AsyncSession = Depends(get_async_db),
     lang: str = 'ja'
 ):
-    if db.query(User).filter_by(username=user_update.new_username).first():
+    if await auth.get_user(db, user_update.new_username):
         raise create_error_response('username_already_exists', lang, status.HTTP_400_BAD_REQUEST)
     
     current_user.set_username(user_update.new_username)
-    db.commit()
-    db.refresh(current_user)
+    await db.commit()
+    await db.refresh(current_user)
+    auth.invalidate_user_cache(current_user.id)  # type: ignore
 
     log_user_action('username_updated', current_user.id, f"New username: {user_update.new_username}", lang) # type: ignore
     return create_user_response('username_updated', lang)
@@ -551,114 +658,612 @@ ALLOWED_IMAGE_TYPES = ["image/jpeg", "image/png", "image/gif"]
 ALLOWED_FONT_TYPES = ["font/ttf", "font/otf", "font/woff", "font/woff2"]
 ALLOWED_VIDEO_TYPES = ["video/mp4", "video/webm", "video/ogg"]
 
-async def save_upload_file(upload_file: UploadFile, destination_folder: str, db_file_entry: UploadedFile, db: Session, file_type: str, lang: str = 'ja'):
+# アップロード実体はコンテンツアドレス型ストレージ(data/uploads/blobs)に重複なく保存する
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1 MB
+blob_store = BlobStore(os.path.join(UPLOAD_DIR, "blobs"))
+# 画像の縮小版(サムネイル等)のディスクキャッシュ
+VARIANT_CACHE_DIR = os.path.join(UPLOAD_DIR, "variants")
+
+# 先頭バイト(マジックナンバー)から判定する MIME タイプ
+SNIFF_BYTES = 16
+_HEIF_BRANDS = (b"heic", b"heix", b"hevc", b"hevx", b"mif1", b"msf1", b"avif")
+
+def _sniff_content_type(head: bytes) -> Optional[str]:
+    """ファイル先頭のバイト列から実際の MIME タイプを推定する。判定できなければ None"""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head.startswith((b"GIF87a", b"GIF89a")):
+        return "image/gif"
+    if head.startswith((b"\x00\x01\x00\x00", b"true")):
+        return "font/ttf"
+    if head.startswith(b"OTTO"):
+        return "font/otf"
+    if head.startswith(b"wOFF"):
+        return "font/woff"
+    if head.startswith(b"wOF2"):
+        return "font/woff2"
+    if head[4:8] == b"ftyp" and head[8:12] not in _HEIF_BRANDS:
+        return "video/mp4"
+    if head.startswith(b"\x1a\x45\xdf\xa3"):
+        return "video/webm"
+    if head.startswith(b"OggS"):
+        return "video/ogg"
+    return None
+
+def _allowed_types_for(file_type: str) -> List[str]:
+    return {
+        "image": ALLOWED_IMAGE_TYPES,
+        "font": ALLOWED_FONT_TYPES,
+        "video": ALLOWED_VIDEO_TYPES,
+    }.get(file_type, [])
+
+def _file_too_large_error(file_type: str, max_size: int, lang: str = 'ja') -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        detail=get_message('file_too_large', lang) + f" ({file_type}: {max_size // (1024*1024)}MB)"
+    )
+
+async def _iter_upload_file(upload_file: UploadFile):
+    while chunk := await upload_file.read(UPLOAD_CHUNK_SIZE):
+        yield chunk
+
+async def ingest_upload_stream(chunks, db_file_entry: UploadedFile, db: AsyncSession, file_type: str, content_type: Optional[str], lang: str = 'ja'):
+    """
+    チャンク列を 1 パスで保存する。
+    - 受信バイト数で MAX_FILE_SIZES を逐次チェック（超過時点で中断）
+    - 先頭バイトから MIME タイプを判定
+    - SHA-256 を計算しながら blob ストアの一時ファイルへ書き込み、最後に rename で配置
+    メモリ使用量は UPLOAD_CHUNK_SIZE 程度に収まる。
+    """
     max_size = MAX_FILE_SIZES.get(file_type)
     if not max_size:
         raise create_error_response('invalid_file_type', lang, status.HTTP_400_BAD_REQUEST)
-    
-    if upload_file.size is None or upload_file.size > max_size:
-        raise HTTPException(
-            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
-            detail=get_message('file_too_large', lang) + f" ({file_type}: {max_size // (1024*1024)}MB)"
-        )
-
-    content_type = upload_file.content_type
-    if file_type == "image" and content_type not in ALLOWED_IMAGE_TYPES:
-        raise create_error_response('invalid_file_type', lang, status.HTTP_400_BAD_REQUEST)
-    elif file_type == "font" and content_type not in ALLOWED_FONT_TYPES:
-        raise create_error_response('invalid_file_type', lang, status.HTTP_400_BAD_REQUEST)
-    elif file_type == "video" and content_type not in ALLOWED_VIDEO_TYPES:
+    allowed_types = _allowed_types_for(file_type)
+    if content_type not in allowed_types:
         raise create_error_response('invalid_file_type', lang, status.HTTP_400_BAD_REQUEST)
 
-    original_filename = secure_filename(upload_file.filename or "")
-    file_extension = os.path.splitext(original_filename)[1]
-    unique_filename = f"{uuid.uuid4()}{file_extension}"
-    file_location = os.path.join(destination_folder, unique_filename)
+    original_filename = secure_filename(str(db_file_entry.filename or ""))
+    writer = blob_store.new_writer()
+    digest: Optional[str] = None
+    received = 0
+    head = b""
+    sniffed_type: Optional[str] = None
+    buffer = bytearray()
 
-    # パス検証: 許可ディレクトリ配下のみ
-    uploads_root = os.path.abspath(UPLOAD_DIR)
-    abs_path = os.path.abspath(file_location)
-    if not abs_path.startswith(uploads_root):
-        logger.error(f"セキュリティエラー: 許可されていないパスへのファイル保存を試行: {abs_path}")
-        raise create_error_response('error_validation', lang, 400)
+    def check_head() -> None:
+        nonlocal sniffed_type
+        sniffed_type = _sniff_content_type(head)
+        if sniffed_type not in allowed_types:
+            raise create_error_response('invalid_file_type', lang, status.HTTP_400_BAD_REQUEST)
 
     try:
-        with open(file_location, "wb+") as file_object:
-            await run_in_threadpool(shutil.copyfileobj, upload_file.file, file_object)
-
-        # ファイルパスを設定 - SQLAlchemyモデルの更新
-        setattr(db_file_entry, 'file_path', file_location)
-        db.add(db_file_entry)
-        db.commit()
-        db.refresh(db_file_entry)
-        
+        async for chunk in chunks:
+            if not chunk:
+                continue
+            received += len(chunk)
+            if received > max_size:
+                raise _file_too_large_error(file_type, max_size, lang)
+            if sniffed_type is None:
+                head += chunk[:SNIFF_BYTES - len(head)]
+                if len(head) >= SNIFF_BYTES:
+                    check_head()
+            buffer += chunk
+            # 小さな ASGI チャンクをまとめてからスレッドプールで書き込む
+            if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                await run_in_threadpool(writer.write, bytes(buffer))
+                buffer.clear()
+        if sniffed_type is None:
+            check_head()
+        if buffer:
+            await run_in_threadpool(writer.write, bytes(buffer))
+            buffer.clear()
+
+        digest = await run_in_threadpool(writer.close)
+        # 配置から参照の登録までを同じダイジェストの削除と交差させない
+        async with blob_store.lock(digest):
+            # 同一内容が既に保存済みなら一時ファイルを捨てるだけ（追加の書き込みなし）
+            blob_path = await run_in_threadpool(blob_store.commit, writer)
+            await db.run_sync(acquire_blob, digest, writer.size, sniffed_type)
+            # ファイルパスを設定 - SQLAlchemyモデルの更新
+            setattr(db_file_entry, 'file_path', blob_path)
+            setattr(db_file_entry, 'blob_digest', digest)
+            db.add(db_file_entry)
+            await db.commit()
+        await db.refresh(db_file_entry)
+
         log_user_action('file_uploaded', db_file_entry.owner_id, f"ファイル名: {original_filename}", lang)  # type: ignore
         return db_file_entry
+    except HTTPException:
+        await run_in_threadpool(writer.discard)
+        raise
     except Exception as e:
-        logger.error(f"ファイル保存エラー ({upload_file.filename}): {e}", exc_info=True)
-        if os.path.exists(file_location):
-            try:
-                await run_in_threadpool(os.remove, file_location)
-            except Exception as remove_e:
-                logger.error(f"一時ファイルの削除に失敗: {file_location}: {remove_e}")
+        await db.rollback()
+        logger.error(f"ファイル保存エラー ({original_filename}): {e}", exc_info=True)
+        try:
+            await run_in_threadpool(writer.discard)
+            # 他から参照されていない新規 blob だけを削除する
+            if digest:
+                async with blob_store.lock(digest):
+                    if not await db.run_sync(blob_in_use, digest):
+                        await run_in_threadpool(blob_store.remove, digest)
+        except Exception as remove_e:
+            logger.error(f"一時ファイルの削除に失敗: {writer.temp_path}: {remove_e}")
         raise create_error_response('error_file_save', lang, status.HTTP_500_INTERNAL_SERVER_ERROR)
 
+async def save_upload_file(upload_file: UploadFile, db_file_entry: UploadedFile, db: AsyncSession, file_type: str, lang: str = 'ja'):
+    max_size = MAX_FILE_SIZES.get(file_type)
+    if not max_size:
+        raise create_error_response('invalid_file_type', lang, status.HTTP_400_BAD_REQUEST)
+    # サイズが申告されている場合は読み込み前に弾く（未申告でも受信中に上限をチェックする）
+    if upload_file.size is not None and upload_file.size > max_size:
+        raise _file_too_large_error(file_type, max_size, lang)
+    return await ingest_upload_stream(
+        _iter_upload_file(upload_file), db_file_entry, db, file_type, upload_file.content_type, lang
+    )
+
 @app.post("/upload/{file_type}", response_model=FileResponse)
 async def upload_file_unified(
     file_type: str,
     file: UploadFile = File(...),
     *,
-    db: Session = Depends(get_db),
-    current_user: Annotated[User, Depends(auth.get_current_user)]
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Annotated[auth.Principal, Depends(auth.get_current_user)]
 ):
     allowed_file_types = ["image", "font", "video"]
     if file_type not in allowed_file_types:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid file type: {file_type}")
 
-    # file_typeの値を正規化し、パストラバーサル防止
-    safe_file_type = os.path.basename(file_type)
-    destination_subfolder = f"{safe_file_type}s"
-    destination_folder = os.path.join(UPLOAD_DIR, destination_subfolder)
-    # パス検証: 許可ディレクトリ配下のみ
-    uploads_root = os.path.abspath(UPLOAD_DIR)
-    abs_dest_folder = os.path.abspath(destination_folder)
-    if not abs_dest_folder.startswith(uploads_root):
-        logger.error(f"Attempted to create/access folder outside uploads dir: {abs_dest_folder}")
-        raise HTTPException(status_code=400, detail="Invalid destination folder path.")
-    os.makedirs(destination_folder, exist_ok=True)
-
     db_file = UploadedFile(
         filename=file.filename, # ここは元のファイル名
         file_path="", # 仮の値。save_upload_fileで設定される
         file_type=file_type,
         owner_id=current_user.id
     )
-    return await save_upload_file(file, destination_folder, db_file, db, file_type)
+    return await save_upload_file(file, db_file, db, file_type)
+
+@app.put("/upload/{file_type}/stream", response_model=FileResponse)
+async def upload_file_stream(
+    file_type: str,
+    filename: str,
+    request: Request,
+    *,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Annotated[auth.Principal, Depends(auth.get_current_user)],
+    lang: str = 'ja'
+):
+    """
+    リクエストボディ(生バイナリ)を直接ストリーミングで保存するアップロード。
+    multipart のように一時ファイルへスプールしないため、大きな動画でも書き込みは 1 回で済む。
+    - クエリ: filename (元のファイル名)
+    - ヘッダー: Content-Type (ファイルの MIME タイプ)
+    """
+    allowed_file_types = ["image", "font", "video"]
+    if file_type not in allowed_file_types:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid file type: {file_type}")
+
+    max_size = MAX_FILE_SIZES[file_type]
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_size:
+        raise _file_too_large_error(file_type, max_size, lang)
+
+    content_type = (request.headers.get("content-type") or "").split(";")[0].strip().lower()
+    db_file = UploadedFile(
+        filename=filename,
+        file_path="", # 仮の値。ingest_upload_streamで設定される
+        file_type=file_type,
+        owner_id=current_user.id
+    )
+    return await ingest_upload_stream(request.stream(), db_file, db, file_type, content_type, lang)
+
+# --- Resumable Upload Endpoints ---
+# init -> append(PATCH, Upload-Offset ヘッダー) -> complete の 3 段階。
+# 途中で切断されても GET で現在のオフセットを取得し、続きから再送できる。
+UPLOAD_SESSION_TTL = timedelta(hours=24)
+# upload_id -> (ハッシュ済みバイト数, sha256)。同一プロセスで先頭から順に受信した場合のみ有効
+_upload_hashers: dict[str, tuple[int, Any]] = {}
+# 追記中の upload_id。同じセッションへの同時 PATCH が一時ファイルの同じ範囲に書き込まないようにする
+_upload_appending: set[str] = set()
+
+def _upload_session_response(session: UploadSession) -> UploadSessionResponse:
+    return UploadSessionResponse(
+        upload_id=session.id,  # type: ignore
+        file_type=session.file_type,  # type: ignore
+        filename=session.filename,  # type: ignore
+        size=session.total_size,  # type: ignore
+        offset=session.offset,  # type: ignore
+    )
+
+async def _get_upload_session(db: AsyncSession, upload_id: str, user: auth.Principal) -> UploadSession:
+    result = await db.execute(
+        select(UploadSession).where(UploadSession.id == upload_id, UploadSession.owner_id == user.id)
+    )
+    session = result.scalars().first()
+    if not session:
+        raise HTTPException(status_code=404, detail="Upload session not found or not authorized")
+    return session
+
+def _remove_file_quietly(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+async def _purge_expired_upload_sessions(db: AsyncSession) -> None:
+    """期限切れのアップロードセッションと一時ファイルを削除する"""
+    cutoff = datetime.now(timezone.utc) - UPLOAD_SESSION_TTL
+    result = await db.execute(select(UploadSession).where(UploadSession.created_at < cutoff))
+    expired = result.scalars().all()
+    for session in expired:
+        await run_in_threadpool(_remove_file_quietly, str(session.temp_path))
+        _upload_hashers.pop(str(session.id), None)
+        await db.delete(session)
+    if expired:
+        await db.commit()
+
+@app.post("/upload/{file_type}/sessions", response_model=UploadSessionResponse, status_code=status.HTTP_201_CREATED)
+async def create_upload_session(
+    file_type: str,
+    payload: UploadSessionCreate,
+    *,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Annotated[auth.Principal, Depends(auth.get_current_user)],
+    lang: str = 'ja'
+):
+    max_size = MAX_FILE_SIZES.get(file_type)
+    if not max_size:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Invalid file type: {file_type}")
+    if payload.size <= 0:
+        raise create_error_response('error_validation', lang, status.HTTP_400_BAD_REQUEST)
+    if payload.size > max_size:
+        raise _file_too_large_error(file_type, max_size, lang)
+    if payload.content_type not in _allowed_types_for(file_type):
+        raise create_error_response('invalid_file_type', lang, status.HTTP_400_BAD_REQUEST)
+
+    await _purge_expired_upload_sessions(db)
+
+    temp_path = await run_in_threadpool(blob_store.new_temp_path)
+    session = UploadSession(
+        id=uuid.uuid4().hex,
+        owner_id=current_user.id,
+        file_type=file_type,
+        filename=payload.filename,
+        content_type=payload.content_type,
+        total_size=payload.size,
+        offset=0,
+        temp_path=temp_path,
+    )
+    db.add(session)
+    await db.commit()
+    _upload_hashers[str(session.id)] = (0, hashlib.sha256())
+    return _upload_session_response(session)
+
+@app.get("/upload/sessions/{upload_id}", response_model=UploadSessionResponse)
+async def get_upload_session(upload_id: str, *, db: AsyncSession = Depends(get_async_db), current_user: Annotated[auth.Principal, Depends(auth.get_current_user)]):
+    return _upload_session_response(await _get_upload_session(db, upload_id, current_user))
+
+@app.patch("/upload/sessions/{upload_id}", response_model=UploadSessionResponse)
+async def append_upload_session(
+    upload_id: str,
+    request: Request,
+    *,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Annotated[auth.Principal, Depends(auth.get_current_user)],
+    lang: str = 'ja'
+):
+    """
+    Upload-Offset ヘッダーで示した位置からリクエストボディを追記する。
+    オフセットがサーバー側と一致しない場合は 409（GET で現在位置を取得して再送する）。
+    切断された場合も受信済みの分までは進捗として保存する。
+    """
+    session = await _get_upload_session(db, upload_id, current_user)
+    offset_header = request.headers.get("upload-offset", "")
+    if not offset_header.isdigit() or int(offset_header) != session.offset:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload-Offset mismatch (current offset: {session.offset})",
+        )
+    # ファイルへ書き込む前にセッションを確保する（同時追記はオフセットの確認だけでは防げない）
+    if upload_id in _upload_appending:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Another append is in progress (current offset: {session.offset})",
+        )
+    _upload_appending.add(upload_id)
+    try:
+        # 確保するまでの間に別の追記が完了していれば、その範囲を上書きしないよう読み直して確認する
+        await db.refresh(session)
+        if int(offset_header) != session.offset:
+            raise HTTPException(
+                status_code=status.HTTP_409_CONFLICT,
+                detail=f"Upload-Offset mismatch (current offset: {session.offset})",
+            )
+        return await _append_to_upload_session(session, upload_id, int(offset_header), request, db, lang)
+    finally:
+        _upload_appending.discard(upload_id)
+
+async def _append_to_upload_session(session: UploadSession, upload_id: str, start: int, request: Request, db: AsyncSession, lang: str) -> UploadSessionResponse:
+    total_size = int(session.total_size)  # type: ignore
+    allowed_types = _allowed_types_for(str(session.file_type))
+
+    # 共有のハッシュ状態は直接更新せず、コピーを進めてオフセットの更新に成功してから置き換える
+    hasher_entry = _upload_hashers.get(upload_id)
+    hasher = hasher_entry[1].copy() if hasher_entry and hasher_entry[0] == start else None
+    written = start
+    buffer = bytearray()
+    head_checked = start > 0
+
+    file_object = await run_in_threadpool(open, str(session.temp_path), "r+b")
+
+    def write_at(position: int, data: bytes) -> None:
+        file_object.seek(position)
+        file_object.write(data)
+        if hasher is not None:
+            hasher.update(data)
+
+    async def flush_buffer() -> None:
+        nonlocal written
+        if buffer:
+            data = bytes(buffer)
+            buffer.clear()
+            await run_in_threadpool(write_at, written, data)
+            written += len(data)
+
+    try:
+        async for chunk in request.stream():
+            if not chunk:
+                continue
+            if written + len(buffer) + len(chunk) > total_size:
+                raise HTTPException(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    detail="Chunk exceeds declared upload size",
+                )
+            buffer += chunk
+            # 先頭チャンクで中身の形式を確認し、不正なファイルの転送を早期に打ち切る
+            if not head_checked and len(buffer) >= SNIFF_BYTES:
+                head_checked = True
+                if _sniff_content_type(bytes(buffer[:SNIFF_BYTES])) not in allowed_types:
+                    raise create_error_response('invalid_file_type', lang, status.HTTP_400_BAD_REQUEST)
+            if len(buffer) >= UPLOAD_CHUNK_SIZE:
+                await flush_buffer()
+        await flush_buffer()
+    except ClientDisconnect:
+        # 受信できた分までを保存して次回の再開位置とする
+        await flush_buffer()
+        logger.info(f"Upload session {upload_id} interrupted at offset {written}")
+    except Exception:
+        # 一時ファイルの内容とハッシュ状態が一致する保証がないため破棄する（完了時に再計算）
+        _upload_hashers.pop(upload_id, None)
+        raise
+    finally:
+        await run_in_threadpool(file_object.close)
+
+    # オフセットが変わっていない場合のみ進める（同時追記の取りこぼし防止）
+    try:
+        result = await db.execute(
+            update(UploadSession)
+            .where(UploadSession.id == upload_id, UploadSession.offset == start)
+            .values(offset=written)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
+    except Exception:
+        _upload_hashers.pop(upload_id, None)
+        raise
+    if not result.rowcount:
+        _upload_hashers.pop(upload_id, None)
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Upload session was modified concurrently")
+    if hasher is not None:
+        _upload_hashers[upload_id] = (written, hasher)
+    else:
+        _upload_hashers.pop(upload_id, None)
+    await db.refresh(session)
+    return _upload_session_response(session)
+
+@app.post("/upload/sessions/{upload_id}/complete", response_model=FileResponse)
+async def complete_upload_session(
+    upload_id: str,
+    *,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: Annotated[auth.Principal, Depends(auth.get_current_user)],
+    lang: str = 'ja'
+):
+    """
+    全チャンク受信後に呼び出す。一時ファイルをそのまま blob ストアへ rename するため、
+    組み立てのための 2 回目のコピーは発生しない。
+    """
+    session = await _get_upload_session(db, upload_id, current_user)
+    if session.offset != session.total_size:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail=f"Upload incomplete (offset: {session.offset}, size: {session.total_size})",
+        )
+    temp_path = str(session.temp_path)
+
+    def read_head() -> bytes:
+        with open(temp_path, "rb") as f:
+            return f.read(SNIFF_BYTES)
+
+    sniffed_type = _sniff_content_type(await run_in_threadpool(read_head))
+    if sniffed_type not in _allowed_types_for(str(session.file_type)):
+        raise create_error_response('invalid_file_type', lang, status.HTTP_400_BAD_REQUEST)
+
+    hasher_entry = _upload_hashers.pop(upload_id, None)
+    if hasher_entry and hasher_entry[0] == session.total_size:
+        digest = hasher_entry[1].hexdigest()
+    else:
+        # 再起動や別ワーカーでの受信でハッシュ状態がない場合は読み直して計算する
+        digest = await run_in_threadpool(hash_file, temp_path)
+
+    try:
+        async with blob_store.lock(digest):
+            blob_path = await run_in_threadpool(blob_store.commit_path, temp_path, digest)
+            await db.run_sync(acquire_blob, digest, int(session.total_size), sniffed_type)  # type: ignore
+            db_file = UploadedFile(
+                filename=session.filename,
+                file_path=blob_path,
+                file_type=session.file_type,
+                blob_digest=digest,
+                owner_id=current_user.id,
+            )
+            db.add(db_file)
+            await db.delete(session)
+            await db.commit()
+        await db.refresh(db_file)
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"Resumable upload completion failed ({upload_id}): {e}", exc_info=True)
+        async with blob_store.lock(digest):
+            if not await db.run_sync(blob_in_use, digest):
+                await run_in_threadpool(blob_store.remove, digest)
+        raise create_error_response('error_file_save', lang, status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    log_user_action('file_uploaded', current_user.id, f"ファイル名: {session.filename}", lang)  # type: ignore
+    return db_file
+
+@app.delete("/upload/sessions/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def abort_upload_session(upload_id: str, *, db: AsyncSession = Depends(get_async_db), current_user: Annotated[auth.Principal, Depends(auth.get_current_user)]):
+    session = await _get_upload_session(db, upload_id, current_user)
+    await run_in_threadpool(_remove_file_quietly, str(session.temp_path))
+    _upload_hashers.pop(upload_id, None)
+    await db.delete(session)
+    await db.commit()
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
 
 # --- File Read/Delete Endpoints ---
+# blob は内容が変わらない(ダイジェストがキー)ため、長期キャッシュを許可する
+IMMUTABLE_CACHE_CONTROL = "private, max-age=31536000, immutable"
+LEGACY_FILE_CACHE_CONTROL = "private, no-cache"
+
+def _etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match の弱い比較 (RFC 9110 13.1.2)"""
+    if if_none_match.strip() == "*":
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(candidate.strip().removeprefix("W/") == opaque for candidate in if_none_match.split(","))
+
+def _not_modified_since(if_modified_since: str, mtime: float) -> bool:
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    return int(mtime) <= since.timestamp()
+
+def _conditional_file_response(request: Request, path: str, stat_result: os.stat_result, *, etag: str, cache_control: str, filename: str, media_type: Optional[str], extra_headers: Optional[Dict[str, str]] = None):
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Cache-Control": cache_control,
+        **(extra_headers or {}),
+    }
+
+    # If-None-Match があれば If-Modified-Since より優先する (RFC 9110 13.2.2)
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        not_modified = _etag_matches(if_none_match, etag)
+    else:
+        if_modified_since = request.headers.get("if-modified-since")
+        not_modified = bool(if_modified_since) and _not_modified_since(if_modified_since, stat_result.st_mtime)  # type: ignore
+    if not_modified:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+
+    # Range / If-Range の処理は FileResponse に任せる（ETag は上で設定したものが使われる）
+    return FastAPIFileResponse(
+        path=path,
+        filename=filename,
+        media_type=media_type,
+        headers=headers,
+        stat_result=stat_result,
+    )
+
 @app.get("/files/{file_id}")
-async def read_file(file_id: int, *, db: Session = Depends(get_db), current_user: Annotated[User, Depends(auth.get_current_user)]):
-    db_file = db.query(UploadedFile).filter(UploadedFile.id == file_id, UploadedFile.owner_id == current_user.id).first()
-    if not db_file:
+async def read_file(
+    file_id: int,
+    request: Request,
+    w: Optional[int] = None,
+    fmt: Optional[str] = Query(None, alias="format"),
+    *,
+    db: AsyncSession = Depends(get_async_read_db),
+    current_user: Annotated[auth.Principal, Depends(auth.get_current_user)]
+):
+    """
+    アップロード済みファイルを返す。
+    - ETag(blob は SHA-256) / Last-Modified による条件付き GET (304)
+    - Range / 複数 Range (206, multipart/byteranges) による部分取得（動画のシーク用）
+    - 画像は ?w=320 (&format=webp|avif) で縮小版を返す（初回要求時に生成してキャッシュ）
+    """
+    result = await db.execute(
+        select(UploadedFile, Blob.content_type)
+        .outerjoin(Blob, Blob.digest == UploadedFile.blob_digest)
+        .where(UploadedFile.id == file_id, UploadedFile.owner_id == current_user.id)
+    )
+    row = result.first()
+    if not row:
         raise HTTPException(status_code=404, detail="File not found or not authorized")
+    db_file, content_type = row
     # パス検証: 許可ディレクトリ配下のみ
     uploads_root = os.path.abspath(UPLOAD_DIR)
     abs_path = os.path.abspath(str(db_file.file_path))
     if not abs_path.startswith(uploads_root):
         logger.error(f"Attempted to access file outside uploads dir: {abs_path}")
         raise HTTPException(status_code=400, detail="Invalid file path.")
-    if not os.path.exists(str(db_file.file_path)):
+    try:
+        stat_result = await run_in_threadpool(os.stat, abs_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="File not found on server")
-    return FastAPIFileResponse(path=str(db_file.file_path), filename=str(db_file.filename))
+
+    digest = db_file.blob_digest
+    if w is not None and digest and content_type in ALLOWED_IMAGE_TYPES:
+        variant_format = imaging.negotiate_format(fmt, request.headers.get("accept", ""))
+        if variant_format is None:
+            raise HTTPException(status_code=400, detail=f"Unsupported image format: {fmt}")
+        width = imaging.snap_width(max(1, w))
+        try:
+            variant_path = await imaging.get_variant(VARIANT_CACHE_DIR, str(digest), abs_path, width, variant_format)
+            variant_stat = await run_in_threadpool(os.stat, variant_path)
+        except Exception as e:
+            logger.error(f"Image variant generation failed (file {file_id}, w={width}): {e}", exc_info=True)
+            raise HTTPException(status_code=500, detail="Failed to generate image variant")
+        base_name = os.path.splitext(str(db_file.filename))[0]
+        return _conditional_file_response(
+            request, variant_path, variant_stat,
+            etag=f'"{digest}-w{width}.{variant_format}"',
+            cache_control=IMMUTABLE_CACHE_CONTROL,
+            filename=f"{base_name}.{variant_format}",
+            media_type=imaging.VARIANT_FORMATS[variant_format][1],
+            # format 未指定時は Accept によって返す形式が変わる
+            extra_headers=None if fmt else {"Vary": "Accept"},
+        )
+
+    if digest:
+        etag = f'"{digest}"'
+        cache_control = IMMUTABLE_CACHE_CONTROL
+    else:
+        etag = f'"{stat_result.st_mtime_ns:x}-{stat_result.st_size:x}"'
+        cache_control = LEGACY_FILE_CACHE_CONTROL
+    return _conditional_file_response(
+        request, abs_path, stat_result,
+        etag=etag,
+        cache_control=cache_control,
+        filename=str(db_file.filename),
+        media_type=content_type,
+    )
 
 @app.delete("/files/{file_id}", response_model=FileResponse)
-async def delete_file_endpoint(file_id: int, *, db: Session = Depends(get_db), current_user: Annotated[User, Depends(auth.get_current_user)]):
-    db_file = db.query(UploadedFile).filter(UploadedFile.id == file_id, UploadedFile.owner_id == current_user.id).first()
+async def delete_file_endpoint(file_id: int, *, db: AsyncSession = Depends(get_async_db), current_user: Annotated[auth.Principal, Depends(auth.get_current_user)]):
+    result = await db.execute(
+        select(UploadedFile).where(UploadedFile.id == file_id, UploadedFile.owner_id == current_user.id)
+    )
+    db_file = result.scalars().first()
     if not db_file:
         raise HTTPException(status_code=404, detail="File not found or not authorized")
 
     deleted_file_response = FileResponse.model_validate(db_file)
     file_path_to_delete = db_file.file_path
+    blob_digest = db_file.blob_digest
 
     # パス検証: 許可ディレクトリ配下のみ削除
     uploads_root = os.path.abspath(UPLOAD_DIR)
@@ -668,41 +1273,156 @@ async def delete_file_endpoint(file_id: int, *, db: Session = Depends(get_db), c
         raise HTTPException(status_code=400, detail="Invalid file path.")
 
     try:
-        db.delete(db_file)
-        db.commit()
-        if os.path.exists(str(file_path_to_delete)):
-            await run_in_threadpool(os.remove, str(file_path_to_delete))
+        await db.delete(db_file)
+        if blob_digest:
+            await db.flush()
+            # 最後の参照が消えた場合のみ実体を削除する
+            last_reference = await db.run_sync(release_blob, str(blob_digest))
+            await db.commit()
+            if last_reference:
+                # 同じ内容のアップロードが参照を登録し直していれば実体は残す
+                async with blob_store.lock(str(blob_digest)):
+                    if not await db.run_sync(blob_in_use, str(blob_digest)):
+                        await run_in_threadpool(blob_store.remove, str(blob_digest))
+                        await run_in_threadpool(imaging.remove_variants, VARIANT_CACHE_DIR, str(blob_digest))
+        else:
+            # 旧形式(uuid ファイル名)のアップロード
+            await db.commit()
+            if os.path.exists(str(file_path_to_delete)):
+                await run_in_threadpool(os.remove, str(file_path_to_delete))
         return deleted_file_response
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         logger.error(f"Error deleting file id {file_id}: {e}", exc_info=True)
         raise HTTPException(status_code=500, detail="Error deleting file.")
 
 # --- Slide Endpoints ---
-@app.post("/slides", response_model=SlideResponse)
-async def create_slide_endpoint(slide: SlideCreate, *, db: Session = Depends(get_db), current_user: Annotated[User, Depends(auth.get_current_user)]):
-    db_slide = Slide(**slide.model_dump(), owner_id=current_user.id)
-    db.add(db_slide)
-    db.commit()
-    db.refresh(db_slide)
-    return db_slide
+def _slide_to_response(slide: Slide) -> SlideResponse:
+    """ページ分割保存されたスライドも含め、slide_data 全体を組み立ててレスポンス化する"""
+    return SlideResponse(
+        id=slide.id,  # type: ignore
+        slide_data=slidestore.dump_slide_data(slide),
+        version=slide.version,  # type: ignore
+        owner_id=slide.owner_id,  # type: ignore
+    )
 
-@app.get("/slides/{slide_id}", response_model=SlideResponse)
-async def get_slide_endpoint(slide_id: int, *, db: Session = Depends(get_db), current_user: Annotated[User, Depends(auth.get_current_user)]):
-    db_slide = db.query(Slide).filter(Slide.id == slide_id, Slide.owner_id == current_user.id).first()
+async def _get_owned_slide(db: AsyncSession, slide_id: int, user: auth.Principal, *, with_pages: bool = False) -> Slide:
+    """
+    ユーザーが所有するスライドを取得する。見つからなければ 404。
+    with_pages=True ではページも一括で読み込む（非同期セッションでは遅延読み込みできないため）。
+    """
+    query = select(Slide).where(Slide.id == slide_id, Slide.owner_id == user.id)
+    if with_pages:
+        query = query.options(selectinload(Slide.pages))
+    db_slide = (await db.execute(query)).scalars().first()
     if not db_slide:
         raise HTTPException(status_code=404, detail="Slide not found or not authorized")
     return db_slide
 
+@app.post("/slides", response_model=SlideResponse)
+async def create_slide_endpoint(slide: SlideCreate, *, db: AsyncSession = Depends(get_async_db), current_user: Annotated[auth.Principal, Depends(auth.get_current_user)]):
+    # pages を空で初期化しておく（ページのない資料でもレスポンス生成時に遅延読み込みが走らないように）
+    db_slide = Slide(owner_id=current_user.id, pages=[])
+    slidestore.save_slide_data(db_slide, slide.slide_data)
+    db.add(db_slide)
+    await db.commit()
+    return _slide_to_response(db_slide)
+
+@app.get("/slides/{slide_id}", response_model=SlideResponse)
+async def get_slide_endpoint(slide_id: int, *, db: AsyncSession = Depends(get_async_read_db), current_user: Annotated[auth.Principal, Depends(auth.get_current_user)]):
+    db_slide = await _get_owned_slide(db, slide_id, current_user, with_pages=True)
+    return _slide_to_response(db_slide)
+
+@app.get("/slides/{slide_id}/outline", response_model=SlideOutlineResponse)
+async def get_slide_outline_endpoint(slide_id: int, *, db: AsyncSession = Depends(get_async_read_db), current_user: Annotated[auth.Principal, Depends(auth.get_current_user)]):
+    """
+    スライドのアウトライン(設定とページ一覧)のみを返す。ページ本文は含まない。
+    API クライアントはこれで全体の構成を取得し、ページ本文は /slides/{slide_id}/pages から必要な分だけ取得する。
+    (現在のエディタ(static/slide)はプレゼンテーションを localStorage に保持しており、このエンドポイントは使わない)
+    """
+    db_slide = await _get_owned_slide(db, slide_id, current_user)
+    outline, pages = await db.run_sync(slidestore.get_outline, db_slide)
+    return SlideOutlineResponse(
+        id=db_slide.id,  # type: ignore
+        version=db_slide.version,  # type: ignore
+        owner_id=db_slide.owner_id,  # type: ignore
+        outline=outline,
+        page_count=len(pages),
+        pages=[SlidePageSummary(**page) for page in pages],
+    )
+
+@app.get("/slides/{slide_id}/pages")
+async def get_slide_pages_endpoint(slide_id: int, start: int = 0, limit: int = 20, *, db: AsyncSession = Depends(get_async_read_db), current_user: Annotated[auth.Principal, Depends(auth.get_current_user)]):
+    """
+    ページ範囲を NDJSON (1行1ページ: {"index": n, "page": {...}}) でストリーミング返却する。
+    """
+    db_slide = await _get_owned_slide(db, slide_id, current_user)
+    start = max(0, start)
+    limit = max(1, min(limit, 100))
+    pages = await db.run_sync(slidestore.get_pages, db_slide, start, limit)
+
+    def iter_pages():
+        # 保存済みの JSON 文字列を再シリアライズせずにそのまま流す
+        for index, page_data in pages:
+            yield f'{{"index":{index},"page":{page_data}}}\n'
+
+    return StreamingResponse(iter_pages(), media_type="application/x-ndjson")
+
+@app.get("/slides/{slide_id}/pages/{page_index}")
+async def get_slide_page_endpoint(slide_id: int, page_index: int, *, db: AsyncSession = Depends(get_async_read_db), current_user: Annotated[auth.Principal, Depends(auth.get_current_user)]):
+    db_slide = await _get_owned_slide(db, slide_id, current_user)
+    pages = await db.run_sync(slidestore.get_pages, db_slide, page_index, 1) if page_index >= 0 else []
+    if not pages:
+        raise HTTPException(status_code=404, detail="Page not found")
+    return Response(content=pages[0][1], media_type="application/json")
+
+@app.patch("/slides/{slide_id}", response_model=SlideResponse)
+async def patch_slide_endpoint(slide_id: int, slide_patch: SlidePatch, *, db: AsyncSession = Depends(get_async_db), current_user: Annotated[auth.Principal, Depends(auth.get_current_user)], lang: str = 'ja'):
+    """
+    スライドに差分を適用して保存する。
+    - patch_type="json-patch": RFC 6902 の操作配列
+    - patch_type="merge-patch": RFC 7396 のマージパッチ
+    version が最新でない場合は 409 を返す（クライアントは再取得してやり直す）。
+    """
+    db_slide = await _get_owned_slide(db, slide_id, current_user, with_pages=True)
+    if db_slide.version != slide_patch.version:
+        raise create_error_response('slide_version_conflict', lang, status.HTTP_409_CONFLICT)
+
+    try:
+        document = slidestore.load_document(db_slide)
+        if slide_patch.patch_type == "merge-patch":
+            document = apply_merge_patch(document, slide_patch.patch)
+        else:
+            document = apply_json_patch(document, slide_patch.patch)
+    except (ValueError, PatchError) as e:
+        logger.warning(f"Slide patch rejected (slide {slide_id}): {e}")
+        raise create_error_response('invalid_patch', lang, 422)
+
+    # バージョン一致を条件に先に版を進め、同時更新の取りこぼしを防ぐ
+    result = await db.execute(
+        update(Slide)
+        .where(Slide.id == slide_id, Slide.version == slide_patch.version)
+        .values(version=slide_patch.version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    if not result.rowcount:
+        await db.rollback()
+        raise create_error_response('slide_version_conflict', lang, status.HTTP_409_CONFLICT)
+    # 変更のあったページだけが書き込まれる
+    slidestore.save_document(db_slide, document)
+    await db.commit()
+    await db.refresh(db_slide, attribute_names=["version"])
+
+    log_user_action('slide_updated', current_user.id, f"スライドID: {slide_id}, version: {db_slide.version}", lang)  # type: ignore
+    return _slide_to_response(db_slide)
+
 @app.delete("/slides/{slide_id}", response_model=SlideResponse)
-async def delete_slide_endpoint(slide_id: int, *, db: Session = Depends(get_db), current_user: Annotated[User, Depends(auth.get_current_user)]):
-    db_slide = db.query(Slide).filter(Slide.id == slide_id, Slide.owner_id == current_user.id).first()
-    if not db_slide:
-        raise HTTPException(status_code=404, detail="Slide not found or not authorized")
+async def delete_slide_endpoint(slide_id: int, *, db: AsyncSession = Depends(get_async_db), current_user: Annotated[auth.Principal, Depends(auth.get_current_user)]):
+    db_slide = await _get_owned_slide(db, slide_id, current_user, with_pages=True)
 
-    deleted_slide_details = SlideResponse.model_validate(db_slide)
-    db.delete(db_slide)
-    db.commit()
+    deleted_slide_details = _slide_to_response(db_slide)
+    await db.delete(db_slide)
+    await db.commit()
     return deleted_slide_details
 
 
@@ -717,83 +1437,49 @@ PIXABAY_API_KEY = os.getenv("PIXABAY_API_KEY")
 if not PIXABAY_API_KEY or PIXABAY_API_KEY == "PixabayApiKey":
     logger.warning("PIXABAY_API_KEY not found. Pixabay endpoint will return 503.")
 
-def _normalize_image_to_png_bytes(img_obj: Any) -> bytes:
-    """
-    入力の画像オブジェクトを完全にメモリ上の PNG バイト列に正規化する。
-    - UploadFile / file-like / bytes / PIL.Image いずれにも対応
-    """
-    # bytes または bytearray の場合は一旦 PIL で開いて PNG に正規化
-    if isinstance(img_obj, (bytes, bytearray)):
-        bio = io.BytesIO(img_obj)
-        with Image.open(bio) as im:
-            im.load()
-            im2 = im.copy()
-        out = io.BytesIO()
-        im2.save(out, format="PNG")
-        return out.getvalue()
-
-    # PIL.Image の場合
-    if isinstance(img_obj, Image.Image):
-        # ソースから切り離す
-        img_obj.load()
-        im2 = img_obj.copy()
-        out = io.BytesIO()
-        im2.save(out, format="PNG")
-        return out.getvalue()
-
-    # UploadFile / file-like 対応（.file を優先）
-    fobj = getattr(img_obj, "file", None)
-    if fobj is None and hasattr(img_obj, "read"):
-        fobj = img_obj
-    if fobj is None:
-        raise TypeError("Unsupported image input type for normalization")
-
-    # 既にクローズ済み（tempfile）を回避して UploadFile から読み直す
-    # Starlette UploadFile には .file の他に .read() がある
-    try:
-        # まずは安全に bytes を得る
-        if hasattr(img_obj, "read"):
-            # UploadFile など: ポインタ位置を考慮して先頭に戻して読む
-            try:
-                if hasattr(img_obj, "seek"):
-                    img_obj.seek(0)
-            except Exception:
-                pass
-            data = img_obj.read()
-        else:
-            # file-like の場合
-            try:
-                if hasattr(fobj, "seek"):
-                    fobj.seek(0)
-            except Exception:
-                pass
-            data = fobj.read()
-    finally:
-        # img_obj が UploadFile の場合は呼び元がクローズするのでここでは閉じない
-        # 一時ファイルなど明示クローズが必要な場合のみクローズを試みる
-        try:
-            if fobj is not None and fobj is not getattr(img_obj, "file", None):
-                fobj.close()
-        except Exception:
-            pass
+AI_MODEL_NAME = "gemini-2.5-flash"
+# /ai/ask の応答キャッシュ（メモリ LRU + ディスク）。同じテンプレートプロンプトの再生成を避ける
+ai_response_cache = AIResponseCache(
+    SessionLocal,
+    max_entries=int(os.getenv("AI_CACHE_MAX_ENTRIES", "256")),
+    max_bytes=int(os.getenv("AI_CACHE_MAX_BYTES", str(32 * 1024 * 1024))),
+    disk_max_entries=int(os.getenv("AI_CACHE_DISK_MAX_ENTRIES", "5000")),
+    ttl=float(os.getenv("AI_CACHE_TTL", str(7 * 24 * 3600))),
+    search_ttl=float(os.getenv("AI_CACHE_SEARCH_TTL", "3600")),
+)
 
-    bio = io.BytesIO(data)
-    with Image.open(bio) as im:
-        im.load()
-        im2 = im.copy()
-    out = io.BytesIO()
-    im2.save(out, format="PNG")
-    return out.getvalue()
+# /ai/ask の同時実行数・キュー・レートの制御（キャッシュヒットは対象外）
+ai_scheduler = AIScheduler(
+    max_concurrency=int(os.getenv("AI_MAX_CONCURRENCY", "8")),
+    max_queue_per_user=int(os.getenv("AI_MAX_QUEUE_PER_USER", "4")),
+    max_queue=int(os.getenv("AI_MAX_QUEUE", "64")),
+    queue_timeout=float(os.getenv("AI_QUEUE_TIMEOUT", "30")),
+    rate_per_minute=float(os.getenv("AI_RATE_PER_MINUTE", "20")),
+    burst=float(os.getenv("AI_RATE_BURST", "10")),
+)
 
+def _ai_client_key(request: Request, user: Optional[auth.Principal]) -> str:
+    """公平キューイング・レート制限の単位。未ログイン時はクライアント IP"""
+    if user is not None:
+        return f"user:{user.id}"
+    return f"ip:{request.client.host if request.client else 'unknown'}"
 
-def reqAI(prompt: str, model_name: str = "gemini-2.5-flash", is_search: bool = False, images: Optional[List[Any]] = None):
+def _get_gemini_client() -> genai.Client:
+    """アプリ共有の Gemini クライアントを返す（lifespan 外で呼ばれた場合は遅延生成）"""
+    global gemini_client
+    if gemini_client is None:
+        gemini_client = genai.Client(api_key=GEMINI_API_KEY)
+    return gemini_client
+
+async def reqAI(prompt: str, model_name: str = AI_MODEL_NAME, is_search: bool = False, images: Optional[List[tuple[str, bytes]]] = None, cache_key: Optional[str] = None):
     """
-    AIモデルにリクエストを送信し、ストリーミングで応答を返すジェネレータ。
-    重要: 画像は事前に PNG bytes に正規化し inline_data で渡すことで
-        'I/O operation on closed file' を回避する。
+    AIモデルにリクエストを送信し、ストリーミングで応答を返す非同期ジェネレータ。
+    共有クライアントの非同期 API を使うため、スレッドプールを占有せず接続も再利用される。
+    images は imaging.prepare_images_for_model で変換済みの (MIME タイプ, バイト列) のリスト。
+    cache_key を指定すると、最後までエラーなく返せた応答のみキャッシュに保存する。
     """
     try:
-        client = genai.Client(api_key=GEMINI_API_KEY)
+        client = _get_gemini_client()
 
         # contents を構築
         content_parts: list[Any] = []
@@ -801,14 +1487,13 @@ def reqAI(prompt: str, model_name: str = "gemini-2.5-flash", is_search: bool = F
             content_parts.append(prompt)
 
         if images:
-            for img_obj in images:
-                png_bytes = _normalize_image_to_png_bytes(img_obj)
+            for mime_type, image_bytes in images:
                 # google-genai SDK の inline_data で渡す
                 content_parts.append(
                     {
                         "inline_data": {
-                            "mime_type": "image/png",
-                            "data": png_bytes,
+                            "mime_type": mime_type,
+                            "data": image_bytes,
                         }
                     }
                 )
@@ -817,16 +1502,21 @@ def reqAI(prompt: str, model_name: str = "gemini-2.5-flash", is_search: bool = F
         if is_search:
             config = types.GenerateContentConfig(tools=[{"google_search": {}}])
 
-        response_stream = client.models.generate_content_stream(
+        response_stream = await client.aio.models.generate_content_stream(
             model=model_name,
             contents=content_parts,
             config=config,
         )
 
-        for chunk in response_stream:
+        chunks: list[str] = []
+        async for chunk in response_stream:
             if getattr(chunk, "text", None):
+                chunks.append(chunk.text)
                 yield chunk.text
 
+        if cache_key and chunks:
+            await ai_response_cache.set(cache_key, model_name, chunks, ai_response_cache.ttl_for(is_search))
+
     except Exception as e:
         logger.error(f"Geminiリクエストでエラーが発生しました: {e}", exc_info=True)
         yield f"Error: {str(e)}"
@@ -834,114 +1524,124 @@ def reqAI(prompt: str, model_name: str = "gemini-2.5-flash", is_search: bool = F
 
 @app.post("/ai/ask")
 async def ai_ask(
+    request: Request,
     prompt: str = Form(...),
     is_search: bool = Form(False),
-    image: UploadFile = File(None)
+    image: UploadFile = File(None),
+    current_user: Optional[auth.Principal] = Depends(auth.get_current_user_optional),
+    lang: str = 'ja'
 ):
     """
     AIに質問を投げてストリーミングで回答を得るエンドポイント。
+    混雑時はユーザーごとに公平に待たせ、キューが深い場合は 429 と Retry-After を返す。
     """
     if not GEMINI_API_KEY:
         raise HTTPException(status_code=503, detail="AI service is currently unavailable")
 
-    images = None
+    image_data = None
     if image:
         try:
             # UploadFile はここで read して bytes を渡す（以降のライフサイクルに依存しない）
             # ポインタを先頭へ
             try:
-                await run_in_threadpool(image.seek, 0)
+                await image.seek(0)
             except Exception:
                 pass
-            data = await run_in_threadpool(image.read)
-            images = [data] if data else None
+            image_data = await image.read() or None
         except Exception as e:
             logger.error(f"画像ファイルの読み込みに失敗: {e}", exc_info=True)
             raise HTTPException(status_code=400, detail=f"Invalid image file: {str(e)}")
 
-    # 非同期ジェネレータであるreqAIをStreamingResponseに渡す
-    return StreamingResponse(reqAI(prompt, is_search=is_search, images=images), media_type="text/event-stream")
-
+    # 同じプロンプト・画像の応答はキャッシュから同じチャンク単位で再送する
+    image_digests = [hashlib.sha256(image_data).hexdigest()] if image_data else []
+    cache_key = make_cache_key(prompt, AI_MODEL_NAME, is_search, image_digests)
+    cached_chunks = await ai_response_cache.get(cache_key)
+    if cached_chunks is not None:
+        async def replay():
+            for chunk in cached_chunks:
+                yield chunk
+        return StreamingResponse(replay(), media_type="text/event-stream", headers={"X-AI-Cache": "hit"})
 
-# --- Wikipedia Image Endpoint ---
-async def get_image_titles(client: httpx.AsyncClient, keyword: str, lang: str):
-    """Fetches image titles for a keyword from a specific language Wikipedia."""
-    cache_key = _make_titles_cache_key(keyword, lang)
-    cached = _cache_get(cache_key)
-    if cached is not None:
-        return cached
-    URL = f"https://{lang}.wikipedia.org/w/api.php"
-    params = {
-        "action": "query",
-        "prop": "images",
-        "titles": keyword,
-        "format": "json",
-        "redirects": 1,
-        "normalized": 1,
-    }
     try:
-        resp = await _retrying_get(client, URL, params=params, max_retries=2, max_backoff_sec=2.0)
-        resp.raise_for_status()
-        data = resp.json()
-        pages = data.get("query", {}).get("pages", {})
-        if not pages:
-            _cache_set(cache_key, [])
-            return []
-        page_id = next(iter(pages.keys()))
-        if page_id == "-1" or "images" not in pages[page_id]:
-            _cache_set(cache_key, [])
-            return []
-        titles = []
-        for img in pages[page_id]["images"]:
-            title = img.get("title")
-            if title:
-                titles.append(title)
-        _cache_set(cache_key, titles)
-        return titles
-    except (httpx.RequestError, httpx.HTTPStatusError, KeyError, IndexError, ValueError):
-        return []
+        slot = await ai_scheduler.acquire(_ai_client_key(request, current_user))
+    except SchedulerBusy as busy:
+        logger.info(f"AI request rejected ({busy.reason}), retry after {busy.retry_after}s: {ai_scheduler.stats()}")
+        error = create_error_response('ai_too_many_requests', lang, status.HTTP_429_TOO_MANY_REQUESTS)
+        error.headers = {"Retry-After": str(busy.retry_after)}
+        raise error
 
-async def get_image_urls(client: httpx.AsyncClient, titles: list[str], lang: str):
-    """Fetches image URLs for a list of titles from a specific language Wikipedia."""
-    if not titles:
-        return []
-    cache_key = _make_imageinfo_cache_key(titles, lang)
-    cached = _cache_get(cache_key)
-    if cached is not None:
-        return cached
-    URL = f"https://{lang}.wikipedia.org/w/api.php"
-    params = {
-        "action": "query",
-        "prop": "imageinfo",
-        "iiprop": "url",
-        "titles": "|".join(sorted(titles)),
-        "format": "json",
-    }
     try:
+        images = None
+        if image_data:
+            try:
+                # デコード・縮小・再エンコードは CPU 負荷が高いためプロセスプールで行う
+                images = await imaging.prepare_images_for_model([image_data])
+            except Exception as e:
+                logger.error(f"画像ファイルの読み込みに失敗: {e}", exc_info=True)
+                raise HTTPException(status_code=400, detail=f"Invalid image file: {str(e)}")
+    except BaseException:
+        slot.release()
+        raise
+
+    async def stream():
+        # ストリームの完了・クライアント切断のどちらでも実行枠を返す
+        try:
+            async for text in reqAI(prompt, is_search=is_search, images=images, cache_key=cache_key):
+                yield text
+        finally:
+            slot.release()
+
+    # 非同期ジェネレータを StreamingResponse に渡す
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"X-AI-Cache": "miss"},
+        background=BackgroundTask(slot.release),
+    )
+
+
+# --- Wikipedia Image Endpoint ---
+# 配信を許可する画像形式
+# User-selected: HEIF/HEIC, extended JPEG family, ICO + existing common formats
+_WIKI_IMAGE_EXTS = (
+    ".jpg", ".jpeg", ".jpe", ".jfif", ".pjpeg", ".pjp",  # JPEG family
+    ".png",                                              # PNG
+    ".webp",                                             # WebP
+    ".gif",                                              # GIF
+    ".heif", ".heic",                                    # HEIF/HEIC
+    ".ico"                                               # ICO
+)
+
+async def get_wiki_image_urls(client: httpx.AsyncClient, keyword: str, lang: str) -> list[str]:
+    """
+    指定言語の Wikipedia 記事に含まれる画像の URL を返す。
+    generator=images で記事の画像ファイルを列挙し、同じリクエストの prop=imageinfo で URL まで取得する（1 往復）。
+    """
+    async def load() -> list[str]:
+        URL = f"https://{lang}.wikipedia.org/w/api.php"
+        params = {
+            "action": "query",
+            "generator": "images",
+            "titles": keyword,
+            "prop": "imageinfo",
+            "iiprop": "url",
+            "format": "json",
+            "redirects": 1,
+        }
         resp = await _retrying_get(client, URL, params=params, max_retries=2, max_backoff_sec=2.0)
         resp.raise_for_status()
         data = resp.json()
         pages = data.get("query", {}).get("pages", {})
-        allowed_exts = (
-            ".jpg", ".jpeg", ".jpe", ".jfif", ".pjpeg", ".pjp",
-            ".png",
-            ".webp",
-            ".gif",
-            ".heif", ".heic",
-            ".ico"
-        )
         urls: list[str] = []
         for page in pages.values():
             info = page.get("imageinfo")
-            if not info:
-                continue
             url = info[0].get("url") if isinstance(info, list) and info else None
-            if not url:
-                continue
-            if url.lower().endswith(allowed_exts):
+            if url and url.lower().endswith(_WIKI_IMAGE_EXTS):
                 urls.append(url)
-        _cache_set(cache_key, urls)
         return urls
+
+    try:
+        return await api_cache.get_or_load(_make_wiki_images_cache_key(keyword, lang), load)
     except (httpx.RequestError, httpx.HTTPStatusError, KeyError, IndexError, ValueError):
         return []
 
@@ -951,10 +1651,7 @@ async def safe_redirect(url: str):
     安全なURLなら即時リダイレクトし、危険判定なら警告ページを返してブロックする。
     クエリ: /redirect?url=...
     """
-    # ブロックリストのロード/更新
-    # 起動時にプリフェッチ済み。TTL(1日)超過時のみ更新を行うため、通常はヒット即判定。
-    await _ensure_blocklists_loaded()
-
+    # ブロックリストはバックグラウンドで更新されるため、ここでは取得を待たずに現在の照合器で判定する
     # URLからドメイン抽出
     domain = _extract_domain_from_url(url)
     if not domain:
@@ -1008,7 +1705,7 @@ async def search_images_on_pixabay(
     Pixabay 画像検索プロキシ
     - クエリ: q (必須), page, per_page
     - レスポンス: 必要フィールドのみ抽出
-    - 簡易TTLキャッシュ対応（デフォルト _TTL_SECONDS=60）
+    - api_cache でキャッシュ（TTL は API_CACHE_PIXABAY_TTL、デフォルト _TTL_SECONDS=60）
     """
     if not PIXABAY_API_KEY:
         raise HTTPException(status_code=503, detail="Pixabay service is currently unavailable")
@@ -1019,12 +1716,6 @@ async def search_images_on_pixabay(
     page = max(1, min(page, 200))
     per_page = max(3, min(per_page, 200))
 
-    # キャッシュキー生成＆ヒットチェック
-    cache_key = _make_pixabay_cache_key(q, page, per_page, lang)
-    cached = _cache_get(cache_key)
-    if cached is not None:
-        return JSONResponse(content=cached)
-
     params = {
         "key": PIXABAY_API_KEY,
         "q": q,
@@ -1037,105 +1728,106 @@ async def search_images_on_pixabay(
     }
     url = "https://pixabay.com/api/"
 
-    try:
+    async def load() -> dict[str, Any]:
         resp = await _retrying_get(shared_http_client, url, params=params, max_retries=2, max_backoff_sec=2.0)
         resp.raise_for_status()
         data = resp.json()
+
+        hits = data.get("hits", [])
+        results: list[dict[str, Any]] = []
+        for h in hits:
+            results.append({
+                "id": h.get("id"),
+                "pageURL": h.get("pageURL"),
+                "tags": h.get("tags"),
+                "previewURL": h.get("previewURL"),
+                "webformatURL": h.get("webformatURL"),
+                "largeImageURL": h.get("largeImageURL"),
+                "user": h.get("user"),
+                "userImageURL": h.get("userImageURL"),
+                "imageWidth": h.get("imageWidth"),
+                "imageHeight": h.get("imageHeight"),
+                "likes": h.get("likes"),
+                "downloads": h.get("downloads"),
+                "views": h.get("views"),
+            })
+
+        return {
+            "total": data.get("total", 0),
+            "totalHits": data.get("totalHits", 0),
+            "hits": results,
+            "page": page,
+            "per_page": per_page
+        }
+
+    # キャッシュ（期限切れ直後は古い結果を返しつつ裏で取り直す）
+    try:
+        response_payload = await api_cache.get_or_load(_make_pixabay_cache_key(q, page, per_page, lang), load)
     except (httpx.RequestError, httpx.HTTPStatusError) as e:
         logger.error(f"Pixabay request failed: {e}", exc_info=True)
         raise HTTPException(status_code=502, detail="Failed to fetch from Pixabay")
 
-    hits = data.get("hits", [])
-    results: list[dict[str, Any]] = []
-    for h in hits:
-        results.append({
-            "id": h.get("id"),
-            "pageURL": h.get("pageURL"),
-            "tags": h.get("tags"),
-            "previewURL": h.get("previewURL"),
-            "webformatURL": h.get("webformatURL"),
-            "largeImageURL": h.get("largeImageURL"),
-            "user": h.get("user"),
-            "userImageURL": h.get("userImageURL"),
-            "imageWidth": h.get("imageWidth"),
-            "imageHeight": h.get("imageHeight"),
-            "likes": h.get("likes"),
-            "downloads": h.get("downloads"),
-            "views": h.get("views"),
-        })
-
-    response_payload = {
-        "total": data.get("total", 0),
-        "totalHits": data.get("totalHits", 0),
-        "hits": results,
-        "page": page,
-        "per_page": per_page
-    }
-
-    # キャッシュ保存
-    _cache_set(cache_key, response_payload)
-
     return JSONResponse(content=response_payload)
 
 
 @app.get("/wiki/image/{keyword}")
 async def get_wiki_image(keyword: str):
-    async with httpx.AsyncClient() as client:
-        # Step 1: Fetch image titles from both languages concurrently
-        title_tasks = [
-            get_image_titles(client, keyword, "en"),
-            get_image_titles(client, keyword, "ja"),
-        ]
-        en_titles, ja_titles = await asyncio.gather(*title_tasks)
-
-        # Step 2: Fetch image URLs from both languages concurrently
-        url_tasks = [
-            get_image_urls(client, en_titles, "en"),
-            get_image_urls(client, ja_titles, "ja"),
-        ]
-        en_urls, ja_urls = await asyncio.gather(*url_tasks)
-
-        # Combine and deduplicate results, allow only specific image formats
-        # User-selected: HEIF/HEIC, extended JPEG family, ICO + existing common formats
-        allowed_exts = (
-            ".jpg", ".jpeg", ".jpe", ".jfif", ".pjpeg", ".pjp",  # JPEG family
-            ".png",                                              # PNG
-            ".webp",                                             # WebP
-            ".gif",                                              # GIF
-            ".heif", ".heic",                                    # HEIF/HEIC
-            ".ico"                                               # ICO
-        )
-        all_urls = set(en_urls) | set(ja_urls)
-        filtered_urls = [
-            url for url in all_urls
-            if url.lower().endswith(allowed_exts)
-        ]
+    # 英語版・日本語版を同時に問い合わせる（それぞれ 1 往復、言語ごとにキャッシュ）
+    en_urls, ja_urls = await asyncio.gather(
+        get_wiki_image_urls(shared_http_client, keyword, "en"),
+        get_wiki_image_urls(shared_http_client, keyword, "ja"),
+    )
 
-        if not filtered_urls:
-            raise HTTPException(
-                status_code=404,
-                detail="No images found for the given keyword."
-            )
+    # Combine and deduplicate results
+    all_urls = set(en_urls) | set(ja_urls)
+    if not all_urls:
+        raise HTTPException(
+            status_code=404,
+            detail="No images found for the given keyword."
+        )
 
-        return JSONResponse(content={"image_urls": sorted(filtered_urls)})
+    return JSONResponse(content={"image_urls": sorted(all_urls)})
 
 # --- WebSocket Endpoint ---
+# スライドごとの共同編集ルーム（マージ済みの状態は定期的に Slide.slide_data へ保存される）
+# 複数ワーカーで動かす場合は COLLAB_BACKPLANE_URL (redis://host:6379/0 や unix:///path/to/redis.sock) を設定する
+collab_manager = CollabManager(AsyncSessionLocal, create_backplane(os.getenv("COLLAB_BACKPLANE_URL")))
+
 @app.websocket("/ws/collaborate/{slide_id}")
-async def websocket_collaborate(websocket: WebSocket, slide_id: str, user: Optional[User] = Depends(auth.get_current_user_ws)):
+async def websocket_collaborate(websocket: WebSocket, slide_id: int, user: Optional[auth.Principal] = Depends(auth.get_current_user_ws)):
     if user is None:
         await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Authentication Failed")
         return
 
-    await websocket.accept()
+    # サブプロトコルで MessagePack(バイナリフレーム) か JSON(テキストフレーム) を選ぶ
+    codec, subprotocol = wsproto.negotiate(websocket.scope.get("subprotocols") or [])
+    try:
+        room, connection = await collab_manager.join(slide_id, websocket, user.id, codec=codec)
+    except RoomAccessDenied:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason="Slide not found")
+        return
+
     logger.info(f"User {user.username} connected to WebSocket for slide {slide_id}")
     try:
+        await websocket.accept(subprotocol=subprotocol)
+        connection.start()
         while True:
-            data = await websocket.receive_text()
-            # TODO: Implement actual collaboration logic instead of echo
-            await websocket.send_text(f"User {user.username} said: {data} (slide: {slide_id})")
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                break
+            connection.touch()
+            try:
+                message = wsproto.decode(frame)
+            except wsproto.ProtocolError as e:
+                connection.send({"type": "error", "message": str(e)})
+                continue
+            await room.handle_message(connection, message)
+    except WebSocketDisconnect:
+        pass
     except Exception as e:
         logger.warning(f"WebSocket connection closed for slide {slide_id}, user {user.username}: {e}")
     finally:
+        await collab_manager.leave(room, connection)
         logger.info(f"User {user.username} disconnected from slide {slide_id}")
 
 app.mount("/", StaticFiles(directory="static"), name="static")
@@ -1143,5 +1835,6 @@ app.mount("/", StaticFiles(directory="static"), name="static")
 # --- Uvicorn startup ---
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="localhost", port=8000)
+    # permessage-deflate を有効にし、共同編集のフレームを圧縮して送る
+    uvicorn.run(app, host="localhost", port=8000, ws_per_message_deflate=True)
 
@@ -0,0 +1,185 @@
+"""
+/ai/ask の応答キャッシュ。
+- メモリ層: エントリ数・合計バイト数で上限を設けた LRU
+- ディスク層: ai_response_cache テーブル（再起動後も有効）
+キーは正規化したプロンプト・モデル名・検索フラグ・画像ダイジェストから作る完全一致キー。
+値はストリーミングしたテキスト片のリストで、ヒット時は同じ単位で再送する。
+"""
+import hashlib
+import json
+import logging
+import re
+import unicodedata
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from fastapi.concurrency import run_in_threadpool
+from sqlalchemy.orm import Session
+
+from module.models import AIResponseCacheEntry
+
+logger = logging.getLogger(__name__)
+
+_HORIZONTAL_SPACE_RE = re.compile(r"[ \t　]+")
+_BLANK_LINES_RE = re.compile(r"\n{3,}")
+
+
+def normalize_prompt(prompt: str) -> str:
+    """
+    表記ゆれだけが異なるプロンプトを同一視するための正規化。
+    Unicode 正規化(NFKC)・改行コード統一・連続空白の圧縮・行末空白と前後の空白の除去を行う。
+    """
+    text = unicodedata.normalize("NFKC", prompt or "").replace("\r\n", "\n").replace("\r", "\n")
+    lines = [_HORIZONTAL_SPACE_RE.sub(" ", line).strip() for line in text.split("\n")]
+    return _BLANK_LINES_RE.sub("\n\n", "\n".join(lines)).strip()
+
+
+def make_cache_key(prompt: str, model: str, is_search: bool, image_digests: Sequence[str] = ()) -> str:
+    payload = json.dumps(
+        [normalize_prompt(prompt), model, bool(is_search), list(image_digests)],
+        ensure_ascii=False, separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def _utcnow() -> datetime:
+    # SQLite の DateTime はタイムゾーンを保持しないため naive な UTC で比較する
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _chunks_size(chunks: Sequence[str]) -> int:
+    return sum(len(chunk.encode("utf-8")) for chunk in chunks)
+
+
+class AIResponseCache:
+    def __init__(
+        self,
+        session_factory: Callable[[], Session],
+        max_entries: int = 256,
+        max_bytes: int = 32 * 1024 * 1024,
+        disk_max_entries: int = 5000,
+        ttl: float = 7 * 24 * 3600,
+        search_ttl: float = 3600,
+    ):
+        self.session_factory = session_factory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.disk_max_entries = disk_max_entries
+        self.ttl = ttl
+        self.search_ttl = search_ttl
+        # key -> (有効期限, チャンク, バイト数)
+        self._memory: "OrderedDict[str, Tuple[datetime, List[str], int]]" = OrderedDict()
+        self._memory_bytes = 0
+
+    def ttl_for(self, is_search: bool) -> float:
+        """検索結果を含む応答は内容が古くなりやすいため短い TTL を使う"""
+        return self.search_ttl if is_search else self.ttl
+
+    # --- メモリ層 ---
+    def _memory_get(self, key: str) -> Optional[List[str]]:
+        item = self._memory.get(key)
+        if item is None:
+            return None
+        expires_at, chunks, _ = item
+        if expires_at <= _utcnow():
+            self._memory_pop(key)
+            return None
+        self._memory.move_to_end(key)
+        return chunks
+
+    def _memory_pop(self, key: str) -> None:
+        item = self._memory.pop(key, None)
+        if item is not None:
+            self._memory_bytes -= item[2]
+
+    def _memory_set(self, key: str, chunks: List[str], expires_at: datetime, size: int) -> None:
+        if size > self.max_bytes:
+            return
+        self._memory_pop(key)
+        self._memory[key] = (expires_at, chunks, size)
+        self._memory_bytes += size
+        while self._memory and (len(self._memory) > self.max_entries or self._memory_bytes > self.max_bytes):
+            oldest = next(iter(self._memory))
+            self._memory_pop(oldest)
+
+    # --- ディスク層（同期 API。イベントループ外から呼び出す） ---
+    def disk_get(self, key: str) -> Optional[Tuple[List[str], datetime]]:
+        db = self.session_factory()
+        try:
+            entry = db.get(AIResponseCacheEntry, key)
+            if entry is None:
+                return None
+            if entry.expires_at <= _utcnow():  # type: ignore
+                db.delete(entry)
+                db.commit()
+                return None
+            return json.loads(entry.chunks), entry.expires_at  # type: ignore
+        finally:
+            db.close()
+
+    def disk_set(self, key: str, model: str, chunks: List[str], expires_at: datetime, size: int) -> None:
+        db = self.session_factory()
+        try:
+            entry = db.get(AIResponseCacheEntry, key)
+            if entry is None:
+                entry = AIResponseCacheEntry(key=key)
+                db.add(entry)
+            entry.model = model  # type: ignore
+            entry.chunks = json.dumps(chunks, ensure_ascii=False)  # type: ignore
+            entry.size = size  # type: ignore
+            entry.created_at = _utcnow()  # type: ignore
+            entry.expires_at = expires_at  # type: ignore
+            db.flush()
+
+            # 期限切れを掃除し、件数上限を超えた分は古いものから削除する
+            db.query(AIResponseCacheEntry).filter(
+                AIResponseCacheEntry.expires_at <= _utcnow()
+            ).delete(synchronize_session=False)
+            overflow = db.query(AIResponseCacheEntry).count() - self.disk_max_entries
+            if overflow > 0:
+                oldest = (
+                    db.query(AIResponseCacheEntry.key)
+                    .order_by(AIResponseCacheEntry.created_at)
+                    .limit(overflow)
+                    .subquery()
+                )
+                db.query(AIResponseCacheEntry).filter(
+                    AIResponseCacheEntry.key.in_(db.query(oldest.c.key))
+                ).delete(synchronize_session=False)
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    # --- 非同期 API ---
+    async def get(self, key: str) -> Optional[List[str]]:
+        """メモリ層→ディスク層の順に探す。ディスク層でヒットした場合はメモリ層へ昇格する"""
+        chunks = self._memory_get(key)
+        if chunks is not None:
+            return chunks
+        try:
+            found = await run_in_threadpool(self.disk_get, key)
+        except Exception as e:
+            logger.warning(f"AI response cache read failed: {e}")
+            return None
+        if found is None:
+            return None
+        chunks, expires_at = found
+        self._memory_set(key, chunks, expires_at, _chunks_size(chunks))
+        return chunks
+
+    async def set(self, key: str, model: str, chunks: List[str], ttl: float) -> None:
+        expires_at = _utcnow() + timedelta(seconds=ttl)
+        size = _chunks_size(chunks)
+        self._memory_set(key, chunks, expires_at, size)
+        try:
+            await run_in_threadpool(self.disk_set, key, model, chunks, expires_at, size)
+        except Exception as e:
+            logger.warning(f"AI response cache write failed: {e}")
+
+    def clear_memory(self) -> None:
+        self._memory.clear()
+        self._memory_bytes = 0
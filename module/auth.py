@@ -1,17 +1,26 @@
 import os
+import math
+import uuid
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from typing import Optional, Annotated
+from typing import Optional, Annotated, Callable, Dict, TypeVar
 
 from fastapi import Depends, HTTPException, status, WebSocket, Query
 from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 import bcrypt
 from pydantic import BaseModel
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from dotenv import load_dotenv
 
 from module.models import User
-from module.database import get_db
+from module.database import get_async_db
 
 load_dotenv()
 
@@ -34,10 +43,14 @@ if SECRET_KEY == "SeceretKey":
 if len(SECRET_KEY) < 8:
     raise ValueError("SECRET_KEY must be at least 8 characters long")
 
+T = TypeVar("T")
+
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login") # tokenUrl should match your login path
+# 未ログインでも利用できるエンドポイント用（トークンがなくても 401 にしない）
+oauth2_scheme_optional = OAuth2PasswordBearer(tokenUrl="/auth/login", auto_error=False)
 
 class TokenData(BaseModel):
     username: Optional[str] = None
@@ -46,6 +59,14 @@ class Token(BaseModel):
     access_token: str
     token_type: str
 
+# bcrypt のコスト係数。変更するとログイン時に既存ハッシュが新しいコストで再ハッシュされる
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# bcrypt は 1 回あたり数百 ms の CPU 処理になるため、専用のスレッドプールで実行する
+# (bcrypt は計算中に GIL を解放するので、ワーカー数だけコアを使える)
+PASSWORD_HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+# 実行待ち+実行中の上限。超えた分は待たせずに PasswordHasherBusy で断る（ログイン集中時に待ち行列が伸び続けないように）
+PASSWORD_HASH_MAX_PENDING = int(os.getenv("PASSWORD_HASH_MAX_PENDING", "64"))
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """
     パスワードを検証する。bcryptを使用。
@@ -62,9 +83,115 @@ def get_password_hash(password: str) -> str:
     """
     if isinstance(password, str):
         password = password.encode('utf-8')
-    salt = bcrypt.gensalt()
+    salt = bcrypt.gensalt(rounds=BCRYPT_ROUNDS)
     return bcrypt.hashpw(password, salt).decode('utf-8')
 
+def password_needs_rehash(hashed_password: str) -> bool:
+    """ハッシュのコスト係数が現在の BCRYPT_ROUNDS と異なる場合 True を返す"""
+    parts = (hashed_password or "").split("$")  # "$2b$12$<salt+hash>"
+    if len(parts) != 4 or not parts[2].isdigit():
+        return False
+    return int(parts[2]) != BCRYPT_ROUNDS
+
+
+class PasswordHasherBusy(Exception):
+    """パスワード処理の待ちが上限に達している。retry_after 秒後の再試行を促す"""
+
+    def __init__(self, retry_after: float):
+        super().__init__("password hashing queue is full")
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class PasswordHasher:
+    """
+    パスワードのハッシュ化・検証を専用スレッドプールで実行し、イベントループを止めないようにする。
+    同時実行数はワーカー数で制限され、待ちが max_pending を超えると PasswordHasherBusy で断る。
+    待ち行列の状況は stats() で確認できる。
+    """
+
+    def __init__(self, max_workers: int, max_pending: int = PASSWORD_HASH_MAX_PENDING):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.rejected = 0
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.max_queued = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+        self.total_run_seconds = 0.0
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="bcrypt")
+        return self._executor
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def _run(self, submitted_at: float, fn: Callable[..., T], *args) -> T:
+        started_at = time.monotonic()
+        wait = started_at - submitted_at
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.total_wait_seconds += wait
+            self.max_wait_seconds = max(self.max_wait_seconds, wait)
+        try:
+            return fn(*args)
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.completed += 1
+                self.total_run_seconds += time.monotonic() - started_at
+
+    async def run(self, fn: Callable[..., T], *args) -> T:
+        with self._lock:
+            if self.queued + self.running >= self.max_pending:
+                self.rejected += 1
+                # 今の待ちが捌けるまでの目安（平均処理時間 × 待ち件数 / ワーカー数）
+                avg_run = self.total_run_seconds / self.completed if self.completed else 0.25
+                raise PasswordHasherBusy(avg_run * self.queued / self.max_workers)
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        loop = asyncio.get_running_loop()
+        try:
+            future = loop.run_in_executor(self._get_executor(), self._run, time.monotonic(), fn, *args)
+        except BaseException:
+            with self._lock:
+                self.queued -= 1
+            raise
+        return await future
+
+    def stats(self) -> Dict[str, float]:
+        with self._lock:
+            completed = self.completed
+            return {
+                "workers": self.max_workers,
+                "queued": self.queued,
+                "running": self.running,
+                "completed": completed,
+                "max_queued": self.max_queued,
+                "max_pending": self.max_pending,
+                "rejected": self.rejected,
+                "avg_wait_ms": self.total_wait_seconds / completed * 1000 if completed else 0.0,
+                "max_wait_ms": self.max_wait_seconds * 1000,
+                "avg_run_ms": self.total_run_seconds / completed * 1000 if completed else 0.0,
+            }
+
+
+password_hasher = PasswordHasher(PASSWORD_HASH_WORKERS)
+
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await password_hasher.run(verify_password, plain_password, hashed_password)
+
+async def get_password_hash_async(password: str) -> str:
+    return await password_hasher.run(get_password_hash, password)
+
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     to_encode = data.copy()
     if expires_delta:
@@ -72,50 +199,130 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     else:
         expire = datetime.now(timezone.utc) + timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     to_encode.update({"exp": expire})
+    # トークンごとの識別子（認証済みユーザーキャッシュのキー）
+    to_encode.setdefault("jti", uuid.uuid4().hex)
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-async def get_user(db: Session, username: str) -> Optional[User]:
-    return db.query(User).filter(User.username == username).first()
+async def get_user(db: AsyncSession, username: str) -> Optional[User]:
+    result = await db.execute(select(User).where(User.username == username))
+    return result.scalars().first()
+
+@dataclass(frozen=True)
+class Principal:
+    """
+    認証済みユーザーを表す軽量なオブジェクト（ORM の User ではない）。
+    パスワードハッシュ等が必要なハンドラは get_current_db_user を使う。
+    """
+    id: int
+    username: str
+
+
+# 認証済みユーザーのキャッシュ: トークンの jti (古いトークンは sub) -> (有効期限, Principal)
+# 自動保存やファイル取得のたびに users テーブルを引かないようにする。
+# プロセス内キャッシュのため、別ワーカーでの変更は TTL 経過後に反映される。
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+PRINCIPAL_CACHE_MAX_ENTRIES = int(os.getenv("PRINCIPAL_CACHE_MAX_ENTRIES", "10000"))
+_principal_cache: "OrderedDict[str, tuple[float, Principal]]" = OrderedDict()
+
+def _principal_cache_get(key: str) -> Optional[Principal]:
+    item = _principal_cache.get(key)
+    if item is None:
+        return None
+    expires_at, principal = item
+    if expires_at <= time.monotonic():
+        _principal_cache.pop(key, None)
+        return None
+    _principal_cache.move_to_end(key)
+    return principal
+
+def _principal_cache_set(key: str, principal: Principal) -> None:
+    _principal_cache[key] = (time.monotonic() + PRINCIPAL_CACHE_TTL, principal)
+    _principal_cache.move_to_end(key)
+    while len(_principal_cache) > PRINCIPAL_CACHE_MAX_ENTRIES:
+        _principal_cache.popitem(last=False)
+
+def invalidate_user_cache(user_id: int) -> None:
+    """ユーザー情報の変更時に、そのユーザーのキャッシュをすべて破棄する"""
+    for key in [key for key, (_, principal) in _principal_cache.items() if principal.id == user_id]:
+        del _principal_cache[key]
+
+async def resolve_principal(token: str, db: AsyncSession) -> Optional[Principal]:
+    """
+    トークンを検証して Principal を返す。無効なトークンの場合は None。
+    署名と有効期限は毎回検証し、ユーザーの存在確認のみキャッシュする。
+    """
+    try:
+        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+    except JWTError:
+        return None
+    username: Optional[str] = payload.get("sub")
+    if username is None:
+        return None
+    user_id = payload.get("uid")
+    jti = payload.get("jti")
+    cache_key = f"jti:{jti}" if jti else f"sub:{username}"
+
+    principal = _principal_cache_get(cache_key)
+    if principal is not None:
+        return principal
+
+    if isinstance(user_id, int):
+        user = await db.get(User, user_id)
+        # ユーザー名が変更された場合、変更前に発行されたトークンは無効とする（従来と同じ挙動）
+        if user is not None and user.username != username:
+            user = None
+    else:
+        user = await get_user(db, username=username)
+    if user is None:
+        return None
+    principal = Principal(id=user.id, username=user.username)  # type: ignore
+    _principal_cache_set(cache_key, principal)
+    return principal
 
-async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: Session = Depends(get_db)) -> User:
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)], db: AsyncSession = Depends(get_async_db)) -> Principal:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: Optional[str] = payload.get("sub")
-        if username is None:
-            raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
+    principal = await resolve_principal(token, db)
+    if principal is None:
         raise credentials_exception
+    return principal
 
-    user = await get_user(db, username=token_data.username) if token_data.username else None
+async def get_current_db_user(
+    principal: Annotated[Principal, Depends(get_current_user)], db: AsyncSession = Depends(get_async_db)
+) -> User:
+    """ORM の User が必要なハンドラ(パスワード・ユーザー名の更新など)向けに DB から読み込む"""
+    user = await db.get(User, principal.id)
     if user is None:
-        raise credentials_exception
+        invalidate_user_cache(principal.id)
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     return user
 
+async def get_current_user_optional(
+    token: Annotated[Optional[str], Depends(oauth2_scheme_optional)], db: AsyncSession = Depends(get_async_db)
+) -> Optional[Principal]:
+    """ログインしていればユーザーを、未ログインまたはトークンが無効なら None を返す"""
+    if token is None:
+        return None
+    return await resolve_principal(token, db)
+
 async def get_current_user_ws(
     websocket: WebSocket,
     token: Optional[str] = Query(None),
-    db: Session = Depends(get_db)
-) -> Optional[User]:
+    db: AsyncSession = Depends(get_async_db)
+) -> Optional[Principal]:
     if token is None:
         return None
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        username: Optional[str] = payload.get("sub")
-        if username is None:
-            return None
-        user = await get_user(db, username=username)
-        return user
-    except JWTError:
-        return None
+    return await resolve_principal(token, db)
 
-async def get_current_active_user(current_user: Annotated[User, Depends(get_current_user)]) -> User:
+async def get_current_active_user(current_user: Annotated[Principal, Depends(get_current_user)]) -> Principal:
     # If we add an "is_active" flag to the User model, we can check it here.
     # For now, just returns the user if authenticated.
     # if not current_user.is_active:
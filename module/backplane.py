@@ -0,0 +1,245 @@
+"""
+ワーカー間で共同編集ルームのメッセージを中継するバックプレーン。
+uvicorn を複数ワーカーで動かすと、同じスライドへの WebSocket 接続が別プロセスに振り分けられるため、
+ルームの操作をチャンネル単位の pub/sub で全ワーカーへ配信する。
+- InProcessBackplane: 同一プロセス内のみで配信する（単一ワーカー構成・テスト用）
+- RedisBackplane: RESP プロトコルの PUBLISH/SUBSCRIBE で配信する（Redis / Valkey などローカルで動く互換サーバー）
+  redis://[:password@]host:port/db または unix:///path/to/socket を指定する
+"""
+import abc
+import asyncio
+import json
+import logging
+from typing import Any, Awaitable, Callable, Dict, Optional, Set, Tuple
+from urllib.parse import unquote, urlparse
+
+logger = logging.getLogger(__name__)
+
+Handler = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class Backplane(abc.ABC):
+    """チャンネル単位の pub/sub。メッセージは JSON にできる dict"""
+
+    def __init__(self):
+        self._handlers: Dict[str, Set[Handler]] = {}
+
+    @abc.abstractmethod
+    async def publish(self, channel: str, message: Dict[str, Any]) -> None:
+        """チャンネルの購読者(他のワーカーを含む)へメッセージを配信する"""
+
+    async def subscribe(self, channel: str, handler: Handler) -> None:
+        self._handlers.setdefault(channel, set()).add(handler)
+
+    async def unsubscribe(self, channel: str, handler: Handler) -> None:
+        handlers = self._handlers.get(channel)
+        if handlers is None:
+            return
+        handlers.discard(handler)
+        if not handlers:
+            del self._handlers[channel]
+
+    async def _dispatch(self, channel: str, message: Dict[str, Any]) -> None:
+        for handler in list(self._handlers.get(channel, ())):
+            try:
+                await handler(message)
+            except Exception as e:
+                logger.warning(f"Backplane handler failed on {channel}: {e}", exc_info=True)
+
+    async def close(self) -> None:
+        self._handlers.clear()
+
+
+class InProcessBackplane(Backplane):
+    async def publish(self, channel: str, message: Dict[str, Any]) -> None:
+        # 購読側でメッセージを書き換えても互いに影響しないよう JSON を経由して複製する
+        await self._dispatch(channel, json.loads(json.dumps(message)))
+
+
+# --- RESP (Redis シリアライゼーションプロトコル) ---
+class RESPError(Exception):
+    """サーバーが返したエラー応答"""
+
+
+def encode_command(*args: Any) -> bytes:
+    parts = [b"*%d\r\n" % len(args)]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode("utf-8")
+        parts.append(b"$%d\r\n%s\r\n" % (len(data), data))
+    return b"".join(parts)
+
+
+async def read_reply(reader: asyncio.StreamReader) -> Any:
+    line = await reader.readline()
+    if not line.endswith(b"\r\n"):
+        raise ConnectionError("connection closed")
+    prefix, payload = line[:1], line[1:-2]
+    if prefix == b"+":
+        return payload.decode("utf-8")
+    if prefix == b"-":
+        raise RESPError(payload.decode("utf-8"))
+    if prefix == b":":
+        return int(payload)
+    if prefix == b"$":
+        length = int(payload)
+        if length < 0:
+            return None
+        data = await reader.readexactly(length + 2)
+        return data[:-2]
+    if prefix == b"*":
+        length = int(payload)
+        if length < 0:
+            return None
+        return [await read_reply(reader) for _ in range(length)]
+    raise ConnectionError(f"unexpected RESP prefix: {prefix!r}")
+
+
+def _as_str(value: Any) -> str:
+    return value.decode("utf-8") if isinstance(value, bytes) else str(value)
+
+
+class RedisBackplane(Backplane):
+    """
+    RESP 互換サーバーを使うバックプレーン。
+    PUBLISH 用と SUBSCRIBE 用に 1 本ずつ接続を持ち、切断時は再接続して購読し直す。
+    """
+
+    RECONNECT_DELAY = 1.0
+
+    def __init__(self, url: str, connect_timeout: float = 5.0):
+        super().__init__()
+        self.url = url
+        self.connect_timeout = connect_timeout
+        parsed = urlparse(url)
+        if parsed.scheme not in ("redis", "unix"):
+            raise ValueError(f"unsupported backplane URL: {url}")
+        self._unix_path = parsed.path if parsed.scheme == "unix" else None
+        self._host = parsed.hostname or "localhost"
+        self._port = parsed.port or 6379
+        self._password = unquote(parsed.password) if parsed.password else None
+        self._db = int(parsed.path.lstrip("/") or 0) if parsed.scheme == "redis" else 0
+
+        self._pub: Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = None
+        self._pub_lock = asyncio.Lock()
+        self._sub_writer: Optional[asyncio.StreamWriter] = None
+        self._sub_task: Optional[asyncio.Task] = None
+        self._sub_ready: Optional[asyncio.Event] = None
+        self._closed = False
+
+    async def _connect(self) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        if self._unix_path:
+            opening = asyncio.open_unix_connection(self._unix_path)
+        else:
+            opening = asyncio.open_connection(self._host, self._port)
+        reader, writer = await asyncio.wait_for(opening, self.connect_timeout)
+        try:
+            if self._password:
+                writer.write(encode_command("AUTH", self._password))
+                await read_reply(reader)
+            if self._db:
+                writer.write(encode_command("SELECT", self._db))
+                await read_reply(reader)
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    async def publish(self, channel: str, message: Dict[str, Any]) -> None:
+        payload = json.dumps(message, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+        async with self._pub_lock:
+            for attempt in range(2):
+                try:
+                    if self._pub is None:
+                        self._pub = await self._connect()
+                    reader, writer = self._pub
+                    writer.write(encode_command("PUBLISH", channel, payload))
+                    await writer.drain()
+                    await read_reply(reader)
+                    return
+                except (OSError, ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError):
+                    self._close_publisher()
+                    if attempt:
+                        raise
+
+    def _close_publisher(self) -> None:
+        if self._pub is not None:
+            self._pub[1].close()
+            self._pub = None
+
+    # --- 購読 ---
+    async def subscribe(self, channel: str, handler: Handler) -> None:
+        is_new = channel not in self._handlers
+        await super().subscribe(channel, handler)
+        if self._sub_task is None:
+            self._sub_ready = asyncio.Event()
+            self._sub_task = asyncio.get_running_loop().create_task(self._subscriber_loop())
+        if is_new:
+            await self._send_sub("SUBSCRIBE", channel)
+
+    async def unsubscribe(self, channel: str, handler: Handler) -> None:
+        await super().unsubscribe(channel, handler)
+        if channel not in self._handlers and self._sub_task is not None:
+            await self._send_sub("UNSUBSCRIBE", channel)
+
+    async def _send_sub(self, command: str, channel: str) -> None:
+        assert self._sub_ready is not None
+        try:
+            await asyncio.wait_for(self._sub_ready.wait(), self.connect_timeout)
+        except asyncio.TimeoutError:
+            # 再接続時に購読中のチャンネルはすべて購読し直す
+            logger.warning(f"Backplane subscriber is not connected; {command} {channel} deferred")
+            return
+        if self._sub_writer is not None:
+            self._sub_writer.write(encode_command(command, channel))
+            await self._sub_writer.drain()
+
+    async def _subscriber_loop(self) -> None:
+        assert self._sub_ready is not None
+        while not self._closed:
+            writer = None
+            try:
+                reader, writer = await self._connect()
+                channels = list(self._handlers)
+                if channels:
+                    writer.write(encode_command("SUBSCRIBE", *channels))
+                    await writer.drain()
+                self._sub_writer = writer
+                self._sub_ready.set()
+                while True:
+                    reply = await read_reply(reader)
+                    if isinstance(reply, list) and len(reply) == 3 and _as_str(reply[0]) == "message":
+                        try:
+                            message = json.loads(reply[2])
+                        except ValueError:
+                            continue
+                        await self._dispatch(_as_str(reply[1]), message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not self._closed:
+                    logger.warning(f"Backplane subscriber disconnected: {e}")
+            finally:
+                self._sub_ready.clear()
+                self._sub_writer = None
+                if writer is not None:
+                    writer.close()
+            await asyncio.sleep(self.RECONNECT_DELAY)
+
+    async def close(self) -> None:
+        self._closed = True
+        if self._sub_task is not None:
+            self._sub_task.cancel()
+            try:
+                await self._sub_task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._sub_task = None
+        self._close_publisher()
+        await super().close()
+
+
+def create_backplane(url: Optional[str]) -> Backplane:
+    """URL が未指定ならプロセス内、redis:// / unix:// なら RESP サーバー経由のバックプレーンを返す"""
+    if not url:
+        return InProcessBackplane()
+    return RedisBackplane(url)
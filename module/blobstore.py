@@ -0,0 +1,154 @@
+"""
+アップロードファイル用のコンテンツアドレス型ストレージ。
+ファイルは SHA-256 ダイジェストをキーに <root>/<2桁>/<2桁>/<digest> へ一度だけ保存し、
+blobs テーブルの参照カウントで UploadedFile からの参照を管理する。
+実ファイルの配置と参照の登録、参照の確認と実ファイルの削除は、同じダイジェストのロック内で行う
+（最後の参照の削除と同一内容のアップロードが交差しても、登録済みの blob の実体を消さないため）。
+"""
+import asyncio
+import hashlib
+import os
+import tempfile
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Tuple
+
+from sqlalchemy.orm import Session
+
+from module.models import Blob
+
+
+class BlobWriter:
+    """一時ファイルへ書き込みながらハッシュとサイズを計算するライター"""
+
+    def __init__(self, tmp_dir: str):
+        self._file = tempfile.NamedTemporaryFile(dir=tmp_dir, prefix="upload-", delete=False)
+        self._hash = hashlib.sha256()
+        self.temp_path = self._file.name
+        self.size = 0
+        self.digest: Optional[str] = None
+
+    def write(self, chunk: bytes) -> None:
+        self._hash.update(chunk)
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+    def close(self) -> str:
+        """書き込みを終了してダイジェストを返す"""
+        if not self._file.closed:
+            self._file.close()
+        self.digest = self._hash.hexdigest()
+        return self.digest
+
+    def discard(self) -> None:
+        """一時ファイルを破棄する"""
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.remove(self.temp_path)
+        except FileNotFoundError:
+            pass
+
+
+class BlobStore:
+    def __init__(self, root: str):
+        self.root = root
+        self.tmp_dir = os.path.join(root, "tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        # digest -> (ロック, 使用中の数)。使われなくなったロックは捨てる
+        self._locks: Dict[str, Tuple[asyncio.Lock, int]] = {}
+
+    def path_for(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def new_writer(self) -> BlobWriter:
+        return BlobWriter(self.tmp_dir)
+
+    def new_temp_path(self) -> str:
+        """再開可能アップロード用に空の一時ファイルを作成してパスを返す"""
+        fd, path = tempfile.mkstemp(dir=self.tmp_dir, prefix="resumable-")
+        os.close(fd)
+        return path
+
+    @asynccontextmanager
+    async def lock(self, digest: str) -> AsyncIterator[None]:
+        """
+        ダイジェストごとのロック。commit/commit_path から参照の登録・コミットまでと、
+        blob_in_use の確認から remove までをこの中で行う。
+        """
+        lock, users = self._locks.get(digest, (asyncio.Lock(), 0))
+        self._locks[digest] = (lock, users + 1)
+        try:
+            async with lock:
+                yield
+        finally:
+            lock, users = self._locks[digest]
+            if users <= 1:
+                del self._locks[digest]
+            else:
+                self._locks[digest] = (lock, users - 1)
+
+    def commit(self, writer: BlobWriter) -> str:
+        """書き込み済みの一時ファイルを最終パスへ移動する"""
+        digest = writer.digest or writer.close()
+        return self.commit_path(writer.temp_path, digest)
+
+    def commit_path(self, temp_path: str, digest: str) -> str:
+        """
+        一時ファイルを最終パスへ移動する。同一内容が既に保存済みなら一時ファイルを捨てるだけで書き込まない。
+        (呼び出し元は lock(digest) を保持していること)
+        """
+        path = self.path_for(digest)
+        if os.path.exists(path):
+            os.remove(temp_path)
+            return path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+        return path
+
+    def remove(self, digest: str) -> None:
+        try:
+            os.remove(self.path_for(digest))
+        except FileNotFoundError:
+            pass
+
+
+def hash_file(path: str, chunk_size: int = 1024 * 1024) -> str:
+    """ファイルの SHA-256 を計算する（読み込みのみでコピーは行わない）"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def acquire_blob(db: Session, digest: str, size: int, content_type: Optional[str]) -> Blob:
+    """
+    ダイジェストの参照カウントを 1 増やす。未登録なら新規に登録する。
+    (コミットは呼び出し元で行う)
+    """
+    updated = db.query(Blob).filter(Blob.digest == digest).update(
+        {Blob.ref_count: Blob.ref_count + 1}, synchronize_session=False
+    )
+    if updated:
+        return db.get(Blob, digest, populate_existing=True)  # type: ignore
+    blob = Blob(digest=digest, size=size, content_type=content_type, ref_count=1)
+    db.add(blob)
+    return blob
+
+
+def release_blob(db: Session, digest: str) -> bool:
+    """
+    参照カウントを 1 減らし、0 になった場合は行を削除して True を返す。
+    True の場合、呼び出し元はコミット後に実ファイルを削除する。
+    """
+    db.query(Blob).filter(Blob.digest == digest, Blob.ref_count > 0).update(
+        {Blob.ref_count: Blob.ref_count - 1}, synchronize_session=False
+    )
+    deleted = db.query(Blob).filter(Blob.digest == digest, Blob.ref_count <= 0).delete(
+        synchronize_session=False
+    )
+    return bool(deleted)
+
+
+def blob_in_use(db: Session, digest: str) -> bool:
+    return db.query(Blob.digest).filter(Blob.digest == digest).first() is not None
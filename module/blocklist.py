@@ -0,0 +1,475 @@
+"""
+URL 安全性チェック用のブロックリスト照合。
+
+ドメインの集合を Python の set で持つと数十万件で数十 MB になり、ワーカーごとに重複する。
+そこで各ドメインを 64bit ハッシュにしてソート済み配列に詰め、ファイル(スナップショット)に書き出す。
+各ワーカーはこのファイルを読み取り専用で mmap するため、物理メモリはページキャッシュとして共有される。
+
+スナップショットの形式（ネイティブバイトオーダー）:
+  ヘッダー   magic(8) | ヘッダー JSON の長さ(u32) | ヘッダー JSON(sources, count, byteorder, built_at)
+  パディング 8 バイト境界まで
+  hashes     u64 × count （昇順）
+  sources    u8 × count  （hashes と同じ並びで、sources のインデックス）
+
+照合は、ドメインとその親ドメイン(2 ラベル以上)のハッシュを二分探索で引くだけで、文字列の結合やリストの生成は行わない。
+64bit ハッシュの衝突による誤検知の確率は 1 回の照合あたり 件数/2^64 程度で、実用上は無視できる。
+
+更新は BlocklistRefresher がバックグラウンドで行い、リクエスト処理はダウンロードを待たない。
+"""
+import asyncio
+import hashlib
+import itertools
+import json
+import logging
+import mmap
+import os
+import struct
+import sys
+import tempfile
+import time
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+from email.utils import formatdate
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+import httpx
+from fastapi.concurrency import run_in_threadpool
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"AISBLK01"
+_HEADER_LENGTH = struct.Struct("<I")
+
+# 取得の再試行（一時的なエラーのみ。指数バックオフ）
+FETCH_MAX_RETRIES = 2
+FETCH_MAX_BACKOFF = 2.0
+_TRANSIENT_STATUSES = (429, 502, 503, 504)
+# 一時ファイルへまとめて書き込む行数
+_WRITE_BATCH_LINES = 4096
+
+
+def domain_hash(domain: str) -> int:
+    return int.from_bytes(hashlib.blake2b(domain.encode("utf-8"), digest_size=8).digest(), sys.byteorder)
+
+
+class BlocklistMatcher:
+    """
+    ソート済みハッシュ配列によるドメイン照合器。
+    sources は優先度順（先頭ほど優先）。同じドメインが複数のリストにある場合は優先度の高い方に属する。
+    """
+
+    def __init__(self, hashes: Sequence[int], source_ids: Sequence[int], sources: List[str],
+                 path: Optional[str] = None, built_at: Optional[float] = None,
+                 _mmap: Optional[mmap.mmap] = None, _view: Optional[memoryview] = None):
+        self._hashes = hashes
+        self._source_ids = source_ids
+        self.sources = sources
+        self.path = path
+        self.built_at = built_at if built_at is not None else time.time()
+        self._mmap = _mmap
+        self._view = _view
+
+    @classmethod
+    def empty(cls) -> "BlocklistMatcher":
+        return cls(array("Q"), array("B"), [])
+
+    @classmethod
+    def from_domains(cls, domains_by_source: Dict[str, Iterable[str]]) -> "BlocklistMatcher":
+        """{source: ドメインの iterable} から構築する（dict の順序が優先度）"""
+        sources = list(domains_by_source)
+        if len(sources) > 255:
+            raise ValueError("too many blocklist sources")
+        merged: Dict[int, int] = {}
+        for source_id, domains in enumerate(domains_by_source.values()):
+            for domain in domains:
+                merged.setdefault(domain_hash(domain), source_id)
+        ordered = sorted(merged)
+        return cls(array("Q", ordered), array("B", (merged[h] for h in ordered)), sources)
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+    def counts(self) -> Dict[str, int]:
+        result = dict.fromkeys(self.sources, 0)
+        for source_id in self._source_ids:
+            result[self.sources[source_id]] += 1
+        return result
+
+    def _lookup(self, domain: str) -> int:
+        """見つかれば source のインデックス、なければ -1"""
+        value = domain_hash(domain)
+        hashes = self._hashes
+        index = bisect_left(hashes, value)
+        if index < len(hashes) and hashes[index] == value:
+            return self._source_ids[index]
+        return -1
+
+    def match(self, domain: str) -> Optional[Tuple[str, str]]:
+        """
+        ドメインまたはその親ドメイン(少なくとも 2 ラベル)がリストにあれば (一致したドメイン, source) を返す。
+        優先度の高い source の一致を優先し、同じ優先度なら具体的な(長い)ドメインを優先する。
+        """
+        if not domain or not self._hashes:
+            return None
+        best: Optional[Tuple[int, str]] = None
+        start = 0
+        last_dot = domain.rfind(".")
+        # "a.b.c" -> "a.b.c", "b.c"（最後のラベル単体は対象外）
+        while 0 <= start < last_dot:
+            variant = domain[start:] if start else domain
+            source_id = self._lookup(variant)
+            if source_id == 0:
+                return variant, self.sources[0]
+            if source_id > 0 and (best is None or source_id < best[0]):
+                best = (source_id, variant)
+            start = domain.find(".", start) + 1
+        if best is None:
+            return None
+        return best[1], self.sources[best[0]]
+
+    # --- スナップショット ---
+    def write_snapshot(self, path: str) -> None:
+        """一時ファイルに書き出してから置き換える（読み込み中のワーカーは古いファイルを使い続けられる）"""
+        header = json.dumps({
+            "sources": self.sources,
+            "count": len(self._hashes),
+            "byteorder": sys.byteorder,
+            "built_at": self.built_at,
+        }).encode("utf-8")
+        prefix = MAGIC + _HEADER_LENGTH.pack(len(header)) + header
+        padding = b"\0" * (-len(prefix) % 8)
+        directory = os.path.dirname(path) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".blocklist-", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                out.write(prefix + padding)
+                out.write(memoryview(array("Q", self._hashes)).cast("B"))
+                out.write(bytes(self._source_ids))
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    @classmethod
+    def open_snapshot(cls, path: str) -> "BlocklistMatcher":
+        """スナップショットを mmap して照合器を作る。形式が異なる場合は ValueError"""
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < len(MAGIC) + _HEADER_LENGTH.size:
+                raise ValueError("blocklist snapshot is truncated")
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            if mapped[:len(MAGIC)] != MAGIC:
+                raise ValueError("not a blocklist snapshot")
+            offset = len(MAGIC)
+            (header_length,) = _HEADER_LENGTH.unpack_from(mapped, offset)
+            offset += _HEADER_LENGTH.size
+            header = json.loads(mapped[offset:offset + header_length])
+            offset += header_length
+            offset += -offset % 8
+            count = int(header["count"])
+            if header.get("byteorder") != sys.byteorder:
+                raise ValueError("blocklist snapshot was built on a different byte order")
+            if offset + count * 9 != size:
+                raise ValueError("blocklist snapshot size does not match its header")
+            view = memoryview(mapped)
+            hashes = view[offset:offset + count * 8].cast("Q")
+            source_ids = view[offset + count * 8:offset + count * 9]
+        except BaseException:
+            mapped.close()
+            raise
+        return cls(hashes, source_ids, list(header["sources"]), path=path,
+                   built_at=float(header.get("built_at") or 0), _mmap=mapped, _view=view)
+
+    def close(self) -> None:
+        """mmap を解放する（以降この照合器は使えない）"""
+        if self._mmap is None:
+            return
+        for view in (self._hashes, self._source_ids, self._view):
+            if isinstance(view, memoryview):
+                view.release()
+        self._view = None
+        self._hashes, self._source_ids = array("Q"), array("B")
+        self._mmap.close()
+        self._mmap = None
+
+
+# --- バックグラウンド更新 ---
+def parse_blocklist_line(line: str) -> Optional[str]:
+    """
+    ブロックリストの 1 行をドメインに正規化する。コメント・空行・不正な行は None。
+    hosts 形式(例: 0.0.0.0 domain.tld)は最後の列を使う。
+    """
+    line = line.strip()
+    if not line or line.startswith("#") or line.startswith("!"):
+        return None
+    if " " in line or "\t" in line:
+        line = line.split()[-1]
+    domain = line.strip(".").lower()
+    if "." in domain and all(domain.split(".")):
+        return domain
+    return None
+
+
+def iter_domain_file(path: str) -> Iterator[str]:
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line:
+                yield line
+
+
+class BlocklistRefresher:
+    """
+    ブロックリストを定期的に取得し、照合器を差し替えるバックグラウンドタスク。
+    - リストごとに正規化済みのドメイン一覧ファイルと ETag/Last-Modified を cache_dir に保存し、
+      If-None-Match / If-Modified-Since で変更のないリストは再ダウンロードしない
+    - レスポンスは行単位でストリーミング処理し、本文全体をメモリに載せない
+    - どれかのリストが変わったときだけ照合器を作り直し、スナップショットを書き出してから差し替える
+    - 他のワーカーが書き出した新しいスナップショットは、次の確認時に mmap して取り込む
+    """
+
+    def __init__(
+        self,
+        get_client: Callable[[], httpx.AsyncClient],
+        sources: Dict[str, List[str]],
+        snapshot_path: str,
+        cache_dir: str,
+        ttl: float = 24 * 60 * 60.0,
+        retry_interval: float = 300.0,
+        check_interval: float = 300.0,
+        verdict_cache_size: int = 10000,
+    ):
+        self.get_client = get_client
+        self.sources = sources  # {source: [URL, ...]}（dict の順序が優先度）
+        self.snapshot_path = snapshot_path
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.retry_interval = retry_interval
+        self.check_interval = check_interval
+        self.matcher = BlocklistMatcher.empty()
+        self.loaded = False
+        # ドメイン -> 判定結果(一致なしは None)。照合器を差し替えたら破棄する
+        self.verdict_cache_size = verdict_cache_size
+        self._verdicts: "OrderedDict[str, Optional[Tuple[str, str]]]" = OrderedDict()
+        self._retry_failed = False
+        self._task: Optional[asyncio.Task] = None
+
+    def match(self, domain: str) -> Optional[Tuple[str, str]]:
+        """照合結果をドメイン単位で LRU キャッシュする"""
+        try:
+            verdict = self._verdicts[domain]
+        except KeyError:
+            pass
+        else:
+            self._verdicts.move_to_end(domain)
+            return verdict
+        verdict = self.matcher.match(domain)
+        self._verdicts[domain] = verdict
+        if len(self._verdicts) > self.verdict_cache_size:
+            self._verdicts.popitem(last=False)
+        return verdict
+
+    # --- スナップショット ---
+    def snapshot_age(self) -> float:
+        """スナップショットの最終確認からの経過秒数（ない場合は inf）"""
+        try:
+            return time.time() - os.path.getmtime(self.snapshot_path)
+        except OSError:
+            return float("inf")
+
+    def swap(self, matcher: BlocklistMatcher) -> None:
+        """照合器を差し替え、古い照合器の mmap を解放する（照合は同期処理なので使用中に解放されることはない）"""
+        old, self.matcher = self.matcher, matcher
+        self.loaded = True
+        self._verdicts.clear()
+        if old is not matcher:
+            old.close()
+
+    def load_snapshot(self, max_age: Optional[float] = None) -> bool:
+        """
+        スナップショットが max_age 秒以内に確認されたもので、現在の照合器より新しければ mmap して差し替える。
+        max_age=None は古くても読み込む（起動直後、取得が終わるまでのつなぎ）。
+        """
+        if max_age is not None and self.snapshot_age() >= max_age:
+            return False
+        try:
+            matcher = BlocklistMatcher.open_snapshot(self.snapshot_path)
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring blocklist snapshot {self.snapshot_path}: {e}")
+            return False
+        if self.loaded and matcher.built_at <= self.matcher.built_at:
+            matcher.close()
+            return False
+        self.swap(matcher)
+        logger.info(f"Blocklist snapshot mapped: {self.snapshot_path} ({len(matcher)} domains)")
+        return True
+
+    def _build(self, files_by_source: Dict[str, List[str]]) -> BlocklistMatcher:
+        """一覧ファイルから照合器を構築してスナップショットに書き出し、mmap したものを返す（スレッドプールで実行）"""
+        domains = {
+            source: itertools.chain.from_iterable(iter_domain_file(path) for path in paths)
+            for source, paths in files_by_source.items()
+        }
+        BlocklistMatcher.from_domains(domains).write_snapshot(self.snapshot_path)
+        return BlocklistMatcher.open_snapshot(self.snapshot_path)
+
+    # --- 取得 ---
+    def cache_paths(self, url: str) -> Tuple[str, str]:
+        """(正規化済みドメイン一覧, 検証子 JSON) のパス"""
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{key}.txt"), os.path.join(self.cache_dir, f"{key}.json")
+
+    def _read_validators(self, url: str) -> Dict[str, str]:
+        path, meta_path = self.cache_paths(url)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(meta_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    async def fetch(self, url: str) -> bool:
+        """
+        リストを条件付き GET で取得し、一覧ファイルを更新する。
+        変更がなければ(304) False、更新したら True。
+        接続エラーや 429/502/503/504 は指数バックオフで再試行し、それでも失敗したら例外を送出する
+        （前回の一覧ファイルはそのまま残す）。
+        """
+        attempt = 0
+        backoff = 0.3
+        while True:
+            try:
+                return await self._fetch_once(url)
+            except (httpx.RequestError, httpx.HTTPStatusError) as e:
+                transient = not isinstance(e, httpx.HTTPStatusError) or e.response.status_code in _TRANSIENT_STATUSES
+                if not transient or attempt >= FETCH_MAX_RETRIES:
+                    raise
+                await asyncio.sleep(min(backoff, FETCH_MAX_BACKOFF))
+                backoff *= 2
+                attempt += 1
+
+    async def _fetch_once(self, url: str) -> bool:
+        path, meta_path = self.cache_paths(url)
+        validators = self._read_validators(url)
+        headers = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+        async with self.get_client().stream("GET", url, headers=headers) as resp:
+            if resp.status_code == 304:
+                return False
+            resp.raise_for_status()
+            fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=".list-", suffix=".tmp")
+            count = 0
+            try:
+                with os.fdopen(fd, "w", encoding="utf-8") as out:
+                    # 書き込みは行をまとめてスレッドプールで行い、イベントループを止めない
+                    batch: List[str] = []
+                    async for line in resp.aiter_lines():
+                        domain = parse_blocklist_line(line)
+                        if domain:
+                            batch.append(domain + "\n")
+                            if len(batch) >= _WRITE_BATCH_LINES:
+                                await run_in_threadpool(out.writelines, batch)
+                                count += len(batch)
+                                batch = []
+                    if batch:
+                        await run_in_threadpool(out.writelines, batch)
+                        count += len(batch)
+                if not count:
+                    raise ValueError(f"blocklist has no domains: {url}")
+                os.replace(tmp_path, path)
+            except BaseException:
+                try:
+                    os.remove(tmp_path)
+                except FileNotFoundError:
+                    pass
+                raise
+            validators = {
+                "etag": resp.headers.get("etag"),
+                # Last-Modified がなければ取得時刻を使う（サーバーが If-Modified-Since に対応していれば 304 になる）
+                "last_modified": resp.headers.get("last-modified") or formatdate(usegmt=True),
+            }
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({**validators, "count": count, "fetched_at": time.time()}, f)
+        return True
+
+    async def refresh(self) -> float:
+        """
+        必要なら更新し、次に確認するまでの秒数を返す。
+        スナップショットが TTL 内なら(他のワーカーが更新したものを含めて)取り込むだけで取得はしない。
+        """
+        age = self.snapshot_age()
+        if age < self.ttl and not self._retry_failed:
+            self.load_snapshot()
+            return min(self.ttl - age, self.check_interval)
+
+        urls = [url for paths in self.sources.values() for url in paths]
+        results = await asyncio.gather(*(self.fetch(url) for url in urls), return_exceptions=True)
+        changed = False
+        failed = 0
+        self._retry_failed = False
+        for url, result in zip(urls, results):
+            if isinstance(result, BaseException):
+                failed += 1
+                logger.error(f"Blocklist download failed: {url} : {result}")
+            elif result:
+                changed = True
+
+        files_by_source = {
+            source: [self.cache_paths(url)[0] for url in paths if os.path.exists(self.cache_paths(url)[0])]
+            for source, paths in self.sources.items()
+        }
+        if not any(files_by_source.values()):
+            logger.error("Failed to load blocklists: no list has been downloaded yet")
+            return self.retry_interval
+
+        if changed or not self.loaded or not os.path.exists(self.snapshot_path):
+            # 照合器の構築(ハッシュ化・ソート)は CPU を使うためスレッドプールで行い、完成後に差し替える
+            self.swap(await run_in_threadpool(self._build, files_by_source))
+            logger.info(f"Blocklists loaded: {self.matcher.counts()}, ttl={self.ttl}s, failed={failed}")
+        else:
+            # 変更がなければスナップショットの確認時刻だけ更新する
+            os.utime(self.snapshot_path)
+            logger.info(f"Blocklists unchanged (failed={failed})")
+        # 取得に失敗したリストがあれば、TTL を待たずに再試行する
+        self._retry_failed = failed > 0
+        return self.retry_interval if failed else min(self.ttl, self.check_interval)
+
+    # --- タスク管理 ---
+    async def run(self) -> None:
+        while True:
+            try:
+                delay = await self.refresh()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Blocklist refresh failed: {e}", exc_info=True)
+                delay = self.retry_interval
+            await asyncio.sleep(delay)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self.run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except (asyncio.CancelledError, Exception):
+                pass
+            self._task = None
+
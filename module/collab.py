@@ -0,0 +1,864 @@
+"""
+/ws/collaborate/{slide_id} のリアルタイム共同編集。
+
+スライドごとにメモリ上のルームを持ち、要素単位の LWW (Last-Writer-Wins) CRDT で操作をマージする。
+- タイムスタンプは (Lamport 時刻, client_id)。大きい方が勝つため、到着順によらず全員が同じ状態に収束する
+  クライアントが送る Lamport 時刻はルームの時刻 + 1 までに丸める
+- 削除は墓標(tombstone)として時刻を残し、削除より古い操作は無視する
+- ページ・要素の並び順は位置(pos, 小数)の LWW レジスタで表し (pos, id) 順に並べる
+- ドラッグ中の移動・リサイズは短い間隔でまとめ、同じ項目の更新は最後の値だけを配信する
+- マージ済みの状態は定期的に(および最後の接続が切れたときに) Slide.slide_data へ保存する
+- 複数ワーカー構成では、各ワーカーのルームがバックプレーン(module.backplane)経由で操作を交換する。
+  LWW のため適用順によらず同じ状態に収束し、新しく作られたルームは他ワーカーに現在の状態を要求する
+- 接続ごとの送信キューは上限付きで、受信が追いつかないクライアントは切断する(再接続でスナップショットを取り直す)
+
+プロトコル（フレームの形式は module.wsproto。以下は JSON 表記）:
+  サーバー -> クライアント
+    {"type": "snapshot", "client_id": str, "clock": int, "doc": {...}, "page_pos": {...}, "element_pos": {...}}
+    {"type": "ops", "ops": [op, ...]}         他のクライアントの操作（ts 付き）
+    {"type": "ack", "seq": n, "clock": int}    seq 付きメッセージの処理完了
+    {"type": "error", "message": str}
+    {"type": "error", "code": "too_many_ops", "limit": n, "message": str}   1 メッセージの操作数が上限を超えた
+    {"type": "ping"}                           ハートビート（一定時間なにも受信しない接続は切断する）
+    {"type": "batch", "messages": [...]}       1 フレームにまとめた複数のメッセージ
+  クライアント -> サーバー
+    {"type": "ops", "seq": n, "ops": [op, ...]}
+    {"type": "sync"}                           スナップショットの再送
+    {"type": "ping"} / {"type": "pong"}        ping には pong を返す
+  op:
+    {"op": "set", "page": id, "el": id, "path": "content" | "style.left", "value": v, "ts": lamport}
+    {"op": "move", "page": id, "el": id, "style": {"left": x, "top": y, ...}, "ts": lamport}
+    {"op": "insert", "page": id, "el": id, "value": {...要素...}, "pos": float?, "ts": lamport}
+    {"op": "delete", "page": id, "el": id, "ts": lamport}
+    {"op": "el_pos", "page": id, "el": id, "pos": float, "ts": lamport}
+    {"op": "page_insert", "page": id, "value": {...ページ...}, "pos": float?, "ts": lamport}
+    {"op": "page_delete", "page": id, "ts": lamport}
+    {"op": "page_set", "page": id, "path": key, "value": v, "ts": lamport}
+    {"op": "page_pos", "page": id, "pos": float, "ts": lamport}
+    {"op": "settings_set", "path": "settings.backgroundColor" | key, "value": v, "ts": lamport}
+"""
+import asyncio
+import copy
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+from sqlalchemy.orm import selectinload
+
+import module.slidestore as slidestore
+import module.wsproto as wsproto
+from module.backplane import Backplane, InProcessBackplane
+from module.models import Slide
+
+logger = logging.getLogger(__name__)
+
+# ドラッグ・リサイズ操作をまとめて配信する間隔(秒)
+BATCH_INTERVAL = 0.03
+# マージ済みの状態を DB に保存する間隔(秒)
+SNAPSHOT_INTERVAL = 5.0
+# 1 メッセージあたりの操作数の上限
+MAX_OPS_PER_MESSAGE = 500
+# 接続ごとの送信待ちメッセージ数の上限。超えた接続は切断する
+SEND_QUEUE_SIZE = 256
+# 送信キューが溢れた接続を閉じるときのコード (1013: Try Again Later)
+WS_CLOSE_TOO_SLOW = 1013
+# 1 フレームの最短間隔(秒)。前のフレームからこの間に溜まったメッセージは次のフレームにまとめる
+FRAME_INTERVAL = 1 / 60
+# 1 フレームにまとめるメッセージ数の上限
+MAX_FRAME_MESSAGES = 64
+# ハートビートの間隔と、なにも受信しない接続を切断するまでの時間(秒)
+HEARTBEAT_INTERVAL = 20.0
+IDLE_TIMEOUT = 60.0
+# アイドル切断のコード (1001: Going Away)
+WS_CLOSE_IDLE = 1001
+
+# 高頻度に送られるため、同じ項目への更新を最後の 1 件にまとめる項目
+COALESCED_PATHS = {"style.top", "style.left", "style.width", "style.height", "style.rotation"}
+
+Timestamp = Tuple[int, str]
+_ZERO: Timestamp = (0, "")
+
+
+class OpError(ValueError):
+    """不正な操作"""
+
+
+class RoomAccessDenied(Exception):
+    """スライドが存在しない、または参加する権限がない"""
+
+
+def _split_path(path: Any, nested_key: str, forbidden: Tuple[str, ...]) -> List[str]:
+    """
+    "key" または "<nested_key>.key" 形式のパスを検証して分割する。
+    nested_key (style/settings) はオブジェクト全体の置き換えを許可しない（項目ごとのレジスタと競合するため）。
+    """
+    if not isinstance(path, str) or not path:
+        raise OpError("path must be a non-empty string")
+    parts = path.split(".")
+    if parts[0] in forbidden:
+        raise OpError(f"path is not editable: {path}")
+    if parts[0] == nested_key:
+        if len(parts) != 2 or not parts[1]:
+            raise OpError(f"path must be '{nested_key}.<key>': {path}")
+    elif len(parts) != 1:
+        raise OpError(f"nested path is not supported: {path}")
+    return parts
+
+
+def _get_path(target: Dict[str, Any], path: str) -> Any:
+    parts = path.split(".")
+    if len(parts) == 2:
+        nested = target.get(parts[0])
+        return nested.get(parts[1]) if isinstance(nested, dict) else None
+    return target.get(parts[0])
+
+
+def _set_path(target: Dict[str, Any], parts: List[str], value: Any) -> None:
+    if len(parts) == 2:
+        nested = target.get(parts[0])
+        if not isinstance(nested, dict):
+            nested = target[parts[0]] = {}
+        nested[parts[1]] = value
+    else:
+        target[parts[0]] = value
+
+
+def _require_id(op: Dict[str, Any], key: str) -> str:
+    value = op.get(key)
+    if not isinstance(value, (str, int)) or isinstance(value, bool) or value == "":
+        raise OpError(f"'{key}' is required")
+    return str(value)
+
+
+def _optional_pos(op: Dict[str, Any]) -> Optional[float]:
+    pos = op.get("pos")
+    if pos is None:
+        return None
+    if isinstance(pos, bool) or not isinstance(pos, (int, float)):
+        raise OpError("'pos' must be a number")
+    return float(pos)
+
+
+class Connection:
+    """
+    WebSocket 接続。送信は上限付きのキューを経由して専用タスクで行い、
+    受信の遅いクライアントのためにサーバーのメモリが増え続けないようにする。
+    送信はフレーム時間単位でまとめ、ハートビートで応答のない接続を切断する。
+    """
+
+    def __init__(self, websocket: Any, user_id: int, max_queue: int = SEND_QUEUE_SIZE, codec: str = wsproto.CODEC_JSON):
+        self.websocket = websocket
+        self.user_id = user_id
+        self.codec = codec
+        self.client_id = uuid.uuid4().hex[:12]
+        self.overflowed = False
+        self.last_seen = time.monotonic()
+        self._queue: asyncio.Queue = asyncio.Queue(max_queue)
+        self._writer: Optional[asyncio.Task] = None
+        self._heartbeat: Optional[asyncio.Task] = None
+
+    def send(self, message: Dict[str, Any]) -> bool:
+        """送信キューに積む。キューが溢れた場合は接続を閉じて False を返す"""
+        if self.overflowed:
+            return False
+        try:
+            self._queue.put_nowait(message)
+        except asyncio.QueueFull:
+            self._overflow()
+            return False
+        return True
+
+    def touch(self) -> None:
+        """クライアントからフレームを受信した"""
+        self.last_seen = time.monotonic()
+
+    def start(self) -> None:
+        """accept 後に送信・ハートビートのタスクを開始する（それまでのメッセージはキューに溜まる）"""
+        if self._writer is None and not self.overflowed:
+            loop = asyncio.get_running_loop()
+            self._writer = loop.create_task(self._write_loop())
+            self._heartbeat = loop.create_task(self._heartbeat_loop())
+
+    async def _write_loop(self) -> None:
+        next_frame = 0.0
+        while True:
+            messages = [await self._queue.get()]
+            # 直前のフレームから FRAME_INTERVAL 経っていなければ待ち、その間に溜まった分をまとめて送る
+            delay = next_frame - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            while len(messages) < MAX_FRAME_MESSAGES and not self._queue.empty():
+                messages.append(self._queue.get_nowait())
+            try:
+                data = wsproto.encode(self.codec, wsproto.pack_frame(messages))
+            except (TypeError, ValueError, OverflowError) as e:
+                # エンコードできないメッセージはこのフレームだけ捨て、接続は維持する
+                logger.warning(f"Dropping an unencodable collaboration frame (client {self.client_id}): {e}")
+                continue
+            try:
+                if isinstance(data, bytes):
+                    await self.websocket.send_bytes(data)
+                else:
+                    await self.websocket.send_text(data)
+            except Exception as e:
+                logger.info(f"Collaboration send failed (client {self.client_id}): {e}")
+                return
+            next_frame = time.monotonic() + FRAME_INTERVAL
+
+    async def _heartbeat_loop(self) -> None:
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            if time.monotonic() - self.last_seen > IDLE_TIMEOUT:
+                logger.info(f"Collaboration client {self.client_id} is idle; closing the connection")
+                self.stop()
+                await self._close(WS_CLOSE_IDLE, "Idle timeout")
+                return
+            self.send({"type": "ping"})
+
+    def _overflow(self) -> None:
+        self.overflowed = True
+        logger.warning(f"Collaboration client {self.client_id} is too slow; closing the connection")
+        while not self._queue.empty():
+            self._queue.get_nowait()
+        self.stop()
+        asyncio.get_running_loop().create_task(self._close(WS_CLOSE_TOO_SLOW, "Client too slow"))
+
+    async def _close(self, code: int, reason: str) -> None:
+        try:
+            await self.websocket.close(code=code, reason=reason)
+        except Exception:
+            pass
+
+    def stop(self) -> None:
+        current = asyncio.current_task()
+        for task in (self._writer, self._heartbeat):
+            if task is not None and task is not current:
+                task.cancel()
+        self._writer = self._heartbeat = None
+
+
+class Room:
+    """1 枚のスライド(デッキ)の共同編集状態"""
+
+    def __init__(
+        self,
+        slide_id: int,
+        owner_id: int,
+        document: Dict[str, Any],
+        session_factory: Callable[[], Any],
+        backplane: Optional[Backplane] = None,
+        worker_id: str = "",
+    ):
+        self.slide_id = slide_id
+        self.owner_id = owner_id
+        self.session_factory = session_factory
+        self.backplane = backplane
+        self.worker_id = worker_id
+        self.channel = f"collab:{slide_id}"
+        self.connections: Dict[str, Connection] = {}
+        self.clock = 0
+        self.dirty = False
+
+        # LWW レジスタの時刻。キーは ("settings", path) / ("page", pid, path) / ("page_exists", pid) /
+        # ("page_pos", pid) / ("el", pid, eid, path) / ("el_exists", pid, eid) / ("el_pos", pid, eid)
+        self.clocks: Dict[tuple, Timestamp] = {}
+        self.outline: Dict[str, Any] = {}
+        self.pages: Dict[str, Dict[str, Any]] = {}  # pid -> elements を除いたページ
+        self.page_pos: Dict[str, float] = {}
+        self.elements: Dict[str, Dict[str, Dict[str, Any]]] = {}  # pid -> eid -> 要素
+        self.element_pos: Dict[str, Dict[str, float]] = {}
+        self._load(document)
+
+        # 配信待ちの (操作, このワーカーの接続から来たか)。まとめられる操作は同じキーで上書きする
+        self._outbox: "OrderedDict[Any, Tuple[Dict[str, Any], bool]]" = OrderedDict()
+        self._outbox_seq = 0
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+        self._flush_lock = asyncio.Lock()
+        self._save_lock = asyncio.Lock()
+        self._snapshot_task: Optional[asyncio.Task] = None
+        self._start_task: Optional[asyncio.Task] = None
+
+    # --- 状態の読み込み・書き出し ---
+    def _load(self, document: Dict[str, Any]) -> None:
+        pages = document.get("slides") if isinstance(document.get("slides"), list) else []
+        self.outline = {key: value for key, value in document.items() if key != "slides"}
+        for index, page in enumerate(pages):
+            if not isinstance(page, dict):
+                continue
+            page = dict(page)
+            pid = str(page.get("id") or f"slide-{uuid.uuid4().hex[:12]}")
+            page["id"] = pid
+            elements = page.pop("elements", None)
+            self.pages[pid] = page
+            self.page_pos[pid] = float(index)
+            self.elements[pid] = {}
+            self.element_pos[pid] = {}
+            for el_index, element in enumerate(elements if isinstance(elements, list) else []):
+                if not isinstance(element, dict):
+                    continue
+                element = dict(element)
+                eid = str(element.get("id") or f"el-{uuid.uuid4().hex[:12]}")
+                element["id"] = eid
+                self.elements[pid][eid] = element
+                self.element_pos[pid][eid] = float(el_index)
+
+    def materialize(self) -> Dict[str, Any]:
+        """現在の状態をプレゼンテーション JSON として組み立てる"""
+        slides = []
+        for pid in sorted(self.pages, key=lambda p: (self.page_pos[p], p)):
+            page = dict(self.pages[pid])
+            positions = self.element_pos[pid]
+            page["elements"] = [
+                self.elements[pid][eid] for eid in sorted(self.elements[pid], key=lambda e: (positions[e], e))
+            ]
+            slides.append(page)
+        return {**self.outline, "slides": slides}
+
+    def snapshot_message(self, connection: Connection) -> Dict[str, Any]:
+        return {
+            "type": "snapshot",
+            "client_id": connection.client_id,
+            "clock": self.clock,
+            "doc": self.materialize(),
+            "page_pos": dict(self.page_pos),
+            "element_pos": {pid: dict(positions) for pid, positions in self.element_pos.items()},
+        }
+
+    # --- 操作の適用 ---
+    def _accept(self, key: tuple, ts: Timestamp) -> bool:
+        if ts <= self.clocks.get(key, _ZERO):
+            return False
+        self.clocks[key] = ts
+        return True
+
+    def _next_element_pos(self, pid: str) -> float:
+        positions = self.element_pos.get(pid) or {}
+        return max(positions.values(), default=-1.0) + 1.0
+
+    def _insert_element(self, pid: str, eid: str, value: Dict[str, Any], pos: Optional[float], ts: Timestamp) -> float:
+        element = copy.deepcopy(value)
+        element["id"] = eid
+        self.elements[pid][eid] = element
+        pos = self._next_element_pos(pid) if pos is None else pos
+        self.element_pos[pid][eid] = pos
+        self.clocks[("el_pos", pid, eid)] = ts
+        # 挿入より古いフィールド更新は無視する
+        for key, field_value in element.items():
+            if key == "style" and isinstance(field_value, dict):
+                for style_key in field_value:
+                    self.clocks[("el", pid, eid, f"style.{style_key}")] = ts
+            elif key != "id":
+                self.clocks[("el", pid, eid, key)] = ts
+        return pos
+
+    def apply(self, op: Dict[str, Any], client_id: str) -> List[Dict[str, Any]]:
+        """
+        1 件の操作を適用し、配信すべき(採用された)操作のリストを返す。
+        LWW で負けた操作は状態を変えずに空リストを返す。不正な操作は OpError。
+        """
+        if not isinstance(op, dict):
+            raise OpError("op must be an object")
+        kind = op.get("op")
+        lamport = op.get("ts")
+        if lamport is None:
+            lamport = self.clock + 1
+        if isinstance(lamport, bool) or not isinstance(lamport, int) or lamport < 0:
+            raise OpError("'ts' must be a non-negative integer")
+        ts: Timestamp = (lamport, client_id)
+        self.clock = max(self.clock, lamport)
+        stamped = {"ts": [lamport, client_id]}
+
+        if kind == "move":
+            style = op.get("style")
+            if not isinstance(style, dict) or not style:
+                raise OpError("'style' must be a non-empty object")
+            accepted: List[Dict[str, Any]] = []
+            for key, value in style.items():
+                accepted += self.apply(
+                    {"op": "set", "page": op.get("page"), "el": op.get("el"),
+                     "path": f"style.{key}", "value": value, "ts": lamport},
+                    client_id,
+                )
+            return accepted
+
+        if kind == "settings_set":
+            parts = _split_path(op.get("path"), "settings", ("slides",))
+            if not self._accept(("settings", op["path"]), ts):
+                return []
+            _set_path(self.outline, parts, copy.deepcopy(op.get("value")))
+            return [{"op": kind, "path": op["path"], "value": op.get("value"), **stamped}]
+
+        pid = _require_id(op, "page")
+
+        if kind == "page_insert":
+            value = op.get("value") or {}
+            if not isinstance(value, dict):
+                raise OpError("'value' must be an object")
+            if not self._accept(("page_exists", pid), ts):
+                return []
+            page = {key: copy.deepcopy(field) for key, field in value.items() if key != "elements"}
+            page["id"] = pid
+            self.pages[pid] = page
+            pos = _optional_pos(op)
+            if pos is None:
+                pos = max(self.page_pos.values(), default=-1.0) + 1.0
+            self.page_pos[pid] = pos
+            self.clocks[("page_pos", pid)] = ts
+            for key in page:
+                if key != "id":
+                    self.clocks[("page", pid, key)] = ts
+            self.elements[pid] = {}
+            self.element_pos[pid] = {}
+            elements = value.get("elements")
+            element_pos = op.get("element_pos") if isinstance(op.get("element_pos"), dict) else {}
+            for el_index, element in enumerate(elements if isinstance(elements, list) else []):
+                if isinstance(element, dict):
+                    eid = str(element.get("id") or f"el-{uuid.uuid4().hex[:12]}")
+                    el_pos = element_pos.get(eid)
+                    if isinstance(el_pos, bool) or not isinstance(el_pos, (int, float)):
+                        el_pos = el_index
+                    self.clocks[("el_exists", pid, eid)] = ts
+                    self._insert_element(pid, eid, element, float(el_pos), ts)
+            materialized = dict(page)
+            materialized["elements"] = [
+                self.elements[pid][eid]
+                for eid in sorted(self.elements[pid], key=lambda e: (self.element_pos[pid][e], e))
+            ]
+            return [{
+                "op": kind, "page": pid, "value": materialized, "pos": pos,
+                "element_pos": dict(self.element_pos[pid]), **stamped,
+            }]
+
+        if kind == "page_delete":
+            if not self._accept(("page_exists", pid), ts):
+                return []
+            self.pages.pop(pid, None)
+            self.page_pos.pop(pid, None)
+            self.elements.pop(pid, None)
+            self.element_pos.pop(pid, None)
+            return [{"op": kind, "page": pid, **stamped}]
+
+        if pid not in self.pages:
+            # 削除済み・未知のページへの操作は無視する
+            return []
+
+        if kind == "page_set":
+            parts = _split_path(op.get("path"), "", ("id", "elements"))
+            if not self._accept(("page", pid, op["path"]), ts):
+                return []
+            _set_path(self.pages[pid], parts, copy.deepcopy(op.get("value")))
+            return [{"op": kind, "page": pid, "path": op["path"], "value": op.get("value"), **stamped}]
+
+        if kind == "page_pos":
+            pos = _optional_pos(op)
+            if pos is None:
+                raise OpError("'pos' is required")
+            if not self._accept(("page_pos", pid), ts):
+                return []
+            self.page_pos[pid] = pos
+            return [{"op": kind, "page": pid, "pos": pos, **stamped}]
+
+        eid = _require_id(op, "el")
+
+        if kind == "insert":
+            value = op.get("value")
+            if not isinstance(value, dict):
+                raise OpError("'value' must be an object")
+            if not self._accept(("el_exists", pid, eid), ts):
+                return []
+            pos = self._insert_element(pid, eid, value, _optional_pos(op), ts)
+            return [{"op": kind, "page": pid, "el": eid, "value": self.elements[pid][eid], "pos": pos, **stamped}]
+
+        if kind == "delete":
+            if not self._accept(("el_exists", pid, eid), ts):
+                return []
+            self.elements[pid].pop(eid, None)
+            self.element_pos[pid].pop(eid, None)
+            return [{"op": kind, "page": pid, "el": eid, **stamped}]
+
+        if eid not in self.elements[pid]:
+            return []
+
+        if kind == "set":
+            parts = _split_path(op.get("path"), "style", ("id",))
+            if not self._accept(("el", pid, eid, op["path"]), ts):
+                return []
+            _set_path(self.elements[pid][eid], parts, copy.deepcopy(op.get("value")))
+            return [{"op": kind, "page": pid, "el": eid, "path": op["path"], "value": op.get("value"), **stamped}]
+
+        if kind == "el_pos":
+            pos = _optional_pos(op)
+            if pos is None:
+                raise OpError("'pos' is required")
+            if not self._accept(("el_pos", pid, eid), ts):
+                return []
+            self.element_pos[pid][eid] = pos
+            return [{"op": kind, "page": pid, "el": eid, "pos": pos, **stamped}]
+
+        raise OpError(f"unsupported op: {kind}")
+
+    def apply_remote(self, op: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """他ワーカーから届いた、採用済み(ts が [lamport, client_id])の操作を適用する"""
+        ts = op.get("ts") if isinstance(op, dict) else None
+        if not isinstance(ts, list) or len(ts) != 2 or not isinstance(ts[1], str):
+            raise OpError("remote op must carry [lamport, client_id]")
+        return self.apply({**op, "ts": ts[0]}, ts[1])
+
+    def state_ops(self) -> List[Dict[str, Any]]:
+        """
+        初期状態から変更されたレジスタ(墓標を含む)を、時刻付きの操作列として書き出す。
+        他ワーカーで新しく作られたルームが適用すると同じ状態に収束する。
+        """
+        order = {"settings": 0, "page_exists": 1, "page": 2, "page_pos": 2, "el_exists": 3, "el": 4, "el_pos": 4}
+        ops: List[Dict[str, Any]] = []
+        for key, ts in sorted(self.clocks.items(), key=lambda item: order[item[0][0]]):
+            kind, stamped = key[0], {"ts": [ts[0], ts[1]]}
+            if kind == "settings":
+                ops.append({"op": "settings_set", "path": key[1], "value": _get_path(self.outline, key[1]), **stamped})
+                continue
+            pid = key[1]
+            if kind == "page_exists":
+                if pid in self.pages:
+                    ops.append({"op": "page_insert", "page": pid, "value": self.pages[pid], "pos": self.page_pos[pid], **stamped})
+                else:
+                    ops.append({"op": "page_delete", "page": pid, **stamped})
+                continue
+            if pid not in self.pages:
+                continue
+            if kind == "page":
+                ops.append({"op": "page_set", "page": pid, "path": key[2], "value": _get_path(self.pages[pid], key[2]), **stamped})
+            elif kind == "page_pos":
+                ops.append({"op": "page_pos", "page": pid, "pos": self.page_pos[pid], **stamped})
+            elif kind == "el_exists":
+                eid = key[2]
+                if eid in self.elements[pid]:
+                    ops.append({
+                        "op": "insert", "page": pid, "el": eid, "value": self.elements[pid][eid],
+                        "pos": self.element_pos[pid][eid], **stamped,
+                    })
+                else:
+                    ops.append({"op": "delete", "page": pid, "el": key[2], **stamped})
+            elif key[2] in self.elements[pid]:
+                eid = key[2]
+                if kind == "el":
+                    ops.append({
+                        "op": "set", "page": pid, "el": eid, "path": key[3],
+                        "value": _get_path(self.elements[pid][eid], key[3]), **stamped,
+                    })
+                else:
+                    ops.append({"op": "el_pos", "page": pid, "el": eid, "pos": self.element_pos[pid][eid], **stamped})
+        return ops
+
+    # --- 配信 ---
+    def _enqueue(self, op: Dict[str, Any], local: bool) -> bool:
+        """配信待ちに追加し、まとめて送れる操作なら True を返す"""
+        coalesce = op["op"] == "set" and op["path"] in COALESCED_PATHS
+        if coalesce:
+            key: Any = ("set", op["page"], op["el"], op["path"])
+            self._outbox.pop(key, None)
+        else:
+            self._outbox_seq += 1
+            key = self._outbox_seq
+        self._outbox[key] = (op, local)
+        return coalesce
+
+    def _schedule_flush(self, delay: float) -> None:
+        loop = asyncio.get_running_loop()
+        if delay <= 0:
+            if self._flush_handle is not None:
+                self._flush_handle.cancel()
+            self._flush_handle = None
+            loop.create_task(self.flush())
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(delay, lambda: loop.create_task(self.flush()))
+
+    async def flush(self) -> None:
+        """
+        配信待ちの操作を、送信元以外の接続へまとめて送る。
+        このワーカーの接続から来た操作はバックプレーンにも流す。
+        """
+        async with self._flush_lock:
+            self._flush_handle = None
+            if not self._outbox:
+                return
+            entries = list(self._outbox.values())
+            self._outbox.clear()
+            ops = [op for op, _ in entries]
+            for connection in list(self.connections.values()):
+                peer_ops = [op for op in ops if op["ts"][1] != connection.client_id]
+                if peer_ops:
+                    connection.send({"type": "ops", "ops": peer_ops})
+            local_ops = [op for op, local in entries if local]
+            if local_ops:
+                await self._publish({"type": "ops", "ops": local_ops})
+
+    async def _publish(self, message: Dict[str, Any]) -> None:
+        if self.backplane is None:
+            return
+        try:
+            await self.backplane.publish(self.channel, {**message, "worker": self.worker_id})
+        except Exception as e:
+            logger.warning(f"Collaboration backplane publish failed (slide {self.slide_id}): {e}")
+
+    async def on_backplane_message(self, message: Dict[str, Any]) -> None:
+        """他ワーカーのルームからのメッセージを処理する"""
+        if message.get("worker") == self.worker_id:
+            return
+        kind = message.get("type")
+        if kind == "sync_request":
+            ops = self.state_ops()
+            if ops:
+                await self._publish({"type": "ops", "ops": ops})
+            return
+        if kind != "ops" or not isinstance(message.get("ops"), list):
+            return
+        immediate = False
+        for op in message["ops"]:
+            try:
+                accepted = self.apply_remote(op)
+            except OpError as e:
+                logger.warning(f"Ignoring invalid remote op (slide {self.slide_id}): {e}")
+                continue
+            for accepted_op in accepted:
+                # 保存は操作を受け付けたワーカーが行う
+                if not self._enqueue(accepted_op, local=False):
+                    immediate = True
+        if self._outbox:
+            self._schedule_flush(0 if immediate else BATCH_INTERVAL)
+
+    def _clamp_ts(self, op: Any) -> Any:
+        """
+        クライアントの ts は現在の時刻 + 1 までに制限する。
+        極端に大きな ts を送って以降の競合にすべて勝つことを防ぐ（他ワーカーから届く採用済みの ts は制限しない）。
+        """
+        if isinstance(op, dict):
+            lamport = op.get("ts")
+            if isinstance(lamport, int) and not isinstance(lamport, bool) and lamport > self.clock + 1:
+                return {**op, "ts": self.clock + 1}
+        return op
+
+    async def handle_message(self, connection: Connection, message: Any) -> None:
+        if not isinstance(message, dict):
+            connection.send({"type": "error", "message": "message must be an object"})
+            return
+        kind = message.get("type")
+        if kind == "ping":
+            connection.send({"type": "pong"})
+            return
+        if kind == "pong":
+            return
+        if kind == "sync":
+            connection.send(self.snapshot_message(connection))
+            return
+        if kind != "ops":
+            connection.send({"type": "error", "message": f"unsupported message type: {kind}"})
+            return
+
+        ops = message.get("ops")
+        if not isinstance(ops, list):
+            connection.send({"type": "error", "message": "'ops' must be an array"})
+            return
+        if len(ops) > MAX_OPS_PER_MESSAGE:
+            # 不正なフレームと区別できるよう、上限超過は専用のコードで返す（クライアントは分割して再送する）
+            connection.send({
+                "type": "error", "code": "too_many_ops", "limit": MAX_OPS_PER_MESSAGE,
+                "message": f"too many ops in one message (limit: {MAX_OPS_PER_MESSAGE})",
+            })
+            return
+        immediate = False
+        errors = []
+        for op in ops:
+            try:
+                accepted = self.apply(self._clamp_ts(op), connection.client_id)
+            except OpError as e:
+                errors.append(str(e))
+                continue
+            for accepted_op in accepted:
+                self.dirty = True
+                if not self._enqueue(accepted_op, local=True):
+                    immediate = True
+        if self._outbox:
+            self._schedule_flush(0 if immediate else BATCH_INTERVAL)
+        if errors:
+            connection.send({"type": "error", "message": "; ".join(errors[:10])})
+        if "seq" in message:
+            connection.send({"type": "ack", "seq": message["seq"], "clock": self.clock})
+
+    # --- 永続化 ---
+    def begin_start(self) -> asyncio.Task:
+        """start() を一度だけ開始し、そのタスクを返す（参加者はそれぞれこれを待つ）"""
+        if self._start_task is None:
+            self._start_task = asyncio.get_running_loop().create_task(self.start())
+        return self._start_task
+
+    async def start(self) -> None:
+        self._snapshot_task = asyncio.get_running_loop().create_task(self._snapshot_loop())
+        if self.backplane is not None:
+            await self.backplane.subscribe(self.channel, self.on_backplane_message)
+            # 他のワーカーで編集中であれば、まだ保存されていない変更を含む状態を送ってもらう
+            await self._publish({"type": "sync_request"})
+
+    async def _snapshot_loop(self) -> None:
+        while True:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            try:
+                await self.save()
+            except Exception as e:
+                logger.error(f"Collaboration snapshot failed (slide {self.slide_id}): {e}", exc_info=True)
+
+    async def save(self) -> None:
+        """変更があればマージ済みの状態を Slide に保存し、version を進める"""
+        async with self._save_lock:
+            if not self.dirty:
+                return
+            self.dirty = False
+            document = self.materialize()
+            try:
+                async with self.session_factory() as db:
+                    result = await db.execute(
+                        select(Slide).options(selectinload(Slide.pages)).where(Slide.id == self.slide_id)
+                    )
+                    slide = result.scalars().first()
+                    if slide is None:
+                        return
+                    slidestore.save_document(slide, document)
+                    slide.version = Slide.version + 1  # type: ignore
+                    await db.commit()
+            except BaseException:
+                self.dirty = True
+                raise
+
+    async def close(self) -> None:
+        if self._start_task is not None and not self._start_task.done():
+            # 購読の途中で閉じると、解除の後に購読が残ってしまう
+            await asyncio.wait([self._start_task])
+        if self._snapshot_task is not None:
+            self._snapshot_task.cancel()
+            self._snapshot_task = None
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        await self.flush()
+        if self.backplane is not None:
+            try:
+                await self.backplane.unsubscribe(self.channel, self.on_backplane_message)
+            except Exception as e:
+                logger.warning(f"Collaboration backplane unsubscribe failed (slide {self.slide_id}): {e}")
+        await self.save()
+
+
+class CollabManager:
+    """スライドごとのルームを管理する"""
+
+    def __init__(self, session_factory: Callable[[], Any], backplane: Optional[Backplane] = None):
+        self.session_factory = session_factory
+        self.backplane = backplane or InProcessBackplane()
+        # バックプレーン上で自分の送ったメッセージを見分けるための ID
+        self.worker_id = uuid.uuid4().hex
+        self.rooms: Dict[int, Room] = {}
+        # 最後の接続が切れて保存中のルーム。保存が終わるまで同じスライドのルームを作り直さない
+        self._closing: Dict[int, asyncio.Task] = {}
+        # ルームを閉じるたびに進める。ロック外で読み込んだ文書が古くなっていないかの確認に使う
+        self._epoch = 0
+        self._lock = asyncio.Lock()
+
+    async def _load_document(self, slide_id: int, user_id: int) -> Dict[str, Any]:
+        async with self.session_factory() as db:
+            result = await db.execute(
+                select(Slide).options(selectinload(Slide.pages)).where(Slide.id == slide_id)
+            )
+            slide = result.scalars().first()
+            if slide is None or slide.owner_id != user_id:
+                raise RoomAccessDenied(slide_id)
+            try:
+                document = slidestore.load_document(slide)
+            except ValueError:
+                document = None
+        if not isinstance(document, dict):
+            raise RoomAccessDenied(slide_id)
+        return document
+
+    async def join(
+        self, slide_id: int, websocket: Any, user_id: int, codec: str = wsproto.CODEC_JSON
+    ) -> Tuple[Room, Connection]:
+        """
+        ルームに参加する（なければ DB から読み込んで作成）。
+        現状はスライドの所有者のみ参加できる（複数端末・複数タブからの同時編集）。
+        最初のメッセージとしてスナップショットを送信キューに積む。以降の操作は必ずその後に届く。
+        """
+        room, connection = await self._register(slide_id, websocket, user_id, codec)
+        # バックプレーンの購読はロックの外で待ち、他のルームの参加・退出を待たせない
+        try:
+            await asyncio.shield(room.begin_start())
+        except Exception:
+            await self.leave(room, connection)
+            raise
+        return room, connection
+
+    async def _register(self, slide_id: int, websocket: Any, user_id: int, codec: str) -> Tuple[Room, Connection]:
+        while True:
+            async with self._lock:
+                room = self.rooms.get(slide_id)
+                if room is not None:
+                    return self._attach(room, websocket, user_id, codec)
+                closing = self._closing.get(slide_id)
+                epoch = self._epoch
+            if closing is not None and not closing.done():
+                # 前のルームの最後の保存が終わってから読み込む（古い状態で上書きしないため）
+                await asyncio.wait([closing])
+                continue
+            # DB からの読み込みはロックの外で行い、他のルームの参加・退出を待たせない
+            document = await self._load_document(slide_id, user_id)
+            async with self._lock:
+                room = self.rooms.get(slide_id)
+                if room is None:
+                    if self._epoch != epoch:
+                        # 読み込み中に閉じられたルームがあれば、保存後の状態を読み直す
+                        continue
+                    room = Room(slide_id, user_id, document, self.session_factory, self.backplane, self.worker_id)
+                    self.rooms[slide_id] = room
+                return self._attach(room, websocket, user_id, codec)
+
+    def _attach(self, room: Room, websocket: Any, user_id: int, codec: str) -> Tuple[Room, Connection]:
+        if room.owner_id != user_id:
+            raise RoomAccessDenied(room.slide_id)
+        connection = Connection(websocket, user_id, codec=codec)
+        connection.send(room.snapshot_message(connection))
+        room.connections[connection.client_id] = connection
+        return room, connection
+
+    async def leave(self, room: Room, connection: Connection) -> None:
+        """接続を外し、最後の接続であればルームを閉じて保存する"""
+        connection.stop()
+        async with self._lock:
+            room.connections.pop(connection.client_id, None)
+            if room.connections or self.rooms.get(room.slide_id) is not room:
+                return
+            del self.rooms[room.slide_id]
+            self._epoch += 1
+            task = asyncio.get_running_loop().create_task(room.close())
+            self._closing[room.slide_id] = task
+            task.add_done_callback(lambda done: self._forget_closing(room.slide_id, done))
+        # 接続側のタスクがキャンセルされても最後の保存は完了させる
+        await asyncio.shield(task)
+
+    def _forget_closing(self, slide_id: int, task: asyncio.Task) -> None:
+        if self._closing.get(slide_id) is task:
+            del self._closing[slide_id]
+
+    async def close(self) -> None:
+        async with self._lock:
+            rooms = list(self.rooms.values())
+            self.rooms.clear()
+            closing = list(self._closing.values())
+        if closing:
+            await asyncio.wait(closing)
+        for room in rooms:
+            try:
+                await room.close()
+            except Exception as e:
+                logger.error(f"Failed to close collaboration room {room.slide_id}: {e}", exc_info=True)
+        await self.backplane.close()
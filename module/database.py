@@ -1,21 +1,182 @@
 import os
-from sqlalchemy import create_engine
+from typing import Any, Dict
+
+from sqlalchemy import create_engine, event, inspect, make_url, text
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./data/data.db")
 
-engine = create_engine(
-    DATABASE_URL, connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
-)
+# 同期ドライバの URL を対応する非同期ドライバの URL に変換する
+_ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "postgres": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+def to_async_url(url: str) -> str:
+    scheme, sep, rest = url.partition("://")
+    if not sep or "+" in scheme:
+        # ドライバ指定済み(例: postgresql+asyncpg)の場合はそのまま使う
+        return url
+    return f"{_ASYNC_DRIVERS.get(scheme, scheme)}://{rest}"
+
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or to_async_url(DATABASE_URL)
+
+# --- 接続プール ---
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# 読み取り専用プール: DATABASE_READ_URL (レプリカ等) を指定するか、
+# SQLite ファイルの場合は DB_READ_POOL=1 で同じファイルを mode=ro で開く別プールを使う
+DATABASE_READ_URL = os.getenv("DATABASE_READ_URL")
+DB_READ_POOL = os.getenv("DB_READ_POOL", "0") == "1"
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", str(DB_POOL_SIZE)))
+
+# --- SQLite ---
+# "production": 接続ごとに下記 PRAGMA を設定する / "default": SQLite の既定値のまま
+SQLITE_PROFILE = os.getenv("SQLITE_PROFILE", "production")
+SQLITE_PRAGMAS = [
+    # WAL: 読み取りと書き込みが互いをブロックしない
+    ("journal_mode", "WAL"),
+    # WAL では NORMAL でも破損しない（電源断時に直近のコミットが失われうるのみ）
+    ("synchronous", "NORMAL"),
+    # ロック取得をすぐに諦めず待つ ("database is locked" の回避)
+    ("busy_timeout", os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+    ("mmap_size", os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    # 負の値は KiB 単位
+    ("cache_size", str(-int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536")))),
+    ("temp_store", "MEMORY"),
+]
+
+def is_sqlite_url(url: str) -> bool:
+    return make_url(url).get_backend_name() == "sqlite"
+
+def is_sqlite_memory_url(url: str) -> bool:
+    parsed = make_url(url)
+    return parsed.database in (None, "", ":memory:") or parsed.query.get("mode") == "memory"
+
+def to_read_only_url(url: str) -> str:
+    """SQLite ファイルの URL を読み取り専用(mode=ro)の URI 形式に変換する"""
+    parsed = make_url(url)
+    database = parsed.database or ""
+    if not database.startswith("file:"):
+        database = f"file:{database}"
+    return parsed.set(
+        database=database, query={**parsed.query, "mode": "ro", "uri": "true"}
+    ).render_as_string(hide_password=False)
+
+def configure_sqlite_engine(sync_engine, *, read_only: bool = False) -> None:
+    """SQLITE_PRAGMAS を接続ごとに設定する（非同期エンジンは .sync_engine を渡す）"""
+
+    @event.listens_for(sync_engine, "connect")
+    def _set_sqlite_pragmas(dbapi_connection, _connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in SQLITE_PRAGMAS:
+                # journal_mode はファイルに記録されるため書き込み側の接続で設定する
+                if read_only and name == "journal_mode":
+                    continue
+                cursor.execute(f"PRAGMA {name}={value}")
+            if read_only:
+                cursor.execute("PRAGMA query_only=ON")
+        finally:
+            cursor.close()
+
+def _engine_options(url: str, pool_size: int = DB_POOL_SIZE) -> Dict[str, Any]:
+    options: Dict[str, Any] = {}
+    if is_sqlite_url(url):
+        options["connect_args"] = {"check_same_thread": False}
+        if is_sqlite_memory_url(url):
+            # インメモリ DB は接続ごとに別の DB になるため既定のプールのまま使う
+            return options
+    options.update(pool_size=pool_size, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    return options
+
+def _tune_engine(url: str, sync_engine, *, read_only: bool = False) -> None:
+    if SQLITE_PROFILE == "production" and is_sqlite_url(url) and not is_sqlite_memory_url(url):
+        configure_sqlite_engine(sync_engine, read_only=read_only)
+
+engine = create_engine(DATABASE_URL, **_engine_options(DATABASE_URL))
+_tune_engine(DATABASE_URL, engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# リクエストハンドラ用の非同期エンジン。DB の待ち時間中も他のリクエストを処理できる
+async_engine = create_async_engine(ASYNC_DATABASE_URL, **_engine_options(ASYNC_DATABASE_URL))
+_tune_engine(ASYNC_DATABASE_URL, async_engine.sync_engine)
+# commit 後に属性を失効させると、レスポンス生成時に暗黙の再読込(同期 I/O)が発生するため無効にする
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False)
+
+# 読み取り専用のエンドポイント(一覧・閲覧)用。書き込みの多い自動保存とプールを分け、互いに待たされないようにする
+if DATABASE_READ_URL:
+    ASYNC_DATABASE_READ_URL = to_async_url(DATABASE_READ_URL)
+elif DB_READ_POOL and is_sqlite_url(ASYNC_DATABASE_URL) and not is_sqlite_memory_url(ASYNC_DATABASE_URL):
+    ASYNC_DATABASE_READ_URL = to_read_only_url(ASYNC_DATABASE_URL)
+else:
+    ASYNC_DATABASE_READ_URL = None
+
+if ASYNC_DATABASE_READ_URL:
+    async_read_engine = create_async_engine(
+        ASYNC_DATABASE_READ_URL, **_engine_options(ASYNC_DATABASE_READ_URL, DB_READ_POOL_SIZE)
+    )
+    _tune_engine(ASYNC_DATABASE_READ_URL, async_read_engine.sync_engine, read_only=True)
+else:
+    async_read_engine = async_engine
+AsyncReadSessionLocal = async_sessionmaker(
+    async_read_engine, class_=AsyncSession, autoflush=False, expire_on_commit=False
+)
+
 Base = declarative_base()
 
+def ensure_schema(bind=engine):
+    """
+    既存テーブルに不足しているカラム・インデックスを追加する簡易マイグレーション。
+    create_all は既存テーブルを変更しないため、モデルにカラムを追加した場合はここで補う。
+    追加対象のカラムは NULL 許容、または server_default を持つもののみ。
+    """
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                if not column.nullable and column.server_default is None:
+                    continue
+                column_type = column.type.compile(dialect=bind.dialect)
+                ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {column_type}'
+                if column.server_default is not None:
+                    default = column.server_default.arg
+                    if isinstance(default, str):
+                        default = "'" + default.replace("'", "''") + "'"
+                    ddl += f" DEFAULT {default}"
+                conn.execute(text(ddl))
+            for index in table.indexes:
+                index.create(bind=conn, checkfirst=True)
+
 # Dependency to get DB session
 def get_db():
     db = SessionLocal()
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+# Dependency to get async DB session
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
+
+# Dependency to get async DB session for read-only endpoints
+async def get_async_read_db():
+    async with AsyncReadSessionLocal() as db:
+        yield db
+
+async def dispose_engines() -> None:
+    await async_engine.dispose()
+    if async_read_engine is not async_engine:
+        await async_read_engine.dispose()
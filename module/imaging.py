@@ -0,0 +1,180 @@
+"""
+画像処理ユーティリティ（CPU 負荷の高い処理はプロセスプールで実行する）。
+- アップロード画像の縮小版(WebP/AVIF)の生成とディスクキャッシュ
+- AI に送信する画像の縮小・再エンコード
+"""
+import asyncio
+import io
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Optional, Tuple
+
+from PIL import Image, ImageOps, features
+
+# 生成する縮小版の幅。要求された幅はこのいずれかに丸める
+VARIANT_WIDTHS = (160, 320, 640, 1280)
+# format -> (PIL の保存形式, MIME タイプ, 保存オプション)
+VARIANT_FORMATS: Dict[str, Tuple[str, str, dict]] = {
+    "webp": ("WEBP", "image/webp", {"quality": 80, "method": 4}),
+}
+if features.check("avif"):
+    VARIANT_FORMATS["avif"] = ("AVIF", "image/avif", {"quality": 60})
+
+# Gemini は長辺 3072px を超える画像を縮小して扱うため、それ以上の解像度は送っても無駄になる
+AI_IMAGE_MAX_EDGE = int(os.getenv("AI_IMAGE_MAX_EDGE", "3072"))
+# この大きさ以下で上記の解像度内なら再エンコードせずそのまま送る（大きい PNG などは JPEG/WebP にする）
+AI_IMAGE_PASSTHROUGH_BYTES = int(os.getenv("AI_IMAGE_PASSTHROUGH_BYTES", str(512 * 1024)))
+# そのまま送信できる形式（サイズが上限内なら再エンコードしない）
+_AI_PASSTHROUGH_FORMATS = {"JPEG": "image/jpeg", "PNG": "image/png", "WEBP": "image/webp"}
+
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(min(2, os.cpu_count() or 1))))
+
+_process_pool: Optional[ProcessPoolExecutor] = None
+# 同じ縮小版の同時生成を 1 回にまとめる
+_pending_variants: Dict[str, asyncio.Future] = {}
+
+
+def get_process_pool() -> ProcessPoolExecutor:
+    global _process_pool
+    if _process_pool is None:
+        _process_pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS)
+    return _process_pool
+
+
+def shutdown_process_pool() -> None:
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown(wait=False, cancel_futures=True)
+        _process_pool = None
+
+
+def snap_width(width: int) -> int:
+    """要求幅以上で最小の定義済み幅を返す（上限は最大幅）"""
+    for candidate in VARIANT_WIDTHS:
+        if width <= candidate:
+            return candidate
+    return VARIANT_WIDTHS[-1]
+
+
+def negotiate_format(requested: Optional[str], accept: str) -> Optional[str]:
+    """明示指定がなければ Accept ヘッダーから AVIF > WebP の順に選ぶ"""
+    if requested:
+        requested = requested.lower()
+        return requested if requested in VARIANT_FORMATS else None
+    if "avif" in VARIANT_FORMATS and "image/avif" in accept:
+        return "avif"
+    return "webp"
+
+
+def variant_path(cache_dir: str, digest: str, width: int, fmt: str) -> str:
+    return os.path.join(cache_dir, digest[:2], f"{digest}_w{width}.{fmt}")
+
+
+def _has_alpha(im: Image.Image) -> bool:
+    return im.mode in ("RGBA", "LA", "PA") or (im.mode == "P" and "transparency" in im.info)
+
+
+def render_variant(src_path: str, dst_path: str, width: int, fmt: str) -> None:
+    """
+    縮小版を生成して dst_path に保存する（プロセスプール上で実行される）。
+    元画像より大きくは拡大しない。アニメーション GIF は先頭フレームのみ。
+    """
+    pil_format, _, options = VARIANT_FORMATS[fmt]
+    with Image.open(src_path) as im:
+        # JPEG はデコード時に縮小できるため、フル解像度での展開を避ける
+        im.draft("RGB", (width, width * 8))
+        im = ImageOps.exif_transpose(im)
+        if im.mode not in ("RGB", "RGBA"):
+            im = im.convert("RGBA" if _has_alpha(im) else "RGB")
+        if im.width > width:
+            im.thumbnail((width, max(1, round(im.height * width / im.width))), Image.Resampling.LANCZOS)
+
+        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dst_path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as out:
+                im.save(out, format=pil_format, **options)
+            os.replace(tmp_path, dst_path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+
+def prepare_image_for_model(
+    data: bytes, max_edge: int = AI_IMAGE_MAX_EDGE, passthrough_bytes: int = AI_IMAGE_PASSTHROUGH_BYTES
+) -> Tuple[str, bytes]:
+    """
+    AI に送信する画像を (MIME タイプ, バイト列) に変換する（プロセスプール上で実行される）。
+    - passthrough_bytes 以下で長辺が max_edge 以内、向き補正も不要な JPEG/PNG/WebP は再エンコードせずそのまま返す
+    - それ以外は縮小し、透過なしは JPEG、透過ありは WebP で軽量にエンコードする
+    不正な画像の場合は PIL の例外(UnidentifiedImageError など)を送出する。
+    """
+    with Image.open(io.BytesIO(data)) as im:
+        orientation = im.getexif().get(0x0112, 1)
+        if (
+            len(data) <= passthrough_bytes
+            and im.format in _AI_PASSTHROUGH_FORMATS
+            and max(im.size) <= max_edge
+            and orientation == 1
+            and not getattr(im, "is_animated", False)
+        ):
+            # verify() は open 直後にしか呼べないため開き直して検証する
+            with Image.open(io.BytesIO(data)) as check:
+                check.verify()
+            return _AI_PASSTHROUGH_FORMATS[im.format], data
+
+        # JPEG はデコード時点で縮小し、フル解像度での展開を避ける
+        im.draft("RGB", (max_edge, max_edge))
+        im = ImageOps.exif_transpose(im)
+        if max(im.size) > max_edge:
+            im.thumbnail((max_edge, max_edge), Image.Resampling.LANCZOS)
+
+        out = io.BytesIO()
+        if _has_alpha(im):
+            im.convert("RGBA").save(out, format="WEBP", quality=85, method=4)
+            return "image/webp", out.getvalue()
+        im.convert("RGB").save(out, format="JPEG", quality=85, optimize=True)
+        return "image/jpeg", out.getvalue()
+
+
+async def prepare_images_for_model(images: list) -> list:
+    """複数画像をプロセスプールで並列に変換する"""
+    loop = asyncio.get_running_loop()
+    pool = get_process_pool()
+    return list(await asyncio.gather(
+        *(loop.run_in_executor(pool, prepare_image_for_model, data) for data in images)
+    ))
+
+
+async def get_variant(cache_dir: str, digest: str, src_path: str, width: int, fmt: str) -> str:
+    """
+    縮小版のパスを返す。未生成ならプロセスプールで生成してディスクにキャッシュする。
+    """
+    path = variant_path(cache_dir, digest, width, fmt)
+    if os.path.exists(path):
+        return path
+
+    pending = _pending_variants.get(path)
+    if pending is None:
+        loop = asyncio.get_running_loop()
+        pending = asyncio.ensure_future(
+            loop.run_in_executor(get_process_pool(), render_variant, src_path, path, width, fmt)
+        )
+        _pending_variants[path] = pending
+        pending.add_done_callback(lambda _: _pending_variants.pop(path, None))
+    await asyncio.shield(pending)
+    return path
+
+
+def remove_variants(cache_dir: str, digest: str) -> None:
+    """blob の削除時に、その縮小版をすべて削除する"""
+    directory = os.path.join(cache_dir, digest[:2])
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.startswith(f"{digest}_"):
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
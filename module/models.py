@@ -1,4 +1,5 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, Text
+from datetime import datetime, timezone
+from sqlalchemy import Column, Integer, String, ForeignKey, Text, Index, DateTime
 from sqlalchemy.orm import relationship
 from module.database import Base
 
@@ -23,14 +24,73 @@ class UploadedFile(Base):
     filename = Column(String, index=True)
     file_path = Column(String)
     file_type = Column(String)
+    # コンテンツアドレス型ストレージ上の実体（旧形式のファイルは NULL）
+    blob_digest = Column(String, ForeignKey("blobs.digest"), index=True)
     owner_id = Column(Integer, ForeignKey("users.id"))
 
     owner = relationship("User", back_populates="files")
+    blob = relationship("Blob")
+
+class UploadSession(Base):
+    """再開可能(チャンク分割)アップロードの進行状況"""
+    __tablename__ = "upload_sessions"
+    id = Column(String, primary_key=True)
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+    file_type = Column(String, nullable=False)
+    filename = Column(String)
+    content_type = Column(String)
+    total_size = Column(Integer, nullable=False)
+    offset = Column(Integer, nullable=False, default=0, server_default="0")
+    temp_path = Column(String, nullable=False)
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+
+class Blob(Base):
+    __tablename__ = "blobs"
+    digest = Column(String, primary_key=True)  # SHA-256 (hex)
+    size = Column(Integer, nullable=False)
+    content_type = Column(String)
+    ref_count = Column(Integer, nullable=False, default=0, server_default="0")
 
 class Slide(Base):
     __tablename__ = "slides"
     id = Column(Integer, primary_key=True, index=True)
     slide_data = Column(Text)
-    owner_id = Column(Integer, ForeignKey("users.id"))
+    # 楽観的排他制御用のバージョン番号（更新のたびに +1）
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    # "inline": slide_data に全体を保持 / "paged": slide_data はアウトラインのみでページは slide_pages に分割
+    storage_format = Column(String, nullable=False, default="inline", server_default="inline")
+    # 一覧表示用のメタデータ（保存時に slide_data から抽出）
+    title = Column(String)
+    page_count = Column(Integer, nullable=False, default=0, server_default="0")
+    thumbnail_url = Column(String)
+    updated_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    owner_id = Column(Integer, ForeignKey("users.id"), index=True)
+
+    owner = relationship("User", back_populates="slides")
+    pages = relationship(
+        "SlidePage", back_populates="slide", order_by="SlidePage.page_index",
+        cascade="all, delete-orphan"
+    )
+
+class SlidePage(Base):
+    __tablename__ = "slide_pages"
+    id = Column(Integer, primary_key=True, index=True)
+    slide_id = Column(Integer, ForeignKey("slides.id"), nullable=False)
+    page_index = Column(Integer, nullable=False)
+    page_key = Column(String)  # クライアント側のページID (slide.js の slides[].id)
+    page_data = Column(Text)
+    element_count = Column(Integer, nullable=False, default=0, server_default="0")
+
+    slide = relationship("Slide", back_populates="pages")
+
+    __table_args__ = (Index("ix_slide_pages_slide_id_page_index", "slide_id", "page_index"),)
 
-    owner = relationship("User", back_populates="slides")
\ No newline at end of file
+class AIResponseCacheEntry(Base):
+    """/ai/ask の応答キャッシュ（ディスク層）。chunks はストリーミングしたテキスト片の JSON 配列"""
+    __tablename__ = "ai_response_cache"
+    key = Column(String, primary_key=True)  # SHA-256 (hex)
+    model = Column(String, nullable=False)
+    chunks = Column(Text, nullable=False)
+    size = Column(Integer, nullable=False, default=0, server_default="0")
+    created_at = Column(DateTime, default=lambda: datetime.now(timezone.utc))
+    expires_at = Column(DateTime, nullable=False, index=True)
@@ -0,0 +1,162 @@
+"""
+スライドデータ(JSON)に対する差分適用ユーティリティ。
+- RFC 6902 (JSON Patch)
+- RFC 7396 (JSON Merge Patch)
+外部ライブラリに依存せず、json.loads 済みの dict / list をそのまま更新する。
+"""
+import copy
+from typing import Any, List, Tuple, Union
+
+
+class PatchError(ValueError):
+    """パッチの形式不正・適用失敗を表す例外"""
+
+
+def _parse_pointer(pointer: str) -> List[str]:
+    """JSON Pointer (RFC 6901) をトークン列に分解する"""
+    if not isinstance(pointer, str):
+        raise PatchError("JSON pointer must be a string")
+    if pointer == "":
+        return []
+    if not pointer.startswith("/"):
+        raise PatchError(f"Invalid JSON pointer: {pointer}")
+    return [token.replace("~1", "/").replace("~0", "~") for token in pointer[1:].split("/")]
+
+
+def _array_index(container: list, token: str, *, allow_end: bool) -> int:
+    if allow_end and token == "-":
+        return len(container)
+    if not token.isdigit() or (len(token) > 1 and token.startswith("0")):
+        raise PatchError(f"Invalid array index: {token}")
+    index = int(token)
+    upper = len(container) if allow_end else len(container) - 1
+    if index > upper:
+        raise PatchError(f"Array index out of range: {token}")
+    return index
+
+
+def _resolve_parent(doc: Any, tokens: List[str]) -> Tuple[Union[dict, list], str]:
+    """最後のトークンを除いたパスを辿り、(親コンテナ, 最終トークン) を返す"""
+    node = doc
+    for token in tokens[:-1]:
+        if isinstance(node, dict):
+            if token not in node:
+                raise PatchError(f"Path not found: {token}")
+            node = node[token]
+        elif isinstance(node, list):
+            node = node[_array_index(node, token, allow_end=False)]
+        else:
+            raise PatchError(f"Cannot traverse into scalar at: {token}")
+    if not isinstance(node, (dict, list)):
+        raise PatchError("Parent of target is not a container")
+    return node, tokens[-1]
+
+
+def _get(doc: Any, tokens: List[str]) -> Any:
+    if not tokens:
+        return doc
+    parent, key = _resolve_parent(doc, tokens)
+    if isinstance(parent, dict):
+        if key not in parent:
+            raise PatchError(f"Path not found: {key}")
+        return parent[key]
+    return parent[_array_index(parent, key, allow_end=False)]
+
+
+def _add(doc: Any, tokens: List[str], value: Any) -> Any:
+    if not tokens:
+        return value
+    parent, key = _resolve_parent(doc, tokens)
+    if isinstance(parent, dict):
+        parent[key] = value
+    else:
+        parent.insert(_array_index(parent, key, allow_end=True), value)
+    return doc
+
+
+def _remove(doc: Any, tokens: List[str]) -> Tuple[Any, Any]:
+    """値を削除し、(更新後ドキュメント, 削除した値) を返す"""
+    if not tokens:
+        raise PatchError("Cannot remove the document root")
+    parent, key = _resolve_parent(doc, tokens)
+    if isinstance(parent, dict):
+        if key not in parent:
+            raise PatchError(f"Path not found: {key}")
+        return doc, parent.pop(key)
+    return doc, parent.pop(_array_index(parent, key, allow_end=False))
+
+
+def _json_equal(a: Any, b: Any) -> bool:
+    """JSON としての等価判定（bool と数値を区別する）"""
+    if isinstance(a, bool) or isinstance(b, bool):
+        return isinstance(a, bool) and isinstance(b, bool) and a == b
+    if isinstance(a, dict) and isinstance(b, dict):
+        return a.keys() == b.keys() and all(_json_equal(a[k], b[k]) for k in a)
+    if isinstance(a, list) and isinstance(b, list):
+        return len(a) == len(b) and all(_json_equal(x, y) for x, y in zip(a, b))
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return a == b
+    return type(a) is type(b) and a == b
+
+
+def apply_json_patch(doc: Any, operations: Any) -> Any:
+    """
+    RFC 6902 の操作列を適用した結果を返す。
+    doc は破壊的に更新されるため、呼び出し元は使い捨ての値を渡すこと。
+    """
+    if not isinstance(operations, list):
+        raise PatchError("JSON Patch must be an array of operations")
+
+    for operation in operations:
+        if not isinstance(operation, dict) or "op" not in operation or "path" not in operation:
+            raise PatchError(f"Invalid operation: {operation}")
+        op = operation["op"]
+        tokens = _parse_pointer(operation["path"])
+
+        if op == "add":
+            if "value" not in operation:
+                raise PatchError("'add' requires 'value'")
+            doc = _add(doc, tokens, operation["value"])
+        elif op == "remove":
+            doc, _ = _remove(doc, tokens)
+        elif op == "replace":
+            if "value" not in operation:
+                raise PatchError("'replace' requires 'value'")
+            _get(doc, tokens)  # 存在確認
+            if not tokens:
+                doc = operation["value"]
+            else:
+                doc, _ = _remove(doc, tokens)
+                doc = _add(doc, tokens, operation["value"])
+        elif op == "move":
+            from_tokens = _parse_pointer(operation.get("from"))
+            if from_tokens != tokens and tokens[:len(from_tokens)] == from_tokens:
+                raise PatchError("Cannot move a value into one of its children")
+            doc, value = _remove(doc, from_tokens)
+            doc = _add(doc, tokens, value)
+        elif op == "copy":
+            value = copy.deepcopy(_get(doc, _parse_pointer(operation.get("from"))))
+            doc = _add(doc, tokens, value)
+        elif op == "test":
+            if not _json_equal(_get(doc, tokens), operation.get("value")):
+                raise PatchError(f"Test failed at: {operation['path']}")
+        else:
+            raise PatchError(f"Unsupported operation: {op}")
+    return doc
+
+
+def apply_merge_patch(target: Any, patch: Any) -> Any:
+    """
+    RFC 7396 の Merge Patch を適用した結果を返す。
+    null は削除、オブジェクトは再帰マージ、それ以外は置換として扱う。
+    """
+    if not isinstance(patch, dict):
+        return patch
+    if not isinstance(target, dict):
+        target = {}
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = apply_merge_patch(target.get(key), value)
+    return target
@@ -0,0 +1,182 @@
+"""
+AI リクエストのアドミッション制御。
+- 全体の同時実行数の上限
+- ユーザー(未ログイン時はクライアント IP)ごとの FIFO キューをラウンドロビンで処理する公平キューイング
+- キューが深い場合は SchedulerBusy (429 + Retry-After) で即座に拒否
+- ユーザーごとのトークンバケットによるレート制限
+"""
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Deque, Dict, Optional
+
+
+class SchedulerBusy(Exception):
+    """受け付けられないリクエスト。retry_after 秒後の再試行を促す"""
+
+    def __init__(self, retry_after: float, reason: str):
+        super().__init__(reason)
+        self.retry_after = max(1, math.ceil(retry_after))
+        self.reason = reason
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float, now: Optional[float] = None):
+        self.rate = rate  # 1 秒あたりの補充量
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic() if now is None else now
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def try_consume(self, now: Optional[float] = None) -> float:
+        """トークンを 1 つ消費する。不足している場合は消費せず、補充までの待ち秒数を返す"""
+        self._refill(time.monotonic() if now is None else now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def is_full(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class Slot:
+    """実行枠。release は何度呼ばれても 1 回だけ有効"""
+
+    def __init__(self, scheduler: "AIScheduler"):
+        self._scheduler = scheduler
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self._scheduler._release()
+
+
+class AIScheduler:
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        max_queue_per_user: int = 4,
+        max_queue: int = 64,
+        queue_timeout: float = 30.0,
+        rate_per_minute: float = 20.0,
+        burst: float = 10.0,
+        avg_service_seconds: float = 10.0,
+        max_buckets: int = 10000,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue_per_user = max_queue_per_user
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.rate_per_second = rate_per_minute / 60.0
+        self.burst = burst
+        self.avg_service_seconds = avg_service_seconds
+        self.max_buckets = max_buckets
+
+        self.active = 0
+        # キーごとの待ち行列。OrderedDict の順序がラウンドロビンの順番になる
+        self._queues: "OrderedDict[str, Deque[asyncio.Future]]" = OrderedDict()
+        self._queued = 0
+        self._buckets: Dict[str, TokenBucket] = {}
+
+    @property
+    def queued(self) -> int:
+        return self._queued
+
+    def _estimate_wait(self) -> float:
+        return (self._queued + 1) / max(1, self.max_concurrency) * self.avg_service_seconds
+
+    def _consume_token(self, key: str) -> None:
+        if self.rate_per_second <= 0:
+            return
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.max_buckets:
+                # 満タン(=しばらく使われていない)のバケットは作り直しても同じなので捨てる
+                for stale in [k for k, b in self._buckets.items() if b.is_full(now)]:
+                    del self._buckets[stale]
+            bucket = self._buckets[key] = TokenBucket(self.rate_per_second, self.burst, now)
+        wait = bucket.try_consume(now)
+        if wait > 0:
+            raise SchedulerBusy(wait, "rate_limited")
+
+    async def acquire(self, key: str) -> Slot:
+        """
+        実行枠を取得する。空きがなければキューで順番を待つ。
+        キューが深い・レート超過・待ち時間超過の場合は SchedulerBusy を送出する。
+        """
+        if self.active < self.max_concurrency and not self._queued:
+            self._consume_token(key)
+            self.active += 1
+            return Slot(self)
+
+        queue = self._queues.get(key)
+        if self._queued >= self.max_queue or (queue is not None and len(queue) >= self.max_queue_per_user):
+            raise SchedulerBusy(self._estimate_wait(), "queue_full")
+        self._consume_token(key)
+
+        waiter: asyncio.Future = asyncio.get_running_loop().create_future()
+        if queue is None:
+            queue = self._queues[key] = deque()
+        queue.append(waiter)
+        self._queued += 1
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), self.queue_timeout)
+        except BaseException as exc:
+            if waiter.done() and not waiter.cancelled():
+                # 枠の割り当てとキャンセルが競合した場合は枠を返す
+                self._release()
+            else:
+                waiter.cancel()
+                self._remove_waiter(key, waiter)
+            if isinstance(exc, asyncio.TimeoutError):
+                raise SchedulerBusy(self._estimate_wait(), "queue_timeout") from None
+            raise
+        return Slot(self)
+
+    def _remove_waiter(self, key: str, waiter: asyncio.Future) -> None:
+        queue = self._queues.get(key)
+        if queue is None:
+            return
+        try:
+            queue.remove(waiter)
+            self._queued -= 1
+        except ValueError:
+            pass
+        if not queue:
+            del self._queues[key]
+
+    def _release(self) -> None:
+        self.active -= 1
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """空き枠を、待っているキーへラウンドロビンで 1 件ずつ割り当てる"""
+        while self.active < self.max_concurrency and self._queues:
+            key, queue = next(iter(self._queues.items()))
+            waiter = queue.popleft()
+            self._queued -= 1
+            if queue:
+                self._queues.move_to_end(key)
+            else:
+                del self._queues[key]
+            if waiter.done():
+                continue
+            self.active += 1
+            waiter.set_result(None)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "active": self.active,
+            "queued": self._queued,
+            "queued_keys": len(self._queues),
+            "max_concurrency": self.max_concurrency,
+        }
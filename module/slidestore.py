@@ -0,0 +1,300 @@
+"""
+スライド(デッキ)のページ単位ストレージ。
+プレゼンテーション JSON ({"settings": ..., "slides": [...], ...}) を
+- slides.slide_data: "slides" を除いたアウトライン
+- slide_pages: ページごとの JSON
+に分割して保存し、必要なページだけを読み出せるようにする。
+プレゼンテーション形式でないデータは従来通り slide_data にそのまま保存する(inline)。
+"""
+import json
+import re
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from sqlalchemy.orm import Session, selectinload
+
+from module.models import Slide, SlidePage
+
+STORAGE_INLINE = "inline"
+STORAGE_PAGED = "paged"
+
+TITLE_MAX_LENGTH = 200
+THUMBNAIL_URL_MAX_LENGTH = 2048
+# 一覧のサムネイルに使う縮小版の幅 (module.imaging.VARIANT_WIDTHS のいずれか)
+THUMBNAIL_WIDTH = 320
+_HTML_TAG_RE = re.compile(r"<[^>]+>")
+_UPLOADED_FILE_RE = re.compile(r"^/files/(\d+)(?:\?.*)?$")
+_WIKIMEDIA_RE = re.compile(r"^(https://upload\.wikimedia\.org/wikipedia/[^/]+)/([0-9a-f]/[0-9a-f]{2})/([^/?#]+)$")
+
+
+def dumps(value: Any) -> str:
+    """保存用のコンパクトな JSON 文字列に変換する"""
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+
+
+def split_document(document: Any) -> Optional[Tuple[Dict[str, Any], List[Dict[str, Any]]]]:
+    """
+    プレゼンテーションを (アウトライン, ページ配列) に分割する。
+    ページ分割できない形式の場合は None を返す。
+    """
+    if not isinstance(document, dict):
+        return None
+    pages = document.get("slides")
+    if not isinstance(pages, list) or not all(isinstance(page, dict) for page in pages):
+        return None
+    outline = {key: value for key, value in document.items() if key != "slides"}
+    return outline, pages
+
+
+def _page_key(page: Dict[str, Any]) -> Optional[str]:
+    """ページの id を保存・概要用のキー(文字列)にする"""
+    page_id = page.get("id")
+    return str(page_id) if page_id is not None else None
+
+
+def _extract_title(document: Dict[str, Any], pages: List[Dict[str, Any]]) -> Optional[str]:
+    """明示的なタイトル、なければ先頭ページ最初のテキスト要素をタイトルとする"""
+    settings = document.get("settings")
+    for candidate in (document.get("title"), settings.get("title") if isinstance(settings, dict) else None):
+        if isinstance(candidate, str) and candidate.strip():
+            return candidate.strip()[:TITLE_MAX_LENGTH]
+    for page in pages[:1]:
+        for element in page.get("elements") or []:
+            if not isinstance(element, dict) or element.get("type") != "text":
+                continue
+            content = element.get("content")
+            if not isinstance(content, str):
+                continue
+            text = _HTML_TAG_RE.sub(" ", content).strip()
+            if text:
+                return text.splitlines()[0].strip()[:TITLE_MAX_LENGTH]
+    return None
+
+
+def _extract_thumbnail_url(pages: List[Dict[str, Any]]) -> Optional[str]:
+    """先頭ページの最初の画像要素の URL を返す（data URL はサイズが大きいため対象外）"""
+    for page in pages[:1]:
+        for element in page.get("elements") or []:
+            if not isinstance(element, dict) or element.get("type") != "image":
+                continue
+            content = element.get("content")
+            if isinstance(content, str) and not content.startswith("data:") and len(content) <= THUMBNAIL_URL_MAX_LENGTH:
+                return _thumbnail_variant_url(content)
+    return None
+
+
+def _thumbnail_variant_url(url: str) -> str:
+    """
+    一覧で原寸の画像を読み込まないよう、縮小版を返せる URL は縮小版の URL にする。
+    - アップロード済みファイル: /files/{id}?w=320
+    - Wikimedia の画像: サムネイル URL (.../thumb/x/xy/Name.jpg/320px-Name.jpg)
+    """
+    match = _UPLOADED_FILE_RE.match(url)
+    if match:
+        return f"/files/{match.group(1)}?w={THUMBNAIL_WIDTH}"
+    match = _WIKIMEDIA_RE.match(url)
+    if match and not match.group(3).lower().endswith(".svg"):
+        base, shard, name = match.groups()
+        return f"{base}/thumb/{shard}/{name}/{THUMBNAIL_WIDTH}px-{name}"
+    return url
+
+
+def _update_metadata(slide: Slide, document: Any) -> None:
+    """一覧表示用のメタデータ(タイトル・ページ数・サムネイル・更新日時)を更新する"""
+    parts = split_document(document)
+    if parts is None:
+        title = document.get("title") if isinstance(document, dict) else None
+        slide.title = title.strip()[:TITLE_MAX_LENGTH] if isinstance(title, str) and title.strip() else None  # type: ignore
+        slide.page_count = 0  # type: ignore
+        slide.thumbnail_url = None  # type: ignore
+    else:
+        _, pages = parts
+        slide.title = _extract_title(document, pages)  # type: ignore
+        slide.page_count = len(pages)  # type: ignore
+        slide.thumbnail_url = _extract_thumbnail_url(pages)  # type: ignore
+    slide.updated_at = datetime.now(timezone.utc)  # type: ignore
+
+
+def _parse(slide_data: Optional[str]) -> Any:
+    try:
+        return json.loads(slide_data or "")
+    except ValueError:
+        return None
+
+
+def load_document(slide: Slide) -> Any:
+    """
+    スライド全体を JSON として読み込む。
+    inline 形式で JSON でない場合は ValueError を送出する。
+    """
+    if slide.storage_format == STORAGE_PAGED:
+        document = json.loads(slide.slide_data or "{}")
+        document["slides"] = [json.loads(page.page_data) for page in slide.pages]
+        return document
+    return json.loads(slide.slide_data or "{}")
+
+
+def dump_slide_data(slide: Slide) -> str:
+    """API 互換のため、スライド全体を 1 つの slide_data 文字列として返す"""
+    if slide.storage_format == STORAGE_PAGED:
+        return dumps(load_document(slide))
+    return slide.slide_data or ""
+
+
+def save_slide_data(slide: Slide, slide_data: str) -> None:
+    """
+    クライアントから受け取った slide_data を保存する。
+    プレゼンテーション形式ならページ分割、それ以外は inline で保存する。
+    (コミットは呼び出し元で行う)
+    """
+    document = _parse(slide_data)
+    if split_document(document) is None:
+        _store_inline(slide, slide_data, document)
+        return
+    save_document(slide, document)
+
+
+def _store_inline(slide: Slide, slide_data: str, document: Any) -> None:
+    slide.pages.clear()
+    slide.storage_format = STORAGE_INLINE  # type: ignore
+    slide.slide_data = slide_data  # type: ignore
+    _update_metadata(slide, document)
+
+
+def save_document(slide: Slide, document: Any) -> None:
+    """
+    JSON ドキュメントを保存する。ページは内容が変わったものだけ書き込み、
+    削除されたページは取り除く。(コミットは呼び出し元で行う)
+    """
+    parts = split_document(document)
+    if parts is None:
+        _store_inline(slide, dumps(document), document)
+        return
+
+    outline, pages = parts
+    existing_by_key: Dict[Any, SlidePage] = {}
+    leftovers: List[SlidePage] = []
+    if slide.storage_format == STORAGE_PAGED:
+        for page in slide.pages:
+            if page.page_key is not None and page.page_key not in existing_by_key:
+                existing_by_key[page.page_key] = page
+            else:
+                leftovers.append(page)
+
+    for index, page_doc in enumerate(pages):
+        page_key = _page_key(page_doc)
+        page_data = dumps(page_doc)
+        elements = page_doc.get("elements")
+        element_count = len(elements) if isinstance(elements, list) else 0
+
+        db_page = existing_by_key.pop(page_key, None) if page_key is not None else None
+        if db_page is None and leftovers:
+            db_page = leftovers.pop(0)
+        if db_page is None:
+            slide.pages.append(SlidePage(
+                page_index=index, page_key=page_key,
+                page_data=page_data, element_count=element_count,
+            ))
+            continue
+        # 変更のあったカラムだけを更新する
+        if db_page.page_index != index:
+            db_page.page_index = index  # type: ignore
+        if db_page.page_key != page_key:
+            db_page.page_key = page_key  # type: ignore
+        if db_page.page_data != page_data:
+            db_page.page_data = page_data  # type: ignore
+            db_page.element_count = element_count  # type: ignore
+
+    for page in list(existing_by_key.values()) + leftovers:
+        slide.pages.remove(page)
+    # 同一セッション内で再読込せずに参照しても順序が崩れないようにする
+    slide.pages.sort(key=lambda page: page.page_index)
+
+    slide.storage_format = STORAGE_PAGED  # type: ignore
+    slide.slide_data = dumps(outline)  # type: ignore
+    _update_metadata(slide, document)
+
+
+def backfill_metadata(db: Session, batch_size: int = 200) -> int:
+    """
+    メタデータ列を追加する前から存在するスライド(updated_at が NULL)のメタデータを埋める。
+    起動時に一度実行する。処理した件数を返す。
+    """
+    count = 0
+    while True:
+        slides = (
+            db.query(Slide)
+            .options(selectinload(Slide.pages))
+            .filter(Slide.updated_at.is_(None))
+            .order_by(Slide.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not slides:
+            return count
+        for slide in slides:
+            try:
+                document = load_document(slide)
+            except ValueError:
+                document = None
+            _update_metadata(slide, document)
+        db.commit()
+        count += len(slides)
+
+
+def get_outline(db: Session, slide: Slide) -> Tuple[Any, List[Dict[str, Any]]]:
+    """
+    (アウトライン, ページ概要リスト) を返す。ページ本文(page_data)は読み込まない。
+    """
+    if slide.storage_format == STORAGE_PAGED:
+        rows = (
+            db.query(SlidePage.page_index, SlidePage.page_key, SlidePage.element_count)
+            .filter(SlidePage.slide_id == slide.id)
+            .order_by(SlidePage.page_index)
+            .all()
+        )
+        summaries = [
+            {"index": row.page_index, "page_id": row.page_key, "element_count": row.element_count}
+            for row in rows
+        ]
+        return json.loads(slide.slide_data or "{}"), summaries
+
+    # inline 形式は読み込んだ上でその場で分割する
+    parts = split_document(_parse(slide.slide_data))
+    if parts is None:
+        return None, []
+    outline, pages = parts
+    summaries = []
+    for index, page in enumerate(pages):
+        elements = page.get("elements")
+        summaries.append({
+            "index": index,
+            "page_id": _page_key(page),
+            "element_count": len(elements) if isinstance(elements, list) else 0,
+        })
+    return outline, summaries
+
+
+def get_pages(db: Session, slide: Slide, start: int, limit: int) -> List[Tuple[int, str]]:
+    """
+    ページ範囲 [start, start + limit) の (page_index, page_data) を返す。
+    page_data は保存済みの JSON 文字列をそのまま返す。
+    """
+    if slide.storage_format == STORAGE_PAGED:
+        rows = (
+            db.query(SlidePage.page_index, SlidePage.page_data)
+            .filter(
+                SlidePage.slide_id == slide.id,
+                SlidePage.page_index >= start,
+                SlidePage.page_index < start + limit,
+            )
+            .order_by(SlidePage.page_index)
+            .all()
+        )
+        return [(row.page_index, row.page_data) for row in rows]
+
+    parts = split_document(_parse(slide.slide_data))
+    if parts is None:
+        return []
+    _, pages = parts
+    return [(index, dumps(pages[index])) for index in range(start, min(start + limit, len(pages)))]
@@ -0,0 +1,217 @@
+"""
+外部 API（Wikipedia / Pixabay）の応答キャッシュ。
+- エントリ数・合計バイト数で上限を設けた LRU（上限を超えたら最も古く使われたものから追い出す）
+- キーの名前空間（"titles::" などキー先頭の "::" まで）ごとに TTL を設定できる
+- TTL 切れ後も stale_ttl の間は古い値を即座に返し、裏で取り直す（stale-while-revalidate）
+- 同じキーの取得が同時に走る場合は 1 回の上流呼び出しを共有する（single-flight）
+- ヒット・ミス・追い出しなどの件数を stats() で参照できる
+値は JSON にできるものを想定し、サイズは JSON にしたときのバイト数で見積もる。
+"""
+import asyncio
+import json
+import logging
+import sys
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Loader = Callable[[], Awaitable[Any]]
+
+
+def namespace_of(key: str) -> str:
+    return key.split("::", 1)[0]
+
+
+def _estimate_size(value: Any) -> int:
+    try:
+        return len(json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+    except (TypeError, ValueError):
+        return sys.getsizeof(value)
+
+
+class SingleFlight:
+    """
+    キーごとに実行中の呼び出しを 1 つにまとめる。
+    後から来た呼び出し元は実行中のタスクの結果（例外も含む）を待つ。
+    タスクは shield して待つため、待っている側がキャンセルされても共有の呼び出しは止まらない。
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self.coalesced = 0
+
+    def running(self, key: str) -> bool:
+        task = self._calls.get(key)
+        return task is not None and not task.done()
+
+    def start(self, key: str, fn: Loader) -> asyncio.Task:
+        # 完了済みのタスクは done コールバックが走るまで残っているため、共有しない
+        task = self._calls.get(key)
+        if task is not None and not task.done():
+            self.coalesced += 1
+            return task
+        task = asyncio.get_running_loop().create_task(fn())
+        self._calls[key] = task
+        task.add_done_callback(lambda t: self._done(key, t))
+        return task
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # 待ち手が全員キャンセルされた場合でも例外の未取得警告を出さない
+        if not task.cancelled():
+            task.exception()
+
+    async def do(self, key: str, fn: Loader) -> Any:
+        return await asyncio.shield(self.start(key, fn))
+
+    async def close(self) -> None:
+        tasks = list(self._calls.values())
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        self._calls.clear()
+
+
+class TTLCache:
+    def __init__(
+        self,
+        max_entries: int = 4096,
+        max_bytes: int = 16 * 1024 * 1024,
+        default_ttl: float = 60.0,
+        ttls: Optional[Dict[str, float]] = None,
+        stale_ttl: float = 300.0,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.default_ttl = default_ttl
+        self.ttls = dict(ttls or {})  # 名前空間 -> TTL 秒
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        # key -> (鮮度の期限, 値, バイト数)。stale_ttl を過ぎたものは読み出し時か追い出しで消える
+        self._entries: "OrderedDict[str, Tuple[float, Any, int]]" = OrderedDict()
+        self._bytes = 0
+        self._flight = SingleFlight()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    def ttl_for(self, key: str) -> float:
+        return self.ttls.get(namespace_of(key), self.default_ttl)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _pop(self, key: str) -> None:
+        item = self._entries.pop(key, None)
+        if item is not None:
+            self._bytes -= item[2]
+
+    def lookup(self, key: str) -> Tuple[bool, Any, bool]:
+        """(見つかったか, 値, 古いか) を返す。件数は数えない"""
+        item = self._entries.get(key)
+        if item is None:
+            return False, None, False
+        fresh_until, value, _ = item
+        now = self.clock()
+        if now >= fresh_until + self.stale_ttl:
+            self._pop(key)
+            self.expirations += 1
+            return False, None, False
+        self._entries.move_to_end(key)
+        return True, value, now >= fresh_until
+
+    def get(self, key: str) -> Optional[Any]:
+        """新鮮な値だけを返す（古い値・未登録は None）"""
+        found, value, stale = self.lookup(key)
+        if found and not stale:
+            self.hits += 1
+            return value
+        self.misses += 1
+        return None
+
+    def set(self, key: str, value: Any, ttl: Optional[float] = None) -> None:
+        size = _estimate_size(value)
+        self._pop(key)
+        if size > self.max_bytes:
+            return
+        if ttl is None:
+            ttl = self.ttl_for(key)
+        self._entries[key] = (self.clock() + ttl, value, size)
+        self._bytes += size
+        while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+            oldest = next(iter(self._entries))
+            self._pop(oldest)
+            self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        self._pop(key)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._bytes = 0
+
+    async def get_or_load(self, key: str, loader: Loader, ttl: Optional[float] = None) -> Any:
+        """
+        新鮮な値があれば返し、古い値があれば返したうえで裏で loader を呼んで更新する。
+        どちらもなければ loader を待って保存する（loader の例外はそのまま呼び出し元へ送る）。
+        同じキーの loader が実行中なら新たには呼ばず、その結果を待つ。
+        """
+        found, value, stale = self.lookup(key)
+        if found:
+            if stale:
+                self.stale_hits += 1
+                self._revalidate(key, loader, ttl)
+            else:
+                self.hits += 1
+            return value
+        self.misses += 1
+        return await self._flight.do(key, lambda: self._load(key, loader, ttl))
+
+    async def _load(self, key: str, loader: Loader, ttl: Optional[float]) -> Any:
+        value = await loader()
+        self.set(key, value, ttl)
+        return value
+
+    def _revalidate(self, key: str, loader: Loader, ttl: Optional[float]) -> None:
+        if self._flight.running(key):
+            return
+        task = self._flight.start(key, lambda: self._load(key, loader, ttl))
+        task.add_done_callback(lambda t: self._refreshed(key, t))
+
+    def _refreshed(self, key: str, task: asyncio.Task) -> None:
+        if task.cancelled():
+            return
+        error = task.exception()
+        if error is None:
+            self.refreshes += 1
+        else:
+            # 失敗しても古い値は stale_ttl の間そのまま使い続け、次の読み出しで再試行する
+            self.refresh_errors += 1
+            logger.warning(f"Cache refresh failed for {key}: {error}")
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors,
+            "coalesced": self._flight.coalesced,
+        }
+
+    async def close(self) -> None:
+        """実行中の取得（裏での更新を含む）を止める"""
+        await self._flight.close()
@@ -0,0 +1,98 @@
+"""
+/ws/collaborate のワイヤープロトコル（フレームのエンコード・デコード）。
+- サブプロトコル "aislide.msgpack.v1" を要求したクライアントにはバイナリフレーム(MessagePack)で送る
+- "aislide.json.v1" または指定なしの場合はテキストフレーム(JSON)
+- 受信はフレームの種類で判別する（バイナリは MessagePack、テキストは JSON）
+- 1 フレームに複数のメッセージをまとめる場合は {"type": "batch", "messages": [...]} で送る
+"""
+import json
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import msgpack
+
+SUBPROTOCOL_MSGPACK = "aislide.msgpack.v1"
+SUBPROTOCOL_JSON = "aislide.json.v1"
+
+CODEC_JSON = "json"
+CODEC_MSGPACK = "msgpack"
+
+
+class ProtocolError(ValueError):
+    """デコードできないフレーム"""
+
+
+def _reject_ext(code: int, data: bytes) -> Any:
+    raise ProtocolError(f"MessagePack extension types are not supported (type {code})")
+
+
+def _ensure_json_types(value: Any) -> None:
+    """
+    JSON で表せない値(bin, Timestamp などの ext, 文字列以外のマップキー)を含むメッセージを拒否する。
+    ルームの状態は JSON として保存・配信するため、MessagePack 固有の型を持ち込ませない。
+    ネストが深いフレームでも再帰の上限に当たらないよう明示的なスタックで辿る。
+    """
+    stack = [value]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, dict):
+            for key, child in item.items():
+                if not isinstance(key, str):
+                    raise ProtocolError("map keys must be strings")
+                stack.append(child)
+        elif isinstance(item, list):
+            stack.extend(item)
+        elif item is not None and not isinstance(item, (str, int, float)):
+            raise ProtocolError(f"unsupported value type: {type(item).__name__}")
+
+
+def negotiate(offered: Sequence[str]) -> Tuple[str, Optional[str]]:
+    """
+    クライアントが提示したサブプロトコルから (コーデック, 応答するサブプロトコル) を選ぶ。
+    提示順を優先し、知らないものしかなければ JSON（サブプロトコルは応答しない）。
+    """
+    for name in offered:
+        if name == SUBPROTOCOL_MSGPACK:
+            return CODEC_MSGPACK, name
+        if name == SUBPROTOCOL_JSON:
+            return CODEC_JSON, name
+    return CODEC_JSON, None
+
+
+def encode(codec: str, message: Any) -> Union[str, bytes]:
+    if codec == CODEC_MSGPACK:
+        return msgpack.packb(message, use_bin_type=True)
+    return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+
+
+def decode(frame: Dict[str, Any]) -> Any:
+    """ASGI の websocket.receive メッセージを復号する"""
+    data = frame.get("bytes")
+    if data is not None:
+        try:
+            message = msgpack.unpackb(data, raw=False, strict_map_key=False, ext_hook=_reject_ext)
+        except ProtocolError:
+            raise
+        except (ValueError, TypeError, msgpack.ExtraData, msgpack.FormatError, msgpack.StackError) as e:
+            raise ProtocolError(f"invalid MessagePack frame: {e}") from None
+        _ensure_json_types(message)
+        return message
+    try:
+        return json.loads(frame.get("text") or "")
+    except ValueError:
+        raise ProtocolError("invalid JSON frame") from None
+
+
+def pack_frame(messages: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """
+    送信待ちのメッセージを 1 フレーム分にまとめる。
+    連続する ops メッセージは 1 つの ops に連結する。
+    """
+    merged: List[Dict[str, Any]] = []
+    for message in messages:
+        if merged and message.get("type") == "ops" and merged[-1].get("type") == "ops":
+            merged[-1] = {"type": "ops", "ops": merged[-1]["ops"] + message["ops"]}
+        else:
+            merged.append(message)
+    if len(merged) == 1:
+        return merged[0]
+    return {"type": "batch", "messages": merged}
@@ -714,14 +714,25 @@ document.addEventListener('DOMContentLoaded', () => {
         slideListContainer.innerHTML = `<p>${getMessage('loading')}</p>`;
 
         try {
-            const response = await fetch(`${API_BASE_URL}/users/me/slides`, {
-                headers: {
-                    'Authorization': `Bearer ${token}`
-                }
-            });
+            // メタデータのみの一覧をカーソルで順に取得する（slide_data 本体は取得しない）
+            const slides = [];
+            let cursor = null;
+            let response;
+            do {
+                const params = new URLSearchParams({ limit: '50' });
+                if (cursor) params.set('cursor', cursor);
+                response = await fetch(`${API_BASE_URL}/users/me/slides/summary?${params}`, {
+                    headers: {
+                        'Authorization': `Bearer ${token}`
+                    }
+                });
+                if (!response.ok) break;
+                const page = await response.json();
+                slides.push(...page.items);
+                cursor = page.next_cursor;
+            } while (cursor);
 
             if (response.ok) {
-                const slides = await response.json();
                 renderSlides(slides);
             } else {
                 const errorMessage = getErrorMessage(response, 'slide_fetch_error');
@@ -764,6 +775,19 @@ document.addEventListener('DOMContentLoaded', () => {
                     </div>
                 </div>
             `;
+            if (slide.title) {
+                slideCard.querySelector('.slide-title').textContent = slide.title;
+            }
+            if (slide.thumbnail_url) {
+                const thumbnail = slideCard.querySelector('.slide-thumbnail-placeholder');
+                const placeholderIcon = thumbnail.innerHTML;
+                const img = document.createElement('img');
+                img.alt = '';
+                img.loading = 'lazy';
+                img.addEventListener('error', () => { thumbnail.innerHTML = placeholderIcon; });
+                thumbnail.replaceChildren(img);
+                loadThumbnail(img, slide.thumbnail_url);
+            }
             slideListContainer.appendChild(slideCard);
 
             slideCard.querySelector('.edit-btn').addEventListener('click', () => handleEditSlide(slide.id));
@@ -771,6 +795,27 @@ document.addEventListener('DOMContentLoaded', () => {
         });
     }
 
+    // アップロード済みファイル(/files/...)は認証が必要なため、トークン付きで取得して表示する
+    async function loadThumbnail(img, url) {
+        if (!url.startsWith('/files/')) {
+            img.src = url;
+            return;
+        }
+        try {
+            const response = await fetch(`${API_BASE_URL}${url}`, {
+                headers: {
+                    'Authorization': `Bearer ${getToken()}`
+                }
+            });
+            if (!response.ok) throw new Error(`HTTP ${response.status}`);
+            const objectUrl = URL.createObjectURL(await response.blob());
+            img.addEventListener('load', () => URL.revokeObjectURL(objectUrl), { once: true });
+            img.src = objectUrl;
+        } catch (error) {
+            img.dispatchEvent(new Event('error'));
+        }
+    }
+
     // 既存: 直接スライドを作成する関数（必要時に使用）
     async function handleCreateNewSlide() {
         const token = getToken();
@@ -481,7 +481,9 @@ document.addEventListener('DOMContentLoaded', () => {
             payload.append('is_search', 'false');
 
             try {
-                const res = await fetch('/ai/ask', { method: 'POST', body: payload });
+                const token = localStorage.getItem('access_token');
+                const headers = token ? { 'Authorization': `Bearer ${token}` } : {};
+                const res = await fetch('/ai/ask', { method: 'POST', headers, body: payload });
                 if (!res.ok) {
                     const t = await res.text();
                     throw new Error(`AI request failed: ${res.status} ${t}`);
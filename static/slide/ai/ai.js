@@ -32,6 +32,15 @@ class AIHandler {
         this.init();
     }
 
+    /**
+     * ログイン済みならAIリクエストに認証ヘッダーを付与する（サーバー側でユーザー単位に公平キューイングされる）
+     * @returns {Object<string, string>}
+     */
+    getAuthHeaders() {
+        const token = localStorage.getItem('access_token');
+        return token ? { 'Authorization': `Bearer ${token}` } : {};
+    }
+
     /**
      * plan.htmlから渡されたデータに基づいてスライド生成を開始する
      * @param {object} planData - plan.jsから収集された質問と回答のオブジェクト
@@ -871,6 +880,7 @@ ${result.message}
 
                 const response = await fetch(this.apiEndpoint, {
                     method: 'POST',
+                    headers: this.getAuthHeaders(),
                     body: formData,
                 });
 
@@ -1735,6 +1745,7 @@ ${result.message}
     
                 const response = await fetch(this.apiEndpoint, {
                     method: 'POST',
+                    headers: this.getAuthHeaders(),
                     body: formData,
                 });
     
@@ -616,6 +616,30 @@ import { ColorPicker } from './ColorPicker.js';
                     return { safe: false, reason: 'error' };
                 }
             },
+
+            // 複数URL（または資料全体）の一括チェック（/api/url/safe-check/batch を 1 回だけ呼ぶ）
+            // 返却: { [url]: { safe, reason, matched_domain?, source? } }
+            checkUrlsSafety: async ({ urls = [], slideData = null } = {}, { signal } = {}) => {
+                try {
+                    const body = { urls };
+                    if (slideData) {
+                        body.slide_data = typeof slideData === 'string' ? slideData : JSON.stringify(slideData);
+                    }
+                    const res = await fetch('/api/url/safe-check/batch', {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/json' },
+                        body: JSON.stringify(body),
+                        signal
+                    });
+                    if (!res.ok) {
+                        return null;
+                    }
+                    const data = await res.json();
+                    return Object.fromEntries(data.results.map(({ url, ...verdict }) => [url, verdict]));
+                } catch (e) {
+                    return null;
+                }
+            },
             
             debounce: (func, wait = CONFIG.DEBOUNCE_DELAY) => {
                 let timeout;
@@ -1459,12 +1483,27 @@ static _createIframe(elData) {
                         );
                     }
 
+                    this._checkDeckUrlSafety();
                 } catch (error) {
                     ErrorHandler.handle(error, 'load_state');
                     this.createNewPresentation();
                 }
             },
 
+            // 資料内のURLを /api/url/safe-check/batch 1 回でまとめて確認し、ブロックリストに一致したものを警告する
+            async _checkDeckUrlSafety() {
+                const presentation = this.state.presentation;
+                if (!presentation?.slides?.length) return;
+                const verdicts = await Utils.checkUrlsSafety({ slideData: presentation });
+                if (!verdicts) return;
+                const blocked = Object.entries(verdicts).filter(([, result]) => result.reason === 'matched');
+                if (!blocked.length) return;
+                const list = blocked
+                    .map(([url, result]) => `${url}（${result.matched_domain || ''} / ${result.source || ''}）`)
+                    .join('\n');
+                App.showEmbedWarning(`危険なURLとしてブロックリストに一致したリンクがスライドに含まれています:\n${list}`);
+            },
+
             saveState() {
                 try {
                     const presentation = this.state.presentation;
@@ -5017,6 +5056,7 @@ static _createIframe(elData) {
                             
                             this.saveState();
                             this.render();
+                            this._checkDeckUrlSafety();
                             
                             // 設定パネルの更新
                             this.initSettingsEventListeners();
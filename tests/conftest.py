@@ -4,9 +4,11 @@ import pytest
 from fastapi.testclient import TestClient
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy.pool import StaticPool
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
 from unittest.mock import AsyncMock, patch
 import asyncio
+import tempfile
 
 # テスト実行用の環境変数を設定 (main, module.authなどのインポート前に設定する必要がある)
 os.environ["SECRET_KEY"] = "testsecretkeyforpytestonly12345678"
@@ -18,18 +20,23 @@ os.environ["DATABASE_URL"] = "sqlite:///:memory:"
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from main import app
-from module.database import Base, get_db
+from module.database import Base, get_db, get_async_db, get_async_read_db
 
-# インメモリSQLite用の設定
-SQLALCHEMY_DATABASE_URL = "sqlite:///:memory:"
+# 同期エンジン(テストからの検証用)と非同期エンジン(リクエストハンドラ用)で同じ DB を共有するため、
+# インメモリではなく一時ディレクトリの SQLite ファイルを使う
+_TEST_DB_PATH = os.path.join(tempfile.mkdtemp(), "test.db")
+SQLALCHEMY_DATABASE_URL = f"sqlite:///{_TEST_DB_PATH}"
 
 engine = create_engine(
     SQLALCHEMY_DATABASE_URL,
     connect_args={"check_same_thread": False},
-    poolclass=StaticPool,
 )
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# TestClient はテストごとに別のイベントループで動くため、接続はプールせず都度作成する
+async_engine = create_async_engine(f"sqlite+aiosqlite:///{_TEST_DB_PATH}", poolclass=NullPool)
+TestingAsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
 @pytest.fixture(scope="function")
 def db_session():
     # テーブル作成
@@ -44,8 +51,9 @@ def db_session():
 
 @pytest.fixture(scope="session", autouse=True)
 def mock_blocklist_loader():
-    # 外部通信を行う _ensure_blocklists_loaded をモック化
-    with patch("main._ensure_blocklists_loaded", new_callable=AsyncMock) as mock:
+    # 外部通信を行うブロックリストの更新をモック化
+    import main
+    with patch.object(main.blocklist_refresher, "refresh", new_callable=AsyncMock) as mock:
         yield mock
 
 @pytest.fixture(scope="function")
@@ -59,9 +67,17 @@ def client(db_session):
     # HTTP通信エラーを回避するために、shared_http_client をモックに置き換えるか、
     # lifespan イベントでエラーにならないように調整する。
     # ここでは、TestClient作成時の lifespan イベントによる外部通信エラーを回避するため、
-    # 既にモックした _ensure_blocklists_loaded が効いているはず。
+    # 既にモックした blocklist_refresher.refresh が効いているはず。
+
+    async def override_get_async_db():
+        async with TestingAsyncSessionLocal() as session:
+            yield session
 
     app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    app.dependency_overrides[get_async_read_db] = override_get_async_db
+    import main
+    main.collab_manager.session_factory = TestingAsyncSessionLocal
     # TestClient を使う際に lifespan=True (デフォルト) だと startup/shutdown が走る
     # shared_http_client の close 問題を回避するため、lifespan を無効にするか
     # main.py 側で再利用可能な実装にする必要があるが、
@@ -1,4 +1,14 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import time
+import pytest
+
 from fastapi.testclient import TestClient
+from starlette.websockets import WebSocketDisconnect
 
 def test_read_main(client: TestClient):
     response = client.get("/")
@@ -85,3 +95,1419 @@ def test_duplicate_user_registration(client: TestClient):
     )
     assert response.status_code == 400
     assert "既に使用されています" in response.json()["detail"] or "already exists" in response.json()["detail"]
+
+def test_patch_slide(client: TestClient):
+    client.post(
+        "/auth/register",
+        json={"username": "patchuser", "password": "password"},
+    )
+    login_res = client.post(
+        "/auth/login",
+        data={"username": "patchuser", "password": "password"},
+    )
+    headers = {"Authorization": f"Bearer {login_res.json()['access_token']}"}
+
+    initial = '{"settings":{"width":1280},"slides":[{"id":"s1","elements":[]}]}'
+    response = client.post("/slides", json={"slide_data": initial}, headers=headers)
+    slide = response.json()
+    assert slide["version"] == 1
+
+    # JSON Patch (RFC 6902)
+    response = client.patch(
+        f"/slides/{slide['id']}",
+        json={
+            "version": 1,
+            "patch": [{"op": "add", "path": "/slides/0/elements/-", "value": {"id": "el1", "type": "text"}}],
+        },
+        headers=headers,
+    )
+    assert response.status_code == 200
+    data = response.json()
+    assert data["version"] == 2
+    assert json.loads(data["slide_data"])["slides"][0]["elements"] == [{"id": "el1", "type": "text"}]
+
+    # Merge Patch (RFC 7396)
+    response = client.patch(
+        f"/slides/{slide['id']}",
+        json={"version": 2, "patch_type": "merge-patch", "patch": {"settings": {"width": 1920}}},
+        headers=headers,
+    )
+    assert response.status_code == 200
+    assert json.loads(response.json()["slide_data"])["settings"]["width"] == 1920
+
+    # 古いバージョンを基準にした差分は競合
+    response = client.patch(
+        f"/slides/{slide['id']}",
+        json={"version": 2, "patch": [{"op": "remove", "path": "/settings"}]},
+        headers=headers,
+    )
+    assert response.status_code == 409
+
+    # 適用できない差分
+    response = client.patch(
+        f"/slides/{slide['id']}",
+        json={"version": 3, "patch": [{"op": "remove", "path": "/missing"}]},
+        headers=headers,
+    )
+    assert response.status_code == 422
+
+def test_slide_outline_and_pages(client: TestClient):
+    client.post(
+        "/auth/register",
+        json={"username": "pageuser", "password": "password"},
+    )
+    login_res = client.post(
+        "/auth/login",
+        data={"username": "pageuser", "password": "password"},
+    )
+    headers = {"Authorization": f"Bearer {login_res.json()['access_token']}"}
+
+    presentation = {
+        "settings": {"width": 1280, "height": 720},
+        "slides": [
+            {"id": f"s{i}", "elements": [{"id": f"el{i}", "type": "text", "content": f"page {i}"}]}
+            for i in range(5)
+        ],
+    }
+    response = client.post("/slides", json={"slide_data": json.dumps(presentation)}, headers=headers)
+    slide = response.json()
+    assert json.loads(slide["slide_data"]) == presentation
+
+    # アウトラインにはページ本文を含まない
+    response = client.get(f"/slides/{slide['id']}/outline", headers=headers)
+    assert response.status_code == 200
+    outline = response.json()
+    assert outline["outline"] == {"settings": {"width": 1280, "height": 720}}
+    assert outline["page_count"] == 5
+    assert [page["page_id"] for page in outline["pages"]] == ["s0", "s1", "s2", "s3", "s4"]
+
+    # 個別ページ
+    response = client.get(f"/slides/{slide['id']}/pages/3", headers=headers)
+    assert response.status_code == 200
+    assert response.json() == presentation["slides"][3]
+    assert client.get(f"/slides/{slide['id']}/pages/5", headers=headers).status_code == 404
+
+    # 範囲取得 (NDJSON)
+    response = client.get(f"/slides/{slide['id']}/pages?start=1&limit=2", headers=headers)
+    assert response.status_code == 200
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    assert [line["index"] for line in lines] == [1, 2]
+    assert lines[0]["page"] == presentation["slides"][1]
+
+    # ページの削除・並べ替えを含む差分
+    response = client.patch(
+        f"/slides/{slide['id']}",
+        json={
+            "version": 1,
+            "patch": [
+                {"op": "remove", "path": "/slides/0"},
+                {"op": "move", "from": "/slides/3", "path": "/slides/0"},
+            ],
+        },
+        headers=headers,
+    )
+    assert response.status_code == 200
+    patched = json.loads(response.json()["slide_data"])
+    assert [page["id"] for page in patched["slides"]] == ["s4", "s1", "s2", "s3"]
+
+    response = client.get(f"/slides/{slide['id']}/outline", headers=headers)
+    assert [page["page_id"] for page in response.json()["pages"]] == ["s4", "s1", "s2", "s3"]
+
+    # inline 形式の概要も page_id を文字列にそろえる
+    from module.models import Slide
+    from module.slidestore import STORAGE_INLINE, get_outline
+    legacy = Slide(storage_format=STORAGE_INLINE, slide_data=json.dumps({"slides": [{"id": 7}, {"elements": []}]}))
+    assert [page["page_id"] for page in get_outline(None, legacy)[1]] == ["7", None]
+
+def test_slide_summary_pagination(client: TestClient):
+    client.post(
+        "/auth/register",
+        json={"username": "summaryuser", "password": "password"},
+    )
+    login_res = client.post(
+        "/auth/login",
+        data={"username": "summaryuser", "password": "password"},
+    )
+    headers = {"Authorization": f"Bearer {login_res.json()['access_token']}"}
+
+    for i in range(3):
+        presentation = {
+            "slides": [
+                {"id": "s1", "elements": [
+                    {"id": "el1", "type": "text", "content": f"<b>Deck {i}</b>"},
+                    {"id": "el2", "type": "image", "content": f"/files/{i}"},
+                ]},
+                {"id": "s2", "elements": []},
+            ],
+        }
+        client.post("/slides", json={"slide_data": json.dumps(presentation)}, headers=headers)
+
+    response = client.get("/users/me/slides/summary?limit=2", headers=headers)
+    assert response.status_code == 200
+    first_page = response.json()
+    assert [item["title"] for item in first_page["items"]] == ["Deck 2", "Deck 1"]
+    assert first_page["items"][0]["page_count"] == 2
+    # 一覧では原寸ではなく縮小版を読み込む
+    assert first_page["items"][0]["thumbnail_url"] == "/files/2?w=320"
+    assert "slide_data" not in first_page["items"][0]
+    assert first_page["next_cursor"] is not None
+
+    response = client.get(f"/users/me/slides/summary?limit=2&cursor={first_page['next_cursor']}", headers=headers)
+    second_page = response.json()
+    assert [item["title"] for item in second_page["items"]] == ["Deck 0"]
+    assert second_page["next_cursor"] is None
+
+    from module.slidestore import _thumbnail_variant_url
+    assert _thumbnail_variant_url("https://upload.wikimedia.org/wikipedia/commons/a/ab/Cat.jpg") == (
+        "https://upload.wikimedia.org/wikipedia/commons/thumb/a/ab/Cat.jpg/320px-Cat.jpg"
+    )
+    assert _thumbnail_variant_url("https://example.com/cat.jpg") == "https://example.com/cat.jpg"
+
+    # メタデータ列の追加前から存在するスライドは起動時に埋める
+    from conftest import TestingSessionLocal
+    from module.models import Slide
+    from module.slidestore import backfill_metadata
+    deck_id = second_page["items"][0]["id"]
+    with TestingSessionLocal() as db:
+        db.query(Slide).filter(Slide.id == deck_id).update(
+            {Slide.title: None, Slide.page_count: 0, Slide.thumbnail_url: None, Slide.updated_at: None}
+        )
+        db.commit()
+        assert backfill_metadata(db) == 1
+        assert backfill_metadata(db) == 0
+    item = client.get(f"/users/me/slides/summary?limit=2&cursor={first_page['next_cursor']}", headers=headers).json()["items"][0]
+    assert (item["title"], item["page_count"], item["thumbnail_url"]) == ("Deck 0", 2, "/files/0?w=320")
+
+def _png_bytes(color=(255, 0, 0)) -> bytes:
+    from PIL import Image
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8), color).save(buf, format="PNG")
+    return buf.getvalue()
+
+def test_upload_deduplicates_blobs(client: TestClient, tmp_path, monkeypatch):
+    import main
+    from module.blobstore import BlobStore
+    monkeypatch.setattr(main, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "blob_store", BlobStore(str(tmp_path / "blobs")))
+
+    client.post(
+        "/auth/register",
+        json={"username": "uploaduser", "password": "password"},
+    )
+    login_res = client.post(
+        "/auth/login",
+        data={"username": "uploaduser", "password": "password"},
+    )
+    headers = {"Authorization": f"Bearer {login_res.json()['access_token']}"}
+
+    png = _png_bytes()
+    blob_path = main.blob_store.path_for(hashlib.sha256(png).hexdigest())
+    ids = []
+    inodes = []
+    for name in ("logo.png", "logo-copy.png"):
+        response = client.post(
+            "/upload/image",
+            files={"file": (name, png, "image/png")},
+            headers=headers,
+        )
+        assert response.status_code == 200
+        ids.append(response.json()["id"])
+        inodes.append(os.stat(blob_path).st_ino)
+
+    # 同一内容の 2 回目は書き込まず、既存のファイルをそのまま使う
+    assert inodes[0] == inodes[1]
+    stored = [p for p in (tmp_path / "blobs").rglob("*") if p.is_file()]
+    assert stored == [Path(blob_path)]
+    assert main.blob_store._locks == {}
+
+    response = client.get(f"/files/{ids[1]}", headers=headers)
+    assert response.status_code == 200
+    assert response.content == png
+
+    # 参照が残っている間は実体を削除しない
+    assert client.delete(f"/files/{ids[0]}", headers=headers).status_code == 200
+    assert os.path.exists(blob_path)
+    assert client.delete(f"/files/{ids[1]}", headers=headers).status_code == 200
+    assert not os.path.exists(blob_path)
+
+def test_streaming_upload(client: TestClient, tmp_path, monkeypatch):
+    import main
+    from module.blobstore import BlobStore
+    monkeypatch.setattr(main, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "blob_store", BlobStore(str(tmp_path / "blobs")))
+
+    client.post(
+        "/auth/register",
+        json={"username": "streamuser", "password": "password"},
+    )
+    login_res = client.post(
+        "/auth/login",
+        data={"username": "streamuser", "password": "password"},
+    )
+    headers = {"Authorization": f"Bearer {login_res.json()['access_token']}"}
+
+    png = _png_bytes((0, 128, 255))
+    response = client.put(
+        "/upload/image/stream?filename=photo.png",
+        content=png,
+        headers={**headers, "Content-Type": "image/png"},
+    )
+    assert response.status_code == 200
+    assert response.json()["filename"] == "photo.png"
+    assert client.get(f"/files/{response.json()['id']}", headers=headers).content == png
+
+    # 申告された MIME タイプと中身が一致しない
+    response = client.put(
+        "/upload/image/stream?filename=fake.png",
+        content=b"<html>not an image</html>",
+        headers={**headers, "Content-Type": "image/png"},
+    )
+    assert response.status_code == 400
+
+    # 受信中にサイズ上限を超えた場合は中断する
+    monkeypatch.setitem(main.MAX_FILE_SIZES, "image", len(png) - 1)
+    response = client.put(
+        "/upload/image/stream?filename=photo.png",
+        content=iter([png[:10], png[10:]]),
+        headers={**headers, "Content-Type": "image/png"},
+    )
+    assert response.status_code == 413
+    assert list((tmp_path / "blobs" / "tmp").iterdir()) == []
+
+def test_resumable_upload(client: TestClient, tmp_path, monkeypatch):
+    import main
+    from module.blobstore import BlobStore
+    monkeypatch.setattr(main, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "blob_store", BlobStore(str(tmp_path / "blobs")))
+
+    client.post(
+        "/auth/register",
+        json={"username": "resumeuser", "password": "password"},
+    )
+    login_res = client.post(
+        "/auth/login",
+        data={"username": "resumeuser", "password": "password"},
+    )
+    headers = {"Authorization": f"Bearer {login_res.json()['access_token']}"}
+
+    video = b"\x00\x00\x00\x18ftypmp42" + os.urandom(4096)
+    response = client.post(
+        "/upload/video/sessions",
+        json={"filename": "clip.mp4", "size": len(video), "content_type": "video/mp4"},
+        headers=headers,
+    )
+    assert response.status_code == 201
+    upload_id = response.json()["upload_id"]
+
+    response = client.patch(
+        f"/upload/sessions/{upload_id}",
+        content=video[:1000],
+        headers={**headers, "Upload-Offset": "0"},
+    )
+    assert response.status_code == 200
+    assert response.json()["offset"] == 1000
+
+    # 未完了のままでは完了できない
+    assert client.post(f"/upload/sessions/{upload_id}/complete", headers=headers).status_code == 409
+    # オフセット不一致（再送の重複など）は 409
+    response = client.patch(
+        f"/upload/sessions/{upload_id}",
+        content=video[:1000],
+        headers={**headers, "Upload-Offset": "0"},
+    )
+    assert response.status_code == 409
+    # 同じセッションへの追記が処理中の間は、オフセットが一致していても書き込まない
+    main._upload_appending.add(upload_id)
+    response = client.patch(
+        f"/upload/sessions/{upload_id}",
+        content=video[1000:2000],
+        headers={**headers, "Upload-Offset": "1000"},
+    )
+    main._upload_appending.discard(upload_id)
+    assert response.status_code == 409
+    assert main._upload_hashers[upload_id][0] == 1000
+
+    # 再開: 現在のオフセットを取得して続きを送る
+    offset = client.get(f"/upload/sessions/{upload_id}", headers=headers).json()["offset"]
+    response = client.patch(
+        f"/upload/sessions/{upload_id}",
+        content=video[offset:],
+        headers={**headers, "Upload-Offset": str(offset)},
+    )
+    assert response.json()["offset"] == len(video)
+
+    response = client.post(f"/upload/sessions/{upload_id}/complete", headers=headers)
+    assert response.status_code == 200
+    file_id = response.json()["id"]
+    assert client.get(f"/files/{file_id}", headers=headers).content == video
+    assert os.path.exists(main.blob_store.path_for(hashlib.sha256(video).hexdigest()))
+    assert client.get(f"/upload/sessions/{upload_id}", headers=headers).status_code == 404
+    assert list((tmp_path / "blobs" / "tmp").iterdir()) == []
+
+def test_file_conditional_and_range_requests(client: TestClient, tmp_path, monkeypatch):
+    import main
+    from module.blobstore import BlobStore
+    monkeypatch.setattr(main, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "blob_store", BlobStore(str(tmp_path / "blobs")))
+
+    client.post(
+        "/auth/register",
+        json={"username": "rangeuser", "password": "password"},
+    )
+    login_res = client.post(
+        "/auth/login",
+        data={"username": "rangeuser", "password": "password"},
+    )
+    headers = {"Authorization": f"Bearer {login_res.json()['access_token']}"}
+
+    video = b"\x1a\x45\xdf\xa3" + bytes(range(256)) * 4
+    response = client.put(
+        "/upload/video/stream?filename=clip.webm",
+        content=video,
+        headers={**headers, "Content-Type": "video/webm"},
+    )
+    file_id = response.json()["id"]
+
+    response = client.get(f"/files/{file_id}", headers=headers)
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert etag == f'"{hashlib.sha256(video).hexdigest()}"'
+    assert "immutable" in response.headers["cache-control"]
+    assert response.headers["content-type"] == "video/webm"
+
+    # 条件付き GET
+    response = client.get(f"/files/{file_id}", headers={**headers, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+    response = client.get(
+        f"/files/{file_id}",
+        headers={**headers, "If-Modified-Since": response.headers["last-modified"]},
+    )
+    assert response.status_code == 304
+
+    # 単一 Range
+    response = client.get(f"/files/{file_id}", headers={**headers, "Range": "bytes=4-9"})
+    assert response.status_code == 206
+    assert response.content == video[4:10]
+
+    # 複数 Range
+    response = client.get(f"/files/{file_id}", headers={**headers, "Range": "bytes=0-1,100-101"})
+    assert response.status_code == 206
+    assert response.headers["content-type"].startswith("multipart/byteranges")
+
+def test_image_variants(client: TestClient, tmp_path, monkeypatch):
+    import main
+    from PIL import Image
+    from module.blobstore import BlobStore
+    monkeypatch.setattr(main, "UPLOAD_DIR", str(tmp_path))
+    monkeypatch.setattr(main, "blob_store", BlobStore(str(tmp_path / "blobs")))
+    monkeypatch.setattr(main, "VARIANT_CACHE_DIR", str(tmp_path / "variants"))
+
+    client.post(
+        "/auth/register",
+        json={"username": "variantuser", "password": "password"},
+    )
+    login_res = client.post(
+        "/auth/login",
+        data={"username": "variantuser", "password": "password"},
+    )
+    headers = {"Authorization": f"Bearer {login_res.json()['access_token']}"}
+
+    buf = io.BytesIO()
+    Image.new("RGB", (400, 200), (10, 200, 30)).save(buf, format="JPEG")
+    response = client.post(
+        "/upload/image",
+        files={"file": ("wide.jpg", buf.getvalue(), "image/jpeg")},
+        headers=headers,
+    )
+    file_id = response.json()["id"]
+
+    # 要求幅は定義済みの幅(160)に丸められる
+    response = client.get(f"/files/{file_id}?w=150&format=webp", headers=headers)
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+    with Image.open(io.BytesIO(response.content)) as variant:
+        assert variant.size == (160, 80)
+
+    # 生成済みの縮小版はキャッシュから返し、ETag で 304 にできる
+    response = client.get(
+        f"/files/{file_id}?w=150&format=webp",
+        headers={**headers, "If-None-Match": response.headers["etag"]},
+    )
+    assert response.status_code == 304
+    assert len(list((tmp_path / "variants").rglob("*.webp"))) == 1
+
+    # 最後の参照を削除すると縮小版も消える
+    client.delete(f"/files/{file_id}", headers=headers)
+    assert list((tmp_path / "variants").rglob("*.webp")) == []
+
+def test_prepare_image_for_model():
+    from PIL import Image
+    from module.imaging import prepare_image_for_model
+
+    # 上限内の JPEG は再エンコードせずにそのまま送る
+    buf = io.BytesIO()
+    Image.new("RGB", (640, 480), (200, 10, 10)).save(buf, format="JPEG")
+    assert prepare_image_for_model(buf.getvalue(), max_edge=1024) == ("image/jpeg", buf.getvalue())
+
+    # 大きな透過画像は縮小して WebP に
+    buf = io.BytesIO()
+    Image.new("RGBA", (4000, 1000), (0, 0, 255, 128)).save(buf, format="PNG")
+    mime_type, data = prepare_image_for_model(buf.getvalue(), max_edge=1024)
+    assert mime_type == "image/webp"
+    with Image.open(io.BytesIO(data)) as prepared:
+        assert prepared.size == (1024, 256)
+
+    # 透過のない画像は JPEG に
+    buf = io.BytesIO()
+    Image.new("RGB", (3000, 3000), (0, 0, 0)).save(buf, format="PNG")
+    mime_type, data = prepare_image_for_model(buf.getvalue(), max_edge=1024)
+    assert mime_type == "image/jpeg"
+    assert len(data) < len(buf.getvalue())
+
+    # 解像度が上限内でもバイト数の大きい PNG はそのまま送らず再エンコードする
+    buf = io.BytesIO()
+    Image.frombytes("RGB", (800, 800), os.urandom(800 * 800 * 3)).save(buf, format="PNG")
+    mime_type, data = prepare_image_for_model(buf.getvalue(), max_edge=1024, passthrough_bytes=512 * 1024)
+    assert mime_type == "image/jpeg"
+    assert len(data) < len(buf.getvalue())
+
+class _FakeGeminiModels:
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.calls = []
+
+    async def generate_content_stream(self, *, model, contents, config=None):
+        self.calls.append({"model": model, "contents": contents, "config": config})
+
+        async def stream():
+            for text in self.chunks:
+                yield type("Chunk", (), {"text": text})()
+        return stream()
+
+class _FakeGeminiClient:
+    def __init__(self, chunks):
+        self.aio = type("AsyncClient", (), {})()
+        self.aio.models = _FakeGeminiModels(chunks)
+
+def _use_fresh_ai_cache(monkeypatch, db_session):
+    import main
+    from sqlalchemy.orm import sessionmaker
+    from module.aicache import AIResponseCache
+
+    cache = AIResponseCache(sessionmaker(bind=db_session.get_bind()))
+    monkeypatch.setattr(main, "ai_response_cache", cache)
+    return cache
+
+def test_ai_ask_streams_with_shared_client(client: TestClient, db_session, monkeypatch):
+    import main
+
+    _use_fresh_ai_cache(monkeypatch, db_session)
+    fake = _FakeGeminiClient(["Hello", ", ", "world"])
+    monkeypatch.setattr(main, "gemini_client", fake)
+
+    for prompt in ("hi", "hello"):
+        response = client.post("/ai/ask", data={"prompt": prompt})
+        assert response.status_code == 200
+        assert response.text == "Hello, world"
+
+    # リクエストごとにクライアントを作らず、共有クライアントの非同期 API を使う
+    assert main.gemini_client is fake
+    assert len(fake.aio.models.calls) == 2
+    assert fake.aio.models.calls[0]["contents"] == ["hi"]
+
+def test_ai_ask_response_cache(client: TestClient, db_session, monkeypatch):
+    import main
+
+    cache = _use_fresh_ai_cache(monkeypatch, db_session)
+    fake = _FakeGeminiClient(["Slide ", "outline"])
+    monkeypatch.setattr(main, "gemini_client", fake)
+
+    response = client.post("/ai/ask", data={"prompt": "Make  an outline\r\n"})
+    assert response.headers["X-AI-Cache"] == "miss"
+    assert response.text == "Slide outline"
+
+    # 空白・改行コードの違いは同じプロンプトとして扱い、上流へは送らない
+    response = client.post("/ai/ask", data={"prompt": "Make an outline"})
+    assert response.headers["X-AI-Cache"] == "hit"
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.text == "Slide outline"
+    assert len(fake.aio.models.calls) == 1
+
+    # メモリ層を失ってもディスク層から復元できる
+    cache.clear_memory()
+    response = client.post("/ai/ask", data={"prompt": "Make an outline"})
+    assert response.headers["X-AI-Cache"] == "hit"
+    assert len(fake.aio.models.calls) == 1
+
+    # 検索フラグと画像はキーに含まれる
+    response = client.post("/ai/ask", data={"prompt": "Make an outline", "is_search": "true"})
+    assert response.headers["X-AI-Cache"] == "miss"
+    response = client.post(
+        "/ai/ask", data={"prompt": "Make an outline"},
+        files={"image": ("a.png", _png_bytes(), "image/png")},
+    )
+    assert response.headers["X-AI-Cache"] == "miss"
+    assert len(fake.aio.models.calls) == 3
+
+    # エラーで終わった応答はキャッシュしない
+    fake.aio.models.chunks = None
+    response = client.post("/ai/ask", data={"prompt": "broken"})
+    assert response.text.startswith("Error:")
+    fake.aio.models.chunks = ["ok"]
+    response = client.post("/ai/ask", data={"prompt": "broken"})
+    assert response.text == "ok"
+
+def test_ai_scheduler_fair_queuing():
+    import asyncio
+    from module.scheduler import AIScheduler, SchedulerBusy
+
+    async def scenario():
+        scheduler = AIScheduler(max_concurrency=1, max_queue_per_user=3, max_queue=10, rate_per_minute=0)
+        first = await scheduler.acquire("user:a")
+        order = []
+
+        async def run(key):
+            slot = await scheduler.acquire(key)
+            order.append(key)
+            slot.release()
+
+        # a が 3 件、b が 1 件待っていても、b は a の 2 件目より先に処理される
+        tasks = [asyncio.create_task(run(key)) for key in ("user:a", "user:a", "user:a", "user:b")]
+        await asyncio.sleep(0)
+        with pytest.raises(SchedulerBusy) as busy:
+            await scheduler.acquire("user:a")
+        assert busy.value.retry_after >= 1
+
+        first.release()
+        first.release()  # 二重解放は無視される
+        await asyncio.gather(*tasks)
+        assert order == ["user:a", "user:b", "user:a", "user:a"]
+        assert scheduler.stats()["active"] == 0 and scheduler.queued == 0
+
+        # トークンバケット: バースト分を使い切ると拒否される
+        limited = AIScheduler(max_concurrency=10, rate_per_minute=1, burst=2)
+        for _ in range(2):
+            (await limited.acquire("ip:1")).release()
+        with pytest.raises(SchedulerBusy):
+            await limited.acquire("ip:1")
+        (await limited.acquire("ip:2")).release()
+
+    asyncio.run(scenario())
+
+def test_ai_ask_rate_limited(client: TestClient, db_session, monkeypatch):
+    import main
+    from module.scheduler import AIScheduler
+
+    _use_fresh_ai_cache(monkeypatch, db_session)
+    monkeypatch.setattr(main, "gemini_client", _FakeGeminiClient(["ok"]))
+    monkeypatch.setattr(main, "ai_scheduler", AIScheduler(rate_per_minute=1, burst=1))
+
+    assert client.post("/ai/ask", data={"prompt": "one"}).status_code == 200
+    response = client.post("/ai/ask", data={"prompt": "two"})
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) >= 1
+    assert main.ai_scheduler.active == 0
+
+    # キャッシュヒットはレート制限の対象外
+    assert client.post("/ai/ask", data={"prompt": "one"}).status_code == 200
+
+def test_login_rehashes_password_when_cost_changes(client: TestClient, db_session, monkeypatch):
+    import module.auth as auth
+    from module.models import User
+
+    monkeypatch.setattr(auth, "BCRYPT_ROUNDS", 4)
+    client.post("/auth/register", json={"username": "rehash", "password": "secret-pass"})
+    user = db_session.query(User).filter_by(username="rehash").one()
+    assert user.hashed_password.startswith("$2b$04$")
+
+    completed = auth.password_hasher.stats()["completed"]
+    monkeypatch.setattr(auth, "BCRYPT_ROUNDS", 5)
+    response = client.post("/auth/login", data={"username": "rehash", "password": "secret-pass"})
+    assert response.status_code == 200
+    db_session.refresh(user)
+    assert user.hashed_password.startswith("$2b$05$")
+    # 検証と再ハッシュは専用スレッドプールで実行される
+    assert auth.password_hasher.stats()["completed"] == completed + 2
+
+    # 再ハッシュ後のパスワードでログインでき、再度のハッシュは行わない
+    response = client.post("/auth/login", data={"username": "rehash", "password": "secret-pass"})
+    assert response.status_code == 200
+    assert auth.password_hasher.stats()["completed"] == completed + 3
+    response = client.post("/auth/login", data={"username": "rehash", "password": "wrong"})
+    assert response.status_code == 401
+
+    # 待ちが上限に達していれば bcrypt を積まずに 503 + Retry-After で断る
+    rejected = auth.password_hasher.stats()["rejected"]
+    monkeypatch.setattr(auth.password_hasher, "max_pending", 0)
+    response = client.post("/auth/login?lang=en", data={"username": "rehash", "password": "secret-pass"})
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+    assert response.json()["detail"] == "Authentication is busy. Please retry later"
+    stats = auth.password_hasher.stats()
+    assert stats["rejected"] == rejected + 1
+    assert stats["completed"] == completed + 4
+    assert stats["queued"] == 0
+
+def test_async_database_url_mapping():
+    from module.database import to_async_url
+
+    assert to_async_url("sqlite:///./data/data.db") == "sqlite+aiosqlite:///./data/data.db"
+    assert to_async_url("postgresql://u:p@db/app") == "postgresql+asyncpg://u:p@db/app"
+    # ドライバ指定済みの URL は変更しない
+    assert to_async_url("postgresql+asyncpg://u:p@db/app") == "postgresql+asyncpg://u:p@db/app"
+
+def test_sqlite_production_profile(tmp_path):
+    from sqlalchemy import create_engine, text
+    from module.database import configure_sqlite_engine, to_read_only_url
+
+    url = f"sqlite:///{tmp_path / 'tuned.db'}"
+    engine = create_engine(url)
+    configure_sqlite_engine(engine)
+    with engine.begin() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == 5000
+        assert conn.execute(text("PRAGMA temp_store")).scalar() == 2  # MEMORY
+        conn.execute(text("CREATE TABLE t (a INTEGER)"))
+        conn.execute(text("INSERT INTO t VALUES (1)"))
+
+    # 読み取り専用プールの接続は読めるが書き込めない
+    read_engine = create_engine(to_read_only_url(url))
+    configure_sqlite_engine(read_engine, read_only=True)
+    with read_engine.connect() as conn:
+        assert conn.execute(text("SELECT a FROM t")).scalar() == 1
+        with pytest.raises(Exception):
+            conn.execute(text("INSERT INTO t VALUES (2)"))
+    read_engine.dispose()
+    engine.dispose()
+
+def test_authenticated_user_cache(client: TestClient, db_session):
+    from jose import jwt
+    import module.auth as auth
+    from module.models import User
+
+    client.post("/auth/register", json={"username": "cached", "password": "cached-pass"})
+    token = client.post("/auth/login", data={"username": "cached", "password": "cached-pass"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    claims = jwt.get_unverified_claims(token)
+    assert claims["sub"] == "cached" and isinstance(claims["uid"], int) and claims["jti"]
+
+    assert client.get("/users/me", headers=headers).json()["username"] == "cached"
+    # 2 回目以降は users テーブルを参照しない（DB を直接書き換えてもキャッシュの値が返る）
+    user = db_session.query(User).filter_by(username="cached").one()
+    user.username = "renamed-directly"
+    db_session.commit()
+    assert client.get("/users/me", headers=headers).json()["username"] == "cached"
+    user.username = "cached"
+    db_session.commit()
+
+    # ユーザー名の変更でキャッシュが破棄され、変更前のトークンは無効になる
+    response = client.put("/users/me/username", json={"new_username": "cached2"}, headers=headers)
+    assert response.status_code == 200
+    assert client.get("/users/me", headers=headers).status_code == 401
+    assert not any(principal.id == claims["uid"] for _, principal in auth._principal_cache.values())
+
+    token = client.post("/auth/login", data={"username": "cached2", "password": "cached-pass"}).json()["access_token"]
+    assert client.get("/users/me", headers={"Authorization": f"Bearer {token}"}).json()["username"] == "cached2"
+
+
+def test_collaborative_editing(client: TestClient):
+    client.post("/auth/register", json={"username": "collab", "password": "collab-pass"})
+    token = client.post("/auth/login", data={"username": "collab", "password": "collab-pass"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    presentation = {
+        "settings": {"width": 1280, "height": 720},
+        "slides": [{"id": "s1", "elements": [
+            {"id": "e1", "type": "text", "content": "hello", "style": {"left": 0, "top": 0, "width": 100, "height": 50}},
+        ]}],
+    }
+    slide = client.post("/slides", json={"slide_data": json.dumps(presentation)}, headers=headers).json()
+
+    with client.websocket_connect(f"/ws/collaborate/{slide['id']}?token={token}") as ws1, \
+            client.websocket_connect(f"/ws/collaborate/{slide['id']}?token={token}") as ws2:
+        snapshot1 = ws1.receive_json()
+        snapshot2 = ws2.receive_json()
+        assert snapshot1["type"] == snapshot2["type"] == "snapshot"
+        assert snapshot1["doc"] == presentation
+        assert snapshot1["client_id"] != snapshot2["client_id"]
+
+        # ドラッグ中の連続した移動は最後の値にまとめて配信される
+        ws1.send_json({"type": "ops", "seq": 1, "ops": [
+            {"op": "move", "page": "s1", "el": "e1", "style": {"left": 10, "top": 5}, "ts": 1},
+            {"op": "move", "page": "s1", "el": "e1", "style": {"left": 20, "top": 8}, "ts": 2},
+        ]})
+        assert ws1.receive_json() == {"type": "ack", "seq": 1, "clock": 2}
+        received = ws2.receive_json()
+        assert received["type"] == "ops"
+        assert {(op["path"], op["value"]) for op in received["ops"]} == {("style.left", 20), ("style.top", 8)}
+
+        # 同じ項目への古い操作は LWW で無視され、新しい操作は送信元以外に配信される
+        ws2.send_json({"type": "ops", "seq": 7, "ops": [
+            {"op": "set", "page": "s1", "el": "e1", "path": "style.left", "value": 99, "ts": 1},
+            {"op": "set", "page": "s1", "el": "e1", "path": "content", "value": "world", "ts": 3},
+            {"op": "insert", "page": "s1", "el": "e2", "value": {"type": "text", "content": "new"}, "ts": 3},
+        ]})
+        assert ws2.receive_json() == {"type": "ack", "seq": 7, "clock": 3}
+        received = ws1.receive_json()
+        assert [op["op"] for op in received["ops"]] == ["set", "insert"]
+
+        ws1.send_json({"type": "sync"})
+        document = ws1.receive_json()["doc"]
+        assert document["slides"][0]["elements"] == [
+            {"id": "e1", "type": "text", "content": "world", "style": {"left": 20, "top": 8, "width": 100, "height": 50}},
+            {"id": "e2", "type": "text", "content": "new"},
+        ]
+
+    # 最後の接続が切れるとマージ済みの状態が保存される
+    for _ in range(50):
+        response = client.get(f"/slides/{slide['id']}", headers=headers)
+        if response.json()["version"] != slide["version"]:
+            break
+        time.sleep(0.05)
+    assert json.loads(response.json()["slide_data"]) == document
+    assert response.json()["version"] == slide["version"] + 1
+
+    # 他人のスライドには参加できない
+    client.post("/auth/register", json={"username": "intruder", "password": "intruder-pass"})
+    other = client.post("/auth/login", data={"username": "intruder", "password": "intruder-pass"}).json()["access_token"]
+    with pytest.raises(WebSocketDisconnect):
+        with client.websocket_connect(f"/ws/collaborate/{slide['id']}?token={other}") as ws:
+            ws.receive_json()
+
+
+class _FakeWebSocket:
+    def __init__(self, block: bool = False):
+        self.sent = []
+        self.closed = None
+        self._block = block
+
+    async def send_text(self, data):
+        if self._block:
+            await asyncio.Event().wait()
+        self.sent.append(json.loads(data))
+
+    async def close(self, code=1000, reason=""):
+        self.closed = (code, reason)
+
+
+def test_collaboration_backplane_and_backpressure(client: TestClient):
+    from conftest import TestingAsyncSessionLocal
+    from module.backplane import InProcessBackplane, encode_command
+    from module.collab import CollabManager, SEND_QUEUE_SIZE
+
+    assert encode_command("PUBLISH", "collab:1", b"{}") == b"*3\r\n$7\r\nPUBLISH\r\n$8\r\ncollab:1\r\n$2\r\n{}\r\n"
+
+    client.post("/auth/register", json={"username": "workers", "password": "workers-pass"})
+    token = client.post("/auth/login", data={"username": "workers", "password": "workers-pass"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    presentation = {"slides": [{"id": "s1", "elements": [{"id": "e1", "type": "text", "content": "a"}]}]}
+    slide = client.post("/slides", json={"slide_data": json.dumps(presentation)}, headers=headers).json()
+    user_id = client.get("/users/me", headers=headers).json()["id"]
+
+    async def scenario():
+        # 2 つのワーカーを 1 つのバックプレーンでつないだ構成
+        backplane = InProcessBackplane()
+        worker_a = CollabManager(TestingAsyncSessionLocal, backplane)
+        worker_b = CollabManager(TestingAsyncSessionLocal, backplane)
+        ws_a, ws_b = _FakeWebSocket(), _FakeWebSocket()
+
+        room_a, conn_a = await worker_a.join(slide["id"], ws_a, user_id)
+        conn_a.start()
+        await room_a.handle_message(conn_a, {"type": "ops", "ops": [
+            {"op": "set", "page": "s1", "el": "e1", "path": "content", "value": "from a", "ts": 1},
+        ]})
+        await asyncio.sleep(0.01)
+
+        # 後から作られたルームは、未保存の変更を他のワーカーから受け取る
+        room_b, conn_b = await worker_b.join(slide["id"], ws_b, user_id)
+        conn_b.start()
+        await asyncio.sleep(0.01)
+        assert room_b.materialize() == room_a.materialize()
+
+        await room_b.handle_message(conn_b, {"type": "ops", "ops": [
+            {"op": "move", "page": "s1", "el": "e1", "style": {"left": 5}, "ts": 2},
+        ]})
+        await asyncio.sleep(0.1)
+        assert room_a.materialize()["slides"][0]["elements"][0] == {
+            "id": "e1", "type": "text", "content": "from a", "style": {"left": 5},
+        }
+        assert [op["value"] for op in ws_a.sent[-1]["ops"]] == [5]
+
+        # 受信の遅いクライアントは送信キューが溢れた時点で切断される
+        slow = _FakeWebSocket(block=True)
+        room, conn_slow = await worker_a.join(slide["id"], slow, user_id)
+        conn_slow.start()
+        for i in range(SEND_QUEUE_SIZE + 2):
+            conn_slow.send({"type": "ops", "ops": [], "n": i})
+        await asyncio.sleep(0)
+        assert conn_slow.overflowed and slow.closed == (1013, "Client too slow")
+        assert conn_slow._queue.empty()
+
+        for manager, room, connection in ((worker_a, room_a, conn_slow), (worker_a, room_a, conn_a), (worker_b, room_b, conn_b)):
+            await manager.leave(room, connection)
+        await backplane.close()
+
+    asyncio.run(scenario())
+    response = client.get(f"/slides/{slide['id']}", headers=headers)
+    assert json.loads(response.json()["slide_data"])["slides"][0]["elements"][0]["style"] == {"left": 5}
+
+
+class _RESPServer:
+    """RedisBackplane のテスト用に PUBLISH/SUBSCRIBE だけを実装した RESP サーバー"""
+
+    def __init__(self):
+        self.commands = []
+        self.subscribers = {}
+        self.writers = set()
+
+    async def handle(self, reader, writer):
+        from module.backplane import encode_command, read_reply
+
+        self.writers.add(writer)
+        try:
+            while True:
+                command = await read_reply(reader)
+                name, args = command[0].decode().upper(), command[1:]
+                self.commands.append(name)
+                if name in ("SUBSCRIBE", "UNSUBSCRIBE"):
+                    for channel in args:
+                        channel = channel.decode()
+                        subscribers = self.subscribers.setdefault(channel, set())
+                        if name == "SUBSCRIBE":
+                            subscribers.add(writer)
+                        else:
+                            subscribers.discard(writer)
+                        writer.write(encode_command(name.lower(), channel, len(subscribers)))
+                elif name == "PUBLISH":
+                    subscribers = self.subscribers.get(args[0].decode(), set())
+                    for subscriber in subscribers:
+                        subscriber.write(encode_command("message", args[0], args[1]))
+                    writer.write(b":%d\r\n" % len(subscribers))
+                else:
+                    writer.write(b"+OK\r\n")
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.writers.discard(writer)
+            for subscribers in self.subscribers.values():
+                subscribers.discard(writer)
+            writer.close()
+
+    def drop(self):
+        """すべての接続を切る（サーバーの再起動相当）"""
+        self.subscribers.clear()
+        for writer in list(self.writers):
+            writer.close()
+
+
+def test_redis_backplane_over_resp_server():
+    import tempfile
+    from module.backplane import Backplane, RedisBackplane
+
+    with pytest.raises(TypeError):
+        Backplane()
+
+    async def until(condition):
+        for _ in range(200):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        raise AssertionError("condition not met")
+
+    async def scenario(path):
+        server = _RESPServer()
+        unix_server = await asyncio.start_unix_server(server.handle, path)
+        backplane = RedisBackplane(f"unix://:secret@{path}")
+        backplane.RECONNECT_DELAY = 0.01
+        received = []
+
+        async def handler(message):
+            received.append(message)
+
+        await backplane.subscribe("collab:1", handler)
+        await until(lambda: server.subscribers.get("collab:1"))
+        await backplane.publish("collab:1", {"n": 1})
+        await until(lambda: received == [{"n": 1}])
+        assert server.commands.count("AUTH") == 2
+
+        # サーバーが接続を切っても、再接続して購読し直し、発行も再送する
+        server.drop()
+        await until(lambda: server.subscribers.get("collab:1"))
+        await backplane.publish("collab:1", {"n": 2})
+        await until(lambda: received == [{"n": 1}, {"n": 2}])
+
+        # 購読を解除したチャンネルのメッセージは届かない
+        await backplane.unsubscribe("collab:1", handler)
+        await until(lambda: not server.subscribers.get("collab:1"))
+        await backplane.publish("collab:1", {"n": 3})
+        await asyncio.sleep(0.05)
+        assert received == [{"n": 1}, {"n": 2}]
+
+        await backplane.close()
+        unix_server.close()
+        await unix_server.wait_closed()
+
+    with tempfile.TemporaryDirectory(prefix="bp") as directory:
+        asyncio.run(scenario(os.path.join(directory, "resp.sock")))
+
+
+def test_collaboration_rejoin_waits_for_final_save(client: TestClient):
+    from conftest import TestingAsyncSessionLocal
+    from module.backplane import InProcessBackplane
+    from module.collab import CollabManager
+
+    client.post("/auth/register", json={"username": "rejoin", "password": "rejoin-pass"})
+    token = client.post("/auth/login", data={"username": "rejoin", "password": "rejoin-pass"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    presentation = {"slides": [{"id": "s1", "elements": [{"id": "e1", "type": "text", "content": "a"}]}]}
+    slide = client.post("/slides", json={"slide_data": json.dumps(presentation)}, headers=headers).json()
+    user_id = client.get("/users/me", headers=headers).json()["id"]
+
+    async def scenario():
+        manager = CollabManager(TestingAsyncSessionLocal)
+        room, connection = await manager.join(slide["id"], _FakeWebSocket(), user_id)
+        await room.handle_message(connection, {"type": "ops", "ops": [
+            {"op": "set", "page": "s1", "el": "e1", "path": "content", "value": "edited"},
+        ]})
+
+        # 最後の保存に時間がかかっている間に再接続しても、保存後の状態でルームを作り直す
+        save = room.save
+
+        async def slow_save():
+            await asyncio.sleep(0.05)
+            await save()
+
+        room.save = slow_save
+        leaving = asyncio.create_task(manager.leave(room, connection))
+        await asyncio.sleep(0)
+        assert slide["id"] not in manager.rooms
+        rejoined, connection = await manager.join(slide["id"], _FakeWebSocket(), user_id)
+        assert leaving.done() and rejoined is not room
+        assert rejoined.materialize()["slides"][0]["elements"][0]["content"] == "edited"
+
+        # クライアントの ts は現在の時刻 + 1 に制限され、巨大な ts で以降の競合に勝ち続けることはできない
+        clock = rejoined.clock
+        await rejoined.handle_message(connection, {"type": "ops", "ops": [
+            {"op": "set", "page": "s1", "el": "e1", "path": "content", "value": "greedy", "ts": 10 ** 12},
+        ]})
+        assert rejoined.clock == clock + 1
+        await rejoined.handle_message(connection, {"type": "ops", "ops": [
+            {"op": "set", "page": "s1", "el": "e1", "path": "content", "value": "later"},
+        ]})
+        assert rejoined.materialize()["slides"][0]["elements"][0]["content"] == "later"
+        await manager.leave(rejoined, connection)
+        await manager.close()
+
+    asyncio.run(scenario())
+
+    # 購読に時間がかかるルームがあっても、他のルームへの参加は待たされない
+    other = client.post("/slides", json={"slide_data": json.dumps(presentation)}, headers=headers).json()
+
+    class SlowBackplane(InProcessBackplane):
+        def __init__(self):
+            super().__init__()
+            self.release = asyncio.Event()
+
+        async def subscribe(self, channel, handler):
+            if channel == f"collab:{slide['id']}":
+                await self.release.wait()
+            await super().subscribe(channel, handler)
+
+    async def slow_subscribe():
+        backplane = SlowBackplane()
+        manager = CollabManager(TestingAsyncSessionLocal, backplane)
+        joining = asyncio.create_task(manager.join(slide["id"], _FakeWebSocket(), user_id))
+        await asyncio.sleep(0.05)
+        room, connection = await asyncio.wait_for(manager.join(other["id"], _FakeWebSocket(), user_id), 1)
+        assert not joining.done()
+        backplane.release.set()
+        slow_room, slow_connection = await joining
+        await manager.leave(room, connection)
+        await manager.leave(slow_room, slow_connection)
+        await manager.close()
+
+    asyncio.run(slow_subscribe())
+
+
+def test_collaboration_wire_protocol(client: TestClient, monkeypatch):
+    import msgpack
+    import module.collab as collab
+    from module.wsproto import SUBPROTOCOL_MSGPACK, pack_frame
+
+    # 同じフレームに入る連続した ops は 1 つにまとめる
+    assert pack_frame([{"type": "ops", "ops": [1]}, {"type": "ops", "ops": [2]}]) == {"type": "ops", "ops": [1, 2]}
+    assert pack_frame([{"type": "ack", "seq": 1}, {"type": "ops", "ops": [1]}]) == {
+        "type": "batch", "messages": [{"type": "ack", "seq": 1}, {"type": "ops", "ops": [1]}],
+    }
+
+    client.post("/auth/register", json={"username": "wire", "password": "wire-pass"})
+    token = client.post("/auth/login", data={"username": "wire", "password": "wire-pass"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    slide = client.post("/slides", json={"slide_data": json.dumps({"slides": []})}, headers=headers).json()
+
+    # MessagePack を要求したクライアントとはバイナリフレームでやり取りする
+    with client.websocket_connect(f"/ws/collaborate/{slide['id']}?token={token}", subprotocols=[SUBPROTOCOL_MSGPACK]) as ws:
+        assert ws.accepted_subprotocol == SUBPROTOCOL_MSGPACK
+        assert msgpack.unpackb(ws.receive_bytes())["doc"] == {"slides": []}
+        ws.send_bytes(msgpack.packb({"type": "ping"}))
+        assert msgpack.unpackb(ws.receive_bytes()) == {"type": "pong"}
+        ws.send_text("not json")
+        assert msgpack.unpackb(ws.receive_bytes())["type"] == "error"
+        # JSON で表せない bin 値を含む操作は拒否し、ルームの状態に持ち込まない
+        ws.send_bytes(msgpack.packb(
+            {"type": "ops", "seq": 1, "ops": [{"op": "page_insert", "page": "p1", "value": {"title": b"\x00"}}]},
+            use_bin_type=True,
+        ))
+        assert msgpack.unpackb(ws.receive_bytes())["type"] == "error"
+        ws.send_bytes(msgpack.packb({"type": "sync"}))
+        assert msgpack.unpackb(ws.receive_bytes())["doc"] == {"slides": []}
+        # 操作数の上限超過は不正なフレームと区別できるエラーで返す
+        ws.send_bytes(msgpack.packb({"type": "ops", "ops": [{}] * (collab.MAX_OPS_PER_MESSAGE + 1)}))
+        error = msgpack.unpackb(ws.receive_bytes())
+        assert (error["code"], error["limit"]) == ("too_many_ops", collab.MAX_OPS_PER_MESSAGE)
+        ws.send_bytes(msgpack.packb({"type": "ops", "ops": {}}))
+        assert "code" not in msgpack.unpackb(ws.receive_bytes())
+    response = client.get(f"/slides/{slide['id']}", headers=headers)
+    assert json.loads(response.json()["slide_data"]) == {"slides": []}
+
+    # エンコードできないメッセージはそのフレームだけ捨て、接続は維持する
+    async def unencodable():
+        websocket = _FakeWebSocket()
+        connection = collab.Connection(websocket, user_id=1)
+        connection.start()
+        connection.send({"type": "ops", "ops": [{"value": b"\x00"}]})
+        await asyncio.sleep(0.05)
+        connection.send({"type": "ping"})
+        await asyncio.sleep(0.05)
+        assert websocket.sent == [{"type": "ping"}]
+        connection.stop()
+
+    asyncio.run(unencodable())
+
+    # 応答のない接続はハートビートで ping を送り、アイドル時間を超えると切断する
+    monkeypatch.setattr(collab, "HEARTBEAT_INTERVAL", 0.01)
+    monkeypatch.setattr(collab, "IDLE_TIMEOUT", 0.05)
+
+    async def scenario():
+        websocket = _FakeWebSocket()
+        connection = collab.Connection(websocket, user_id=1)
+        connection.start()
+        await asyncio.sleep(0.03)
+        assert {"type": "ping"} in websocket.sent and websocket.closed is None
+        await asyncio.sleep(0.1)
+        assert websocket.closed == (collab.WS_CLOSE_IDLE, "Idle timeout")
+        connection.stop()
+
+    asyncio.run(scenario())
+
+
+def test_blocklist_snapshot_matcher(client: TestClient, tmp_path, monkeypatch):
+    import main
+    from module.blocklist import BlocklistMatcher, BlocklistRefresher
+
+    path = str(tmp_path / "blocklist.snapshot")
+    built = BlocklistMatcher.from_domains({
+        "phishing": ["evil.example", "shared.example"],
+        "urlhaus": ["malware.example", "shared.example", "deep.evil.example"],
+    })
+    built.write_snapshot(path)
+
+    # スナップショットは mmap するだけで読み込める
+    refresher = BlocklistRefresher(lambda: None, {"phishing": [], "urlhaus": []}, path, str(tmp_path / "lists"))
+    monkeypatch.setattr(main, "blocklist_refresher", refresher)
+    assert refresher.load_snapshot()
+    matcher = refresher.matcher
+    assert matcher.path == path and len(matcher) == 4
+    assert matcher.counts() == {"phishing": 2, "urlhaus": 2}
+    # 同じスナップショットは読み直さない
+    assert not refresher.load_snapshot()
+
+    # サブドメインも一致し、phishing が urlhaus より優先される
+    assert main._check_domain_safety("www.deep.evil.example") == {"matched_domain": "evil.example", "source": "phishing"}
+    assert main._check_domain_safety("a.malware.example") == {"matched_domain": "malware.example", "source": "urlhaus"}
+    assert main._check_domain_safety("shared.example")["source"] == "phishing"
+    assert main._check_domain_safety("example") is None
+
+    response = client.post("/api/url/safe-check", json={"url": "https://login.evil.example/path"})
+    assert response.json() == {"safe": False, "reason": "matched", "matched_domain": "evil.example", "source": "phishing"}
+    response = client.post("/api/url/safe-check", json={"url": "https://good.example/"})
+    assert response.json()["safe"] is True
+    matcher.close()
+
+
+def test_blocklist_background_refresh(tmp_path):
+    import httpx
+    from module.blocklist import BlocklistRefresher
+
+    bodies = {
+        "https://lists.test/phishing.txt": "# comment\n0.0.0.0 evil.example\nphish.example\n",
+        "https://lists.test/urlhaus.txt": "malware.example\n",
+    }
+    requests = []
+    failures = {}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        url = str(request.url)
+        requests.append((url, request.headers.get("if-none-match")))
+        if failures.get(url):
+            failures[url] -= 1
+            return httpx.Response(503)
+        etag = '"%s"' % hashlib.sha256(bodies[url].encode()).hexdigest()[:8]
+        if request.headers.get("if-none-match") == etag:
+            return httpx.Response(304)
+        return httpx.Response(200, headers={"ETag": etag}, content=bodies[url].encode())
+
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    refresher = BlocklistRefresher(
+        lambda: http_client,
+        {"phishing": ["https://lists.test/phishing.txt"], "urlhaus": ["https://lists.test/urlhaus.txt"]},
+        str(tmp_path / "blocklist.snapshot"), str(tmp_path / "lists"), ttl=3600,
+    )
+
+    async def scenario():
+        await refresher.refresh()
+        first = refresher.matcher
+        assert first.counts() == {"phishing": 2, "urlhaus": 1}
+        assert refresher.match("a.evil.example") == ("evil.example", "phishing")
+        assert all(etag is None for _, etag in requests)
+
+        # TTL 内はダウンロードしない
+        requests.clear()
+        await refresher.refresh()
+        assert requests == [] and refresher.matcher is first
+
+        # TTL 切れでも、変更がなければ(304)照合器を作り直さない
+        refresher.ttl = 0
+        await refresher.refresh()
+        assert len(requests) == 2 and all(etag for _, etag in requests)
+        assert refresher.matcher is first
+
+        # 変更されたリストだけ取り直して差し替える
+        requests.clear()
+        bodies["https://lists.test/urlhaus.txt"] = "malware.example\nworm.example\n"
+        await refresher.refresh()
+        assert refresher.matcher is not first
+        assert refresher.match("worm.example") == ("worm.example", "urlhaus")
+
+        # 一時的なエラーは再試行し、その回の更新を取りこぼさない
+        requests.clear()
+        failures["https://lists.test/urlhaus.txt"] = 1
+        bodies["https://lists.test/urlhaus.txt"] = "malware.example\nworm.example\ntrojan.example\n"
+        await refresher.refresh()
+        assert len(requests) == 3 and not refresher._retry_failed
+        assert refresher.match("trojan.example") == ("trojan.example", "urlhaus")
+        await http_client.aclose()
+        refresher.matcher.close()
+
+    asyncio.run(scenario())
+
+
+def test_url_safe_check_batch(client: TestClient, tmp_path, monkeypatch):
+    import main
+    from module.blocklist import BlocklistMatcher, BlocklistRefresher
+
+    refresher = BlocklistRefresher(lambda: None, {}, str(tmp_path / "blocklist.snapshot"), str(tmp_path / "lists"))
+    refresher.swap(BlocklistMatcher.from_domains({"phishing": ["evil.example"], "urlhaus": []}))
+    monkeypatch.setattr(main, "blocklist_refresher", refresher)
+
+    document = {"slides": [{"id": "s1", "elements": [
+        {"id": "e1", "type": "iframe", "content": {"url": "https://www.evil.example/embed"}},
+        {"id": "e2", "type": "text", "content": "see https://good.example/a"},
+        {"id": "e3", "type": "image", "content": "https://good.example/b.png"},
+    ]}]}
+    response = client.post("/api/url/safe-check/batch", json={
+        "urls": ["https://login.evil.example/", "not a url", "https://good.example/b.png"],
+        "slide_data": json.dumps(document),
+    })
+    assert response.status_code == 200
+    body = response.json()
+    results = {item["url"]: item for item in body["results"]}
+    # URL は重複を除いて出現順、ドメインは 1 回ずつ判定する
+    assert list(results) == [
+        "https://login.evil.example/", "not a url", "https://good.example/b.png", "https://www.evil.example/embed",
+    ]
+    assert body["domain_count"] == 3
+    assert results["https://login.evil.example/"]["matched_domain"] == "evil.example"
+    assert results["https://www.evil.example/embed"]["safe"] is False
+    assert results["not a url"]["reason"] == "invalid_url"
+    assert results["https://good.example/b.png"] == {
+        "url": "https://good.example/b.png", "safe": True, "reason": "clean", "matched_domain": None, "source": None,
+    }
+    # 判定結果はドメイン単位でキャッシュされる
+    assert refresher._verdicts["login.evil.example"] == ("evil.example", "phishing")
+
+    monkeypatch.setattr(main, "MAX_SAFE_CHECK_URLS", 2)
+    response = client.post("/api/url/safe-check/batch", json={"urls": ["https://a.example", "https://b.example", "https://c.example"]}, params={"lang": "en"})
+    assert response.status_code == 400
+    assert response.json()["detail"] == "Too many URLs to check at once"
+    assert client.post("/api/url/safe-check/batch", json={"slide_data": "{"}).status_code == 400
+
+
+def test_api_cache_bounds_and_stale_while_revalidate(client: TestClient, monkeypatch):
+    import httpx
+    import main
+    from module.ttlcache import TTLCache
+
+    now = [0.0]
+    cache = TTLCache(max_entries=3, max_bytes=1024, default_ttl=10, ttls={"titles": 100}, stale_ttl=50, clock=lambda: now[0])
+    loads = []
+
+    async def scenario():
+        async def load():
+            loads.append(now[0])
+            return [f"v{len(loads)}"]
+
+        assert await cache.get_or_load("pixabay::k", load) == ["v1"]
+        cached = await cache.get_or_load("pixabay::k", load)
+        assert cached == ["v1"] and len(loads) == 1
+        # TTL 切れ直後は古い値を返し、裏で 1 回だけ取り直す
+        now[0] = 15
+        assert await cache.get_or_load("pixabay::k", load) == ["v1"]
+        stale = await cache.get_or_load("pixabay::k", load)
+        assert stale == ["v1"]
+        await asyncio.sleep(0)
+        assert await cache.get_or_load("pixabay::k", load) == ["v2"]
+        # stale_ttl も過ぎたら待って取り直す
+        now[0] = 100
+        assert await cache.get_or_load("pixabay::k", load) == ["v3"]
+
+        async def failing():
+            raise httpx.ConnectError("down")
+
+        # 裏での取り直しが失敗しても古い値を使い続ける
+        now[0] = 111
+        assert await cache.get_or_load("pixabay::k", failing) == ["v3"]
+        await asyncio.sleep(0)
+        assert cache.get("pixabay::k") is None and cache.lookup("pixabay::k")[1] == ["v3"]
+        await cache.close()
+
+    asyncio.run(scenario())
+    assert len(loads) == 3
+    assert cache.ttl_for("titles::en::x") == 100 and cache.ttl_for("imageinfo::en::x") == 10
+    stats = cache.stats()
+    assert (stats["hits"], stats["stale_hits"], stats["refreshes"], stats["refresh_errors"], stats["expirations"]) == (2, 3, 1, 1, 1)
+
+    # エントリ数とバイト数の上限を超えたら古く使われたものから追い出す
+    for i in range(5):
+        cache.set(f"titles::en::{i}", ["x"])
+    assert len(cache) == 3 and cache.get("titles::en::1") is None
+    cache.set("titles::en::big", "y" * 1020)
+    assert len(cache) == 1 and cache.stats()["bytes"] <= 1024
+    cache.set("titles::en::huge", "z" * 2000)
+    assert cache.lookup("titles::en::huge")[0] is False
+    assert cache.stats()["evictions"] == 6
+
+    # Pixabay 検索は同じクエリを API に再送しない
+    calls = []
+
+    async def fake_get(client, url, *, params, max_retries, max_backoff_sec):
+        calls.append(params["q"])
+        return httpx.Response(200, json={"total": 1, "totalHits": 1, "hits": [{"id": 1, "tags": "cat"}]}, request=httpx.Request("GET", url))
+
+    monkeypatch.setattr(main, "api_cache", TTLCache())
+    monkeypatch.setattr(main, "_retrying_get", fake_get)
+    first = client.get("/api/images/search", params={"q": "Cat"})
+    second = client.get("/api/images/search", params={"q": " cat "})
+    assert first.status_code == 200 and first.json()["hits"][0]["id"] == 1
+    assert second.json() == first.json()
+    assert calls == ["Cat"]
+    assert main.api_cache.stats()["hits"] == 1
+
+
+def test_api_cache_single_flight(client: TestClient, monkeypatch):
+    import httpx
+    import main
+    from module.ttlcache import TTLCache
+
+    cache = TTLCache()
+    calls = []
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def load():
+            calls.append("load")
+            await release.wait()
+            return ["shared"]
+
+        # 同じキーの同時ミスは 1 回の呼び出しを共有する（待ち手が 1 つキャンセルされても止まらない）
+        waiters = [asyncio.ensure_future(cache.get_or_load("titles::en::cat", load)) for _ in range(5)]
+        await asyncio.sleep(0)
+        waiters[0].cancel()
+        release.set()
+        results = await asyncio.gather(*waiters, return_exceptions=True)
+        assert isinstance(results[0], asyncio.CancelledError)
+        assert results[1:] == [["shared"]] * 4
+        assert cache.get("titles::en::cat") == ["shared"]
+
+        # 失敗はすべての待ち手へ伝わり、キャッシュされない
+        async def failing():
+            calls.append("fail")
+            await asyncio.sleep(0)
+            raise httpx.ConnectError("down")
+
+        results = await asyncio.gather(
+            *(cache.get_or_load("pixabay::ja::dog", failing) for _ in range(3)), return_exceptions=True
+        )
+        assert all(isinstance(r, httpx.ConnectError) for r in results)
+        assert cache.lookup("pixabay::ja::dog")[0] is False
+
+    asyncio.run(scenario())
+    assert calls == ["load", "fail"]
+    assert cache.stats()["coalesced"] == 6
+
+    # 同時に来た同じ Wikipedia 検索は上流への問い合わせを共有する
+    requests = []
+
+    async def fake_get(client, url, *, params, max_retries, max_backoff_sec):
+        requests.append(url)
+        await asyncio.sleep(0.01)
+        body = {"query": {"pages": {"1": {"imageinfo": [{"url": f"{url}/Cat.jpg"}]}}}}
+        return httpx.Response(200, json=body, request=httpx.Request("GET", url))
+
+    monkeypatch.setattr(main, "api_cache", TTLCache())
+    monkeypatch.setattr(main, "_retrying_get", fake_get)
+
+    async def burst():
+        return await asyncio.gather(*(main.get_wiki_image("Cat") for _ in range(4)))
+
+    responses = asyncio.run(burst())
+    assert len({r.body for r in responses}) == 1
+    assert len(requests) == 2  # en/ja で 1 回ずつ
+
+
+def test_wiki_image_single_query_per_language(client: TestClient, monkeypatch):
+    import httpx
+    import main
+    from module.ttlcache import TTLCache
+
+    requests = []
+    pages = {
+        "en": {"-1": {"title": "File:Missing.png", "missing": ""},
+               "10": {"imageinfo": [{"url": "https://upload.test/en/Cat.JPG"}]},
+               "11": {"imageinfo": [{"url": "https://upload.test/en/Cat.svg"}]}},
+        "ja": {"20": {"imageinfo": [{"url": "https://upload.test/ja/Neko.png"}]}},
+    }
+
+    async def fake_get(client, url, *, params, max_retries, max_backoff_sec):
+        assert client is main.shared_http_client
+        lang = url.split("//")[1].split(".")[0]
+        requests.append((lang, params["generator"], params["prop"], params["titles"]))
+        return httpx.Response(200, json={"query": {"pages": pages[lang]}}, request=httpx.Request("GET", url))
+
+    monkeypatch.setattr(main, "api_cache", TTLCache())
+    monkeypatch.setattr(main, "_retrying_get", fake_get)
+    response = client.get("/wiki/image/Cat")
+    assert response.status_code == 200
+    assert response.json() == {"image_urls": ["https://upload.test/en/Cat.JPG", "https://upload.test/ja/Neko.png"]}
+    assert sorted(requests) == [("en", "images", "imageinfo", "Cat"), ("ja", "images", "imageinfo", "Cat")]
+
+    # 言語ごとにキャッシュされる
+    assert client.get("/wiki/image/Cat").status_code == 200
+    assert len(requests) == 2
+    assert main.api_cache.lookup("wikiimages::ja::Cat")[1] == ["https://upload.test/ja/Neko.png"]
+
+    pages["en"] = pages["ja"] = {}
+    assert client.get("/wiki/image/Nothing").status_code == 404